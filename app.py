@@ -6,8 +6,10 @@ from flask import Flask, render_template, jsonify
 from flask_socketio import SocketIO
 from flask_migrate import Migrate
 from models import db, User
+from models.schema import upgrade_schema
 from routes import register_routes
 from services.status_monitor import FirewallMonitor
+from services.job_queue import job_queue
 from config import Config
 import threading
 import time
@@ -23,6 +25,9 @@ migrate = Migrate(app, db)
 # 初始化SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# 初始化后台任务队列
+job_queue.init_app(app, socketio)
+
 # 注册所有路由
 register_routes(app)
 
@@ -49,8 +54,10 @@ def start_monitor():
 # 创建初始用户
 def create_default_user():
 	with app.app_context():
-		# 确保表已创建
-		db.create_all()
+		# 确保表已创建，并为旧版本创建的表补充新增的列
+		added = upgrade_schema()
+		if added:
+			print(f"Added database columns: {', '.join(added)}")
 		
 		# 检查是否有用户，如果没有则创建默认用户
 		if User.query.count() == 0:
@@ -60,6 +67,9 @@ def create_default_user():
 			db.session.add(default_user)
 			db.session.commit()
 			print(f"Created default admin user with password: {default_password}")
+		
+		# 上次退出时未完成的后台任务不会再继续
+		job_queue.fail_interrupted()
 
 
 if __name__ == '__main__':
@@ -16,6 +16,16 @@ class Config:
 	# 防火墙配置
 	IPTABLES_PATH = os.environ.get('IPTABLES_PATH') or '/sbin/iptables'
 	NFTABLES_PATH = os.environ.get('NFTABLES_PATH') or '/sbin/nft'
+	IPTABLES_RESTORE_PATH = os.environ.get('IPTABLES_RESTORE_PATH') or '/sbin/iptables-restore'
+	IPTABLES_SAVE_PATH = os.environ.get('IPTABLES_SAVE_PATH') or '/sbin/iptables-save'
+	IP6TABLES_SAVE_PATH = os.environ.get('IP6TABLES_SAVE_PATH') or '/sbin/ip6tables-save'
+	IPSET_PATH = os.environ.get('IPSET_PATH') or '/sbin/ipset'
+	# 连续规则达到该数量时编译为命名集合/判决映射
+	RULE_COMPILE_MIN_GROUP = int(os.environ.get('RULE_COMPILE_MIN_GROUP') or 4)
+	# 按协议/目的端口桶拆分为goto子链的基础链（逗号分隔，为空时不分片），以及分片所需的最少规则数和端口桶数
+	RULE_SHARD_CHAINS = os.environ.get('RULE_SHARD_CHAINS') or ''
+	RULE_SHARD_MIN_RULES = int(os.environ.get('RULE_SHARD_MIN_RULES') or 32)
+	RULE_SHARD_PORT_BUCKETS = int(os.environ.get('RULE_SHARD_PORT_BUCKETS') or 8)
 	
 	# 日志配置
 	IPTABLES_LOG_PATH = os.environ.get('IPTABLES_LOG_PATH') or '/var/log/iptables.log'
@@ -23,6 +33,13 @@ class Config:
 	
 	# 监控配置
 	MONITOR_INTERVAL = int(os.environ.get('MONITOR_INTERVAL') or 30)  # 秒
+	RULE_STATS_RETENTION_DAYS = int(os.environ.get('RULE_STATS_RETENTION_DAYS') or 7)
+	# 通过 nft monitor / xtables-monitor 事件流检测内核规则漂移
+	DRIFT_WATCH_ENABLED = os.environ.get('DRIFT_WATCH_ENABLED', 'True').lower() == 'true'
+	XTABLES_MONITOR_PATH = os.environ.get('XTABLES_MONITOR_PATH') or '/usr/sbin/xtables-monitor'
+	
+	# 后台任务配置
+	JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
 	
 	# 备份配置
 	BACKUP_DIR = os.environ.get('BACKUP_DIR') or '/app/backups'
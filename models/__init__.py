@@ -3,8 +3,9 @@ from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
-from models.rule import FirewallRule, RuleTemplate
+from models.rule import FirewallRule, RuleTemplate, RulesetState, RuleTombstone, ObjectGroup, ObjectGroupMember
 from models.log import FirewallLog, AlertConfig
-from models.status import FirewallStatus, ConnectionStat
+from models.status import FirewallStatus, ConnectionStat, RuleCounterSample
 from models.user import User
 from models.setting import SystemSetting, SystemBackup
+from models.job import Job
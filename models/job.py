@@ -0,0 +1,48 @@
+# models/job.py
+import json
+from datetime import datetime
+from models import db
+
+# 任务状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+
+class Job(db.Model):
+	"""后台任务记录：状态、结果和耗时持久化，运行中的进度由任务队列在内存中维护"""
+	__tablename__ = 'jobs'
+	
+	id = db.Column(db.String(32), primary_key=True)
+	job_type = db.Column(db.String(50), nullable=False)
+	status = db.Column(db.String(20), default=JOB_PENDING, index=True)
+	progress = db.Column(db.Float, default=0)  # 0-100
+	message = db.Column(db.String(255))
+	result = db.Column(db.Text)  # JSON
+	error = db.Column(db.Text)
+	created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+	started_at = db.Column(db.DateTime)
+	finished_at = db.Column(db.DateTime)
+	
+	@property
+	def duration(self):
+		"""运行时长（秒）；运行中的任务计算到当前时间"""
+		if not self.started_at:
+			return None
+		return round(((self.finished_at or datetime.utcnow()) - self.started_at).total_seconds(), 3)
+	
+	def to_dict(self):
+		return {
+			'id': self.id,
+			'job_type': self.job_type,
+			'status': self.status,
+			'progress': self.progress,
+			'message': self.message,
+			'result': json.loads(self.result) if self.result else None,
+			'error': self.error,
+			'created_at': self.created_at.isoformat() if self.created_at else None,
+			'started_at': self.started_at.isoformat() if self.started_at else None,
+			'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+			'duration': self.duration
+		}
@@ -1,7 +1,166 @@
 # models/rule.py
+import ipaddress
+import json
 from datetime import datetime
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
 from models import db
 
+# 受管规则所在的专用链前缀，例如 INPUT 的受管规则放在 FWM_INPUT 中
+MANAGED_CHAIN_PREFIX = 'FWM_'
+
+
+def managed_chain_name(chain):
+	"""返回基础链对应的受管链名称"""
+	return f'{MANAGED_CHAIN_PREFIX}{chain}'
+
+
+# 对象组在内核中的集合名称前缀（nftables命名集合与ipset同名）：FWM_ADDR_<组名>、FWM_PORT_<组名>
+OBJECT_GROUP_PREFIXES = {
+	'address': 'FWM_ADDR_',
+	'port': 'FWM_PORT_'
+}
+
+# 规则字段 -> 可引用的对象组类型；字段值 @组名 表示引用该对象组
+OBJECT_GROUP_FIELDS = {
+	'source': 'address',
+	'destination': 'address',
+	'port': 'port'
+}
+
+
+def object_group_set(group_type, name):
+	"""对象组在内核中的集合名称"""
+	return f'{OBJECT_GROUP_PREFIXES[group_type]}{name}'
+
+
+def object_group_name(value):
+	"""字段值引用的对象组名；不是对象组引用（包括编译集合的 @FWM_... 引用）时返回None"""
+	if isinstance(value, str) and value.startswith('@') and not value.startswith(f'@{MANAGED_CHAIN_PREFIX}'):
+		return value[1:]
+	return None
+
+
+def object_group_refs(rule):
+	"""规则引用的对象组：[(字段, 组类型, 组名)]"""
+	refs = []
+	for field, group_type in OBJECT_GROUP_FIELDS.items():
+		name = object_group_name(getattr(rule, field, None))
+		if name:
+			refs.append((field, group_type, name))
+	return refs
+
+
+def _object_group_reference(value, group_type):
+	"""内核中解析出的对象组集合引用（@FWM_ADDR_组名）还原为规则中的写法（@组名）"""
+	prefix = f'@{OBJECT_GROUP_PREFIXES[group_type]}'
+	return f'@{value[len(prefix):]}' if value.startswith(prefix) else value
+
+
+def normalize_address(value):
+	"""规范化地址字段（10.0.0.1 与 10.0.0.1/32 视为相同）"""
+	if not value or value in ('any', '0.0.0.0/0', '::/0'):
+		return 'any'
+	if value.startswith('@'):
+		return _object_group_reference(value, 'address')
+	try:
+		return str(ipaddress.ip_network(value, strict=False))
+	except ValueError:
+		return value
+
+
+def normalize_port(value):
+	"""规范化端口字段（iptables的 1000:2000 与 1000-2000 视为相同）"""
+	if not value or value == 'any':
+		return 'any'
+	if str(value).startswith('@'):
+		return _object_group_reference(str(value), 'port')
+	value = str(value).replace(':', '-')
+	if '-' in value:
+		start, end = value.split('-', 1)
+		return start if start == end else f'{start}-{end}'
+	return value
+
+
+# 规则中的匿名计数器，用于统计每条规则的命中次数
+NFT_COUNTER = {'counter': {'packets': 0, 'bytes': 0}}
+
+
+def _nft_match(protocol, field, right):
+	"""生成nftables JSON的payload匹配表达式"""
+	return {'match': {'op': '==', 'left': {'payload': {'protocol': protocol, 'field': field}}, 'right': right}}
+
+
+def _nft_address(value):
+	"""将地址/网段转换为nftables JSON值（网段使用prefix对象，对象组引用其命名集合）"""
+	name = object_group_name(value)
+	if name:
+		return f"@{object_group_set('address', name)}"
+	try:
+		network = ipaddress.ip_network(value, strict=False)
+	except ValueError:
+		return value
+	if network.prefixlen == network.max_prefixlen:
+		return str(network.network_address)
+	return {'prefix': {'addr': str(network.network_address), 'len': network.prefixlen}}
+
+
+def _nft_port(value):
+	"""将端口/端口范围转换为nftables JSON值（对象组引用其命名集合）"""
+	name = object_group_name(value)
+	if name:
+		return f"@{object_group_set('port', name)}"
+	if '-' in value:  # 端口范围
+		start, end = value.split('-')
+		return {'range': [int(start), int(end)]}
+	return int(value)
+
+
+def _nft_verdict(action):
+	"""将规则动作转换为nftables JSON判决语句"""
+	verdict = action.upper()
+	if verdict in ('ACCEPT', 'DROP', 'REJECT', 'RETURN', 'CONTINUE'):
+		return {verdict.lower(): None}
+	if verdict == 'LOG':
+		return {'log': {}}
+	return {'jump': {'target': action}}
+
+
+def _iptables_address(option, value, direction):
+	"""iptables的地址匹配参数；对象组引用匹配其ipset"""
+	name = object_group_name(value)
+	if name:
+		return ['-m', 'set', '--match-set', object_group_set('address', name), direction]
+	return [option, value]
+
+
+def iptables_restore_line(args):
+	"""把iptables参数拼接为iptables-restore的一行：含空白或引号的参数（例如注释）加双引号，
+	直接执行iptables时参数列表原样传递，不加引号"""
+	quoted = []
+	for arg in args:
+		if arg == '' or any(char.isspace() or char in '"\'\\' for char in arg):
+			arg = '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+		quoted.append(arg)
+	return ' '.join(quoted)
+
+
+def _nft_address_text(value):
+	"""nft命令文本中的地址；对象组引用其命名集合"""
+	name = object_group_name(value)
+	return f"@{object_group_set('address', name)}" if name else value
+
+
+def rule_signature(protocol, source, destination, port, action):
+	"""生成规则匹配条件的规范化签名，用于比对数据库与内核中的规则"""
+	return (
+		(protocol or 'all').lower(),
+		normalize_address(source),
+		normalize_address(destination),
+		normalize_port(port),
+		(action or '').upper()
+	)
+
 
 class FirewallRule(db.Model):
 	__tablename__ = 'firewall_rules'
@@ -17,6 +176,12 @@ class FirewallRule(db.Model):
 	comment = db.Column(db.String(200))
 	priority = db.Column(db.Integer)
 	enabled = db.Column(db.Boolean, default=True)
+	kernel_handle = db.Column(db.Integer)  # 应用时记录的nftables规则句柄
+	kernel_position = db.Column(db.Integer)  # 应用时记录的iptables受管链内位置（从1开始）
+	kernel_set = db.Column(db.String(64))  # 规则被编译进的命名集合/判决映射，为空表示单独的内核规则
+	generation = db.Column(db.BigInteger, default=0, index=True)  # 最后一次修改时的规则集代数
+	template_id = db.Column(db.Integer, index=True)  # 由模板展开生成时所属的模板
+	expires_at = db.Column(db.DateTime, index=True)  # 过期时间（UTC），为空表示永久规则
 	created_at = db.Column(db.DateTime, default=datetime.utcnow)
 	updated_at = db.Column(db.DateTime, onupdate=datetime.utcnow)
 	
@@ -33,24 +198,53 @@ class FirewallRule(db.Model):
 			'comment': self.comment,
 			'priority': self.priority,
 			'enabled': self.enabled,
+			'kernel_handle': self.kernel_handle,
+			'kernel_position': self.kernel_position,
+			'kernel_set': self.kernel_set,
+			'generation': self.generation,
+			'template_id': self.template_id,
+			'expires_at': self.expires_at.isoformat() if self.expires_at else None,
 			'created_at': self.created_at.isoformat() if self.created_at else None,
 			'updated_at': self.updated_at.isoformat() if self.updated_at else None
 		}
 	
-	def to_iptables_command(self):
-		cmd = ['-A', self.chain]
+	@property
+	def kernel_chain(self):
+		"""规则在内核中实际所在的受管链"""
+		return managed_chain_name(self.chain)
+	
+	@property
+	def kernel_key(self):
+		"""规则在内核中的定位：(受管链, iptables位置或nftables句柄)"""
+		if self.rule_type == 'iptables':
+			return self.kernel_chain, self.kernel_position
+		return self.kernel_chain, self.kernel_handle
+	
+	def signature(self):
+		return rule_signature(self.protocol, self.source, self.destination, self.port, self.action)
+	
+	def to_iptables_command(self, position=None):
+		"""生成iptables命令参数；position为插入位置（从1开始），为空时追加到链尾"""
+		if position is not None:
+			return ['-I', self.kernel_chain, str(position)] + self.iptables_rule_spec()
+		return ['-A', self.kernel_chain] + self.iptables_rule_spec()
+	
+	def iptables_rule_spec(self):
+		cmd = []
 		
 		if self.protocol and self.protocol != 'all':
 			cmd.extend(['-p', self.protocol])
 		
 		if self.source and self.source != 'any':
-			cmd.extend(['-s', self.source])
+			cmd.extend(_iptables_address('-s', self.source, 'src'))
 		
 		if self.destination and self.destination != 'any':
-			cmd.extend(['-d', self.destination])
+			cmd.extend(_iptables_address('-d', self.destination, 'dst'))
 		
 		if self.port and self.port != 'any':
-			if '-' in self.port:  # 端口范围
+			if object_group_name(self.port):
+				cmd.extend(['-m', 'set', '--match-set', object_group_set('port', object_group_name(self.port)), 'dst'])
+			elif '-' in self.port:  # 端口范围
 				cmd.extend(['--dport', self.port])
 			else:
 				cmd.extend(['--dport', self.port])
@@ -59,7 +253,7 @@ class FirewallRule(db.Model):
 			cmd.extend(['-j', self.action])
 		
 		if self.comment:
-			cmd.extend(['-m', 'comment', '--comment', f'"{self.comment}"'])
+			cmd.extend(['-m', 'comment', '--comment', self.comment])
 		
 		return cmd
 	
@@ -67,30 +261,30 @@ class FirewallRule(db.Model):
 		table = 'filter'
 		
 		# 构建nftables命令
-		cmd = f'add rule {table} {self.chain}'
-		
+		return f'add rule {table} {self.kernel_chain} {self.nftables_rule_spec()}'
+	
+	def nftables_rule_spec(self):
 		conditions = []
 		
 		if self.protocol and self.protocol != 'all':
 			conditions.append(f'ip protocol {self.protocol}')
 		
 		if self.source and self.source != 'any':
-			conditions.append(f'ip saddr {self.source}')
+			conditions.append(f'ip saddr {_nft_address_text(self.source)}')
 		
 		if self.destination and self.destination != 'any':
-			conditions.append(f'ip daddr {self.destination}')
+			conditions.append(f'ip daddr {_nft_address_text(self.destination)}')
 		
 		if self.port and self.port != 'any':
 			if self.protocol in ['tcp', 'udp']:
-				if '-' in self.port:  # 端口范围
+				if object_group_name(self.port):
+					conditions.append(f"{self.protocol} dport @{object_group_set('port', object_group_name(self.port))}")
+				elif '-' in self.port:  # 端口范围
 					start, end = self.port.split('-')
 					conditions.append(f'{self.protocol} dport {{{start}-{end}}}')
 				else:
 					conditions.append(f'{self.protocol} dport {self.port}')
 		
-		if conditions:
-			cmd += ' ' + ' '.join(conditions)
-		
 		if self.action:
 			action_map = {
 				'ACCEPT': 'accept',
@@ -98,13 +292,49 @@ class FirewallRule(db.Model):
 				'REJECT': 'reject',
 				'LOG': 'log'
 			}
-			action = action_map.get(self.action, self.action.lower())
-			cmd += f' {action}'
+			conditions.append('counter')
+			conditions.append(action_map.get(self.action, self.action.lower()))
 		
 		if self.comment:
-			cmd += f' comment "{self.comment}"'
+			conditions.append(f'comment "{self.comment}"')
 		
-		return cmd
+		return ' '.join(conditions)
+	
+	def to_nftables_json(self, verb='add', position=None):
+		"""生成libnftables JSON命令对象；position为插入位置参考的规则句柄"""
+		rule = {
+			'family': 'ip',
+			'table': 'filter',
+			'chain': self.kernel_chain,
+			'expr': self.nftables_expr()
+		}
+		if position is not None:
+			rule['handle'] = position
+		if self.comment:
+			rule['comment'] = self.comment
+		return {verb: {'rule': rule}}
+	
+	def nftables_expr(self):
+		"""生成规则的nftables JSON表达式列表"""
+		expr = []
+		
+		if self.protocol and self.protocol != 'all':
+			expr.append(_nft_match('ip', 'protocol', self.protocol))
+		
+		if self.source and self.source != 'any':
+			expr.append(_nft_match('ip', 'saddr', _nft_address(self.source)))
+		
+		if self.destination and self.destination != 'any':
+			expr.append(_nft_match('ip', 'daddr', _nft_address(self.destination)))
+		
+		if self.port and self.port != 'any' and self.protocol in ['tcp', 'udp']:
+			expr.append(_nft_match(self.protocol, 'dport', _nft_port(self.port)))
+		
+		if self.action:
+			expr.append(NFT_COUNTER)
+			expr.append(_nft_verdict(self.action))
+		
+		return expr
 
 
 class RuleTemplate(db.Model):
@@ -113,8 +343,10 @@ class RuleTemplate(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(100), unique=True)
 	description = db.Column(db.String(255))
-	rule_json = db.Column(db.Text)  # 存储规则模板的JSON
+	rule_json = db.Column(db.Text)  # 存储规则模板的JSON，字段中可用 {{参数名}} 引用参数
+	parameters = db.Column(db.Text)  # 参数定义的JSON列表：[{name, type, default, description}]
 	created_at = db.Column(db.DateTime, default=datetime.utcnow)
+	updated_at = db.Column(db.DateTime, onupdate=datetime.utcnow)
 	
 	def to_dict(self):
 		return {
@@ -122,5 +354,128 @@ class RuleTemplate(db.Model):
 			'name': self.name,
 			'description': self.description,
 			'rule_json': self.rule_json,
-			'created_at': self.created_at.isoformat() if self.created_at else None
+			'parameters': json.loads(self.parameters) if self.parameters else [],
+			'created_at': self.created_at.isoformat() if self.created_at else None,
+			'updated_at': self.updated_at.isoformat() if self.updated_at else None
+		}
+
+
+class ObjectGroup(db.Model):
+	"""命名的地址/端口对象组：规则以 @组名 引用，在内核中编译为同名的nftables命名集合或ipset"""
+	__tablename__ = 'object_groups'
+	
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(20), unique=True, nullable=False)
+	group_type = db.Column(db.String(10), nullable=False)  # address 或 port
+	description = db.Column(db.String(255))
+	created_at = db.Column(db.DateTime, default=datetime.utcnow)
+	updated_at = db.Column(db.DateTime, onupdate=datetime.utcnow)
+	
+	@property
+	def kernel_name(self):
+		return object_group_set(self.group_type, self.name)
+	
+	def to_dict(self, members=None):
+		data = {
+			'id': self.id,
+			'name': self.name,
+			'group_type': self.group_type,
+			'description': self.description,
+			'reference': f'@{self.name}',
+			'kernel_name': self.kernel_name,
+			'created_at': self.created_at.isoformat() if self.created_at else None,
+			'updated_at': self.updated_at.isoformat() if self.updated_at else None
 		}
+		if members is not None:
+			data['members'] = members
+		return data
+
+
+class ObjectGroupMember(db.Model):
+	"""对象组成员：一个IPv4地址/网段，或一个端口/端口范围"""
+	__tablename__ = 'object_group_members'
+	__table_args__ = (db.UniqueConstraint('group_id', 'value'),)
+	
+	id = db.Column(db.Integer, primary_key=True)
+	group_id = db.Column(db.Integer, db.ForeignKey('object_groups.id'), nullable=False, index=True)
+	value = db.Column(db.String(50), nullable=False)
+
+
+# 当前事务已分配的规则集代数在 session.info 中的键
+GENERATION_KEY = 'ruleset_generation'
+
+
+class RulesetState(db.Model):
+	"""规则集代数：规则每次被修改（每个事务一次）时单调递增"""
+	__tablename__ = 'ruleset_state'
+	
+	id = db.Column(db.Integer, primary_key=True)
+	generation = db.Column(db.BigInteger, default=0, nullable=False)
+
+
+class RuleTombstone(db.Model):
+	"""已删除规则的记录，用于按代数返回增量"""
+	__tablename__ = 'rule_tombstones'
+	
+	id = db.Column(db.Integer, primary_key=True)
+	rule_id = db.Column(db.Integer, nullable=False)
+	rule_type = db.Column(db.String(10))
+	generation = db.Column(db.BigInteger, nullable=False, index=True)
+	deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def current_generation():
+	"""当前已提交的规则集代数"""
+	generation = db.session.execute(
+		select(RulesetState.generation).where(RulesetState.id == 1)).scalar()
+	return generation or 0
+
+
+def bump_generation(session):
+	"""当前事务的规则集代数：事务中第一次修改规则时加一，同一事务内复用"""
+	generation = session.info.get(GENERATION_KEY)
+	if generation is None:
+		table = RulesetState.__table__
+		connection = session.connection()
+		result = connection.execute(
+			table.update().where(table.c.id == 1).values(generation=table.c.generation + 1))
+		if result.rowcount == 0:
+			connection.execute(table.insert().values(id=1, generation=1))
+		generation = connection.execute(select(table.c.generation).where(table.c.id == 1)).scalar()
+		session.info[GENERATION_KEY] = generation
+	return generation
+
+
+def tombstone_rules(session, query):
+	"""批量删除规则（query.delete）前为其记录删除代数"""
+	rows = session.query(FirewallRule.id, FirewallRule.rule_type).filter(
+		FirewallRule.id.in_(query.with_entities(FirewallRule.id))).all()
+	if rows:
+		generation = bump_generation(session)
+		session.bulk_insert_mappings(RuleTombstone, [
+			{'rule_id': rule_id, 'rule_type': rule_type, 'generation': generation} for rule_id, rule_type in rows
+		])
+
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_rule_generation(session, flush_context, instances):
+	"""规则的新增、修改和删除在flush前记录规则集代数（批量操作需显式调用bump_generation）"""
+	changed = [obj for obj in session.new if isinstance(obj, FirewallRule)]
+	changed.extend(obj for obj in session.dirty
+	               if isinstance(obj, FirewallRule) and session.is_modified(obj, include_collections=False))
+	deleted = [obj for obj in session.deleted if isinstance(obj, FirewallRule)]
+	if not changed and not deleted:
+		return
+	
+	generation = bump_generation(session)
+	for rule in changed:
+		rule.generation = generation
+	for rule in deleted:
+		session.add(RuleTombstone(rule_id=rule.id, rule_type=rule.rule_type, generation=generation))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _reset_rule_generation(session, transaction):
+	# flush内部的子事务结束时保留；保存点结束后的修改重新递增，代数可能跳号但保持单调
+	if transaction.parent is None or transaction.nested:
+		session.info.pop(GENERATION_KEY, None)
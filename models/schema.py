@@ -0,0 +1,32 @@
+# models/schema.py
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+from models import db
+
+
+def upgrade_schema():
+	"""创建缺少的表，并为已有的表补充模型中新增的列及其索引，返回补充的 表.列 列表
+	
+	db.create_all() 不会修改已存在的表，旧版本创建的数据库缺少新增的列时查询会失败。
+	新增的列都允许为空，ALTER TABLE ADD COLUMN 后已有行的值为NULL。
+	"""
+	db.create_all()
+	inspector = inspect(db.engine)
+	preparer = db.engine.dialect.identifier_preparer
+	added = []
+	
+	with db.engine.begin() as connection:
+		for table in db.metadata.sorted_tables:
+			existing = {column['name'] for column in inspector.get_columns(table.name)}
+			missing = [column for column in table.columns if column.name not in existing]
+			for column in missing:
+				column_type = column.type.compile(dialect=db.engine.dialect)
+				connection.exec_driver_sql(f'ALTER TABLE {preparer.format_table(table)} '
+				                           f'ADD COLUMN {preparer.format_column(column)} {column_type}')
+				added.append(f'{table.name}.{column.name}')
+			
+			missing_names = {column.name for column in missing}
+			for index in table.indexes:
+				if any(column.name in missing_names for column in index.columns):
+					connection.execute(CreateIndex(index))
+	return added
@@ -43,3 +43,26 @@ class ConnectionStat(db.Model):
 			'syn_sent': self.syn_sent,
 			'udp_connections': self.udp_connections
 		}
+
+
+class RuleCounterSample(db.Model):
+	"""规则计数器增量的时间序列，只记录有命中的采样周期"""
+	__tablename__ = 'rule_counter_samples'
+	__table_args__ = (db.Index('ix_rule_counter_samples_rule_time', 'rule_id', 'timestamp'),)
+	
+	id = db.Column(db.Integer, primary_key=True)
+	rule_id = db.Column(db.Integer, nullable=False)
+	timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+	interval = db.Column(db.Float)  # 与上一次采样的间隔（秒）
+	packets = db.Column(db.BigInteger, default=0)
+	bytes = db.Column(db.BigInteger, default=0)
+	
+	def to_dict(self):
+		return {
+			'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+			'interval': self.interval,
+			'packets': self.packets,
+			'bytes': self.bytes,
+			'pps': round(self.packets / self.interval, 3) if self.interval else None,
+			'bps': round(self.bytes / self.interval, 3) if self.interval else None
+		}
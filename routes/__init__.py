@@ -4,6 +4,8 @@ from routes.logs import logs_bp
 from routes.status import status_bp
 from routes.users import users_bp
 from routes.settings import settings_bp
+from routes.jobs import jobs_bp
+from routes.object_groups import object_groups_bp
 
 def register_routes(app):
     """注册所有路由蓝图"""
@@ -12,3 +14,5 @@ def register_routes(app):
     app.register_blueprint(status_bp, url_prefix='/api/status')
     app.register_blueprint(users_bp, url_prefix='/api/users')
     app.register_blueprint(settings_bp, url_prefix='/api/settings')
+    app.register_blueprint(jobs_bp, url_prefix='/api/jobs')
+    app.register_blueprint(object_groups_bp, url_prefix='/api/object-groups')
@@ -0,0 +1,60 @@
+# routes/jobs.py
+from flask import Blueprint, request, jsonify
+from flask_restful import Api, Resource
+from models import Job
+from services.job_queue import job_queue
+from utils.security import require_api_key
+
+jobs_bp = Blueprint('jobs', __name__)
+api = Api(jobs_bp)
+
+
+class JobList(Resource):
+	@require_api_key
+	def get(self):
+		"""获取后台任务列表"""
+		page = request.args.get('page', 1, type=int)
+		per_page = request.args.get('per_page', 50, type=int)
+		
+		query = Job.query
+		status = request.args.get('status')
+		if status:
+			query = query.filter(Job.status == status)
+		job_type = request.args.get('job_type')
+		if job_type:
+			query = query.filter(Job.job_type == job_type)
+		
+		paginated_jobs = query.order_by(Job.created_at.desc()).paginate(page=page, per_page=per_page)
+		
+		return jsonify({
+			'success': True,
+			'data': [job.to_dict() for job in paginated_jobs.items],
+			'pagination': {
+				'total': paginated_jobs.total,
+				'pages': paginated_jobs.pages,
+				'current_page': page,
+				'per_page': per_page
+			}
+		})
+
+
+class JobDetail(Resource):
+	@require_api_key
+	def get(self, job_id):
+		"""获取任务的状态、进度、结果和耗时"""
+		job = job_queue.get(job_id)
+		if job is None:
+			return jsonify({
+				'success': False,
+				'message': 'Job not found'
+			}), 404
+		
+		return jsonify({
+			'success': True,
+			'data': job
+		})
+
+
+# 注册API资源
+api.add_resource(JobList, '')
+api.add_resource(JobDetail, '/<string:job_id>')
@@ -3,6 +3,7 @@ from flask import Blueprint, request, jsonify
 from flask_restful import Api, Resource
 from models import db, FirewallLog, AlertConfig
 from services.log_analyzer import LogCollector, LogAnalyzer
+from services.job_queue import job_queue
 from utils.security import require_api_key
 from datetime import datetime, timedelta
 
@@ -115,20 +116,18 @@ class LogAnalysis(Resource):
 class LogCollectorResource(Resource):
 	@require_api_key
 	def post(self):
-		"""手动触发日志收集"""
-		try:
-			collector = LogCollector()
-			count = collector.collect_logs()
-			
-			return jsonify({
-				'success': True,
-				'message': f'Successfully collected {count} log entries'
-			})
-		except Exception as e:
-			return jsonify({
-				'success': False,
-				'message': f'Failed to collect logs: {str(e)}'
-			}), 500
+		"""在后台手动触发日志收集"""
+		def collect_logs(job):
+			count = LogCollector().collect_logs()
+			job.progress(message=f'Successfully collected {count} log entries')
+			return {'count': count}
+		
+		job = job_queue.submit('log_collect', collect_logs, lock='log_collect')
+		return jsonify({
+			'success': True,
+			'message': 'Log collection started',
+			'data': job.to_dict()
+		})
 
 
 class AlertConfigList(Resource):
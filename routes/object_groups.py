@@ -0,0 +1,177 @@
+# routes/object_groups.py
+from flask import Blueprint, request, jsonify
+from flask_restful import Api, Resource
+from sqlalchemy import func
+from models import db, ObjectGroup, ObjectGroupMember
+from services.firewall_manager import FirewallManager
+from services.job_queue import job_queue, RULESET_LOCK
+from services.object_group import ObjectGroupService
+from utils.security import require_api_key
+
+object_groups_bp = Blueprint('object_groups', __name__)
+api = Api(object_groups_bp)
+
+
+def member_list(data):
+	"""请求中的成员列表：列表，或以逗号/空白分隔的字符串"""
+	members = data.get('members', [])
+	if isinstance(members, str):
+		members = members.replace(',', ' ').split()
+	if not isinstance(members, list):
+		raise ValueError('members must be a list')
+	return members
+
+
+class ObjectGroupList(Resource):
+	@require_api_key
+	def get(self):
+		"""获取对象组列表（附带成员数）"""
+		counts = dict(db.session.query(ObjectGroupMember.group_id, func.count(ObjectGroupMember.id)).group_by(
+			ObjectGroupMember.group_id).all())
+		groups = ObjectGroup.query.order_by(ObjectGroup.name).all()
+		return jsonify({
+			'success': True,
+			'data': [dict(group.to_dict(), member_count=counts.get(group.id, 0)) for group in groups]
+		})
+	
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def post(self):
+		"""创建对象组"""
+		data = request.get_json() or {}
+		try:
+			service = ObjectGroupService(FirewallManager())
+			group = service.create(data.get('name'), data.get('group_type'), data.get('description'),
+			                       member_list(data))
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
+		return jsonify({
+			'success': True,
+			'message': 'Object group created successfully',
+			'data': group.to_dict(service.members(group))
+		})
+
+
+class ObjectGroupDetail(Resource):
+	@require_api_key
+	def get(self, group_id):
+		"""获取对象组及其成员"""
+		group = ObjectGroup.query.get_or_404(group_id)
+		service = ObjectGroupService(FirewallManager())
+		return jsonify({
+			'success': True,
+			'data': group.to_dict(service.members(group))
+		})
+	
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def put(self, group_id):
+		"""更新对象组描述；提供members时以其替换成员，只增删有差异的元素"""
+		group = ObjectGroup.query.get_or_404(group_id)
+		data = request.get_json() or {}
+		service = ObjectGroupService(FirewallManager())
+		
+		if 'description' in data:
+			group.description = data['description']
+		try:
+			if 'members' in data:
+				added, removed = service.replace_members(group, member_list(data))
+			else:
+				added, removed = [], []
+			db.session.commit()
+		except ValueError as e:
+			db.session.rollback()
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to update object group: {str(e)}'
+			}), 500
+		
+		return jsonify({
+			'success': True,
+			'message': 'Object group updated successfully',
+			'data': dict(group.to_dict(), added=added, removed=removed)
+		})
+	
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def delete(self, group_id):
+		"""删除未被规则引用的对象组"""
+		group = ObjectGroup.query.get_or_404(group_id)
+		try:
+			ObjectGroupService(FirewallManager()).delete(group)
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
+		return jsonify({
+			'success': True,
+			'message': 'Object group deleted successfully'
+		})
+
+
+class ObjectGroupMembers(Resource):
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def post(self, group_id):
+		"""添加成员：每个已加载该组的后端一次元素添加，引用它的规则不变"""
+		group = ObjectGroup.query.get_or_404(group_id)
+		try:
+			added = ObjectGroupService(FirewallManager()).add_members(group, member_list(request.get_json() or {}))
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to add members: {str(e)}'
+			}), 500
+		
+		return jsonify({
+			'success': True,
+			'message': f'{len(added)} members added',
+			'data': {'added': added}
+		})
+	
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def delete(self, group_id):
+		"""删除成员：每个已加载该组的后端一次元素删除"""
+		group = ObjectGroup.query.get_or_404(group_id)
+		try:
+			removed = ObjectGroupService(FirewallManager()).remove_members(group,
+			                                                               member_list(request.get_json() or {}))
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to remove members: {str(e)}'
+			}), 500
+		
+		return jsonify({
+			'success': True,
+			'message': f'{len(removed)} members removed',
+			'data': {'removed': removed}
+		})
+
+
+# 注册API资源
+api.add_resource(ObjectGroupList, '')
+api.add_resource(ObjectGroupDetail, '/<int:group_id>')
+api.add_resource(ObjectGroupMembers, '/<int:group_id>/members')
@@ -1,26 +1,99 @@
 # routes/rules.py
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, stream_with_context
 from flask_restful import Api, Resource
-from models import db, FirewallRule, RuleTemplate
+from models import db, FirewallRule, RuleTemplate, RuleCounterSample, RuleTombstone
+from models.rule import current_generation, bump_generation
 from services.firewall_manager import FirewallManager
+from services.rule_reconciler import RuleReconciler
+from services.chain_sharder import shard_report
+from services.rule_analyzer import RuleAnalyzer
+from services.rule_optimizer import RuleOptimizer
+from services.rule_simulator import RuleSimulator
+from services.rule_batch import RuleBatch, parse_expiry
+from services.object_group import validate_object_group_refs
+from services.rule_exporter import RuleExporter, EXPORT_FORMATS
+from services.rule_importer import RuleImporter
+from services.rule_template import TemplateExpander, parse_parameters, parse_rule_json
+from services.job_queue import job_queue, RULESET_LOCK
 from utils.security import require_api_key
+import hashlib
 import json
+import time
+from datetime import datetime, timedelta
+import os
+import tempfile
+from urllib.parse import urlencode
 
 rules_bp = Blueprint('rules', __name__)
 api = Api(rules_bp)
 
+# 可通过API修改的规则字段
+RULE_FIELDS = ['rule_type', 'chain', 'protocol', 'source',
+               'destination', 'port', 'action', 'comment',
+               'priority', 'enabled']
+
+
+def representation_etag(generation):
+	"""规则集代数加查询参数摘要的ETag：同一代数下不同格式、类型或增量起点的表示各不相同"""
+	args = urlencode(sorted(request.args.items(multi=True)))
+	return f'{generation}-{hashlib.sha1(args.encode()).hexdigest()[:12]}'
+
+
+def not_modified(etag):
+	"""请求的If-None-Match与当前表示的ETag一致时返回304响应，否则返回None"""
+	if etag in request.if_none_match:
+		response = current_app.response_class(status=304)
+		response.set_etag(etag)
+		return response
+	return None
+
+
+def template_fields(rule_json, parameters):
+	"""校验模板规则和参数定义，返回存储用的JSON文本"""
+	try:
+		rules = parse_rule_json(rule_json)
+		parameters = parse_parameters(parameters)
+	except json.JSONDecodeError as e:
+		raise ValueError(f'Invalid template JSON: {e}')
+	return json.dumps(rules), json.dumps(parameters)
+
 
 class RuleList(Resource):
 	@require_api_key
 	def get(self):
-		"""获取所有防火墙规则"""
-		rules = FirewallRule.query.order_by(FirewallRule.priority).all()
-		return jsonify({
-			'success': True,
-			'data': [rule.to_dict() for rule in rules]
-		})
+		"""获取所有防火墙规则；支持If-None-Match条件请求和 ?since_generation= 增量"""
+		# 先读取代数再读取规则，代数不会比返回的数据新
+		generation = current_generation()
+		etag = representation_etag(generation)
+		cached = not_modified(etag)
+		if cached is not None:
+			return cached
+		
+		since_generation = request.args.get('since_generation', type=int)
+		if since_generation is not None:
+			rules = FirewallRule.query.filter(FirewallRule.generation > since_generation).order_by(
+				FirewallRule.priority).all()
+			deleted = RuleTombstone.query.filter(RuleTombstone.generation > since_generation).all()
+			response = jsonify({
+				'success': True,
+				'generation': generation,
+				'data': [rule.to_dict() for rule in rules],
+				# 被删除后id又被复用的规则以当前数据为准
+				'deleted': sorted({tombstone.rule_id for tombstone in deleted} - {rule.id for rule in rules})
+			})
+		else:
+			rules = FirewallRule.query.order_by(FirewallRule.priority).all()
+			response = jsonify({
+				'success': True,
+				'generation': generation,
+				'data': [rule.to_dict() for rule in rules]
+			})
+		
+		response.set_etag(etag)
+		return response
 	
 	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
 	def post(self):
 		"""创建新规则"""
 		data = request.get_json()
@@ -34,6 +107,22 @@ class RuleList(Resource):
 					'message': f'Missing required field: {field}'
 				}), 400
 		
+		try:
+			expires_at = parse_expiry(data)
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
+		# 对象组引用须指向已存在且类型匹配的对象组
+		error = validate_object_group_refs(data)
+		if error:
+			return jsonify({
+				'success': False,
+				'message': error
+			}), 400
+		
 		# 创建规则对象
 		rule = FirewallRule(
 			rule_type=data.get('rule_type'),
@@ -45,7 +134,8 @@ class RuleList(Resource):
 			action=data.get('action'),
 			comment=data.get('comment', ''),
 			priority=data.get('priority', 100),
-			enabled=data.get('enabled', True)
+			enabled=data.get('enabled', True),
+			expires_at=expires_at
 		)
 		
 		# 保存到数据库
@@ -60,6 +150,9 @@ class RuleList(Resource):
 			else:
 				firewall_manager.apply_nftables_rule(rule)
 			
+			# 保存应用时记录的内核句柄/位置
+			db.session.commit()
+			
 			return jsonify({
 				'success': True,
 				'message': 'Rule created successfully',
@@ -87,29 +180,64 @@ class RuleDetail(Resource):
 		})
 	
 	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
 	def put(self, rule_id):
 		"""更新规则"""
 		rule = FirewallRule.query.get_or_404(rule_id)
 		data = request.get_json()
 		
+		# 保留更新前的规则副本，用于从内核中移除旧规则
+		previous_rule = FirewallRule(**{field: getattr(rule, field)
+		                                for field in RULE_FIELDS + ['id', 'kernel_handle', 'kernel_position', 'kernel_set',
+		                                                            'expires_at']})
+		
+		# 提供了ttl或expires_at时更新过期时间（均为空表示改为永久规则）
+		if 'ttl' in data or 'expires_at' in data:
+			try:
+				expires_at = parse_expiry(data)
+			except ValueError as e:
+				return jsonify({
+					'success': False,
+					'message': str(e)
+				}), 400
+			rule.expires_at = expires_at
+		
+		error = validate_object_group_refs(data)
+		if error:
+			return jsonify({
+				'success': False,
+				'message': error
+			}), 400
+		
 		# 更新规则字段
-		for field in ['rule_type', 'chain', 'protocol', 'source',
-		              'destination', 'port', 'action', 'comment',
-		              'priority', 'enabled']:
+		for field in RULE_FIELDS:
 			if field in data:
 				setattr(rule, field, data[field])
 		
 		# 保存更新
 		db.session.commit()
 		
-		# 应用更新后的规则
+		# 先移除旧规则再应用更新后的规则，避免内核中残留旧版本
 		try:
 			firewall_manager = FirewallManager()
+			if previous_rule.enabled:
+				if previous_rule.rule_type == 'iptables':
+					firewall_manager.remove_iptables_rule(previous_rule)
+				else:
+					firewall_manager.remove_nftables_rule(previous_rule)
+			
+			# 旧规则已移除，其句柄/位置不再有效
+			rule.kernel_handle = None
+			rule.kernel_position = None
+			rule.kernel_set = None
+			
 			if rule.rule_type == 'iptables':
 				firewall_manager.apply_iptables_rule(rule)
 			else:
 				firewall_manager.apply_nftables_rule(rule)
 			
+			db.session.commit()
+			
 			return jsonify({
 				'success': True,
 				'message': 'Rule updated successfully',
@@ -122,6 +250,7 @@ class RuleDetail(Resource):
 			}), 500
 	
 	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
 	def delete(self, rule_id):
 		"""删除规则"""
 		rule = FirewallRule.query.get_or_404(rule_id)
@@ -135,6 +264,7 @@ class RuleDetail(Resource):
 				firewall_manager.remove_nftables_rule(rule)
 			
 			# 从数据库删除
+			RuleCounterSample.query.filter_by(rule_id=rule.id).delete()
 			db.session.delete(rule)
 			db.session.commit()
 			
@@ -149,10 +279,44 @@ class RuleDetail(Resource):
 			}), 500
 
 
+class RuleBatchOperations(Resource):
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def post(self):
+		"""批量创建/更新/删除规则：先校验全部操作，再以一次内核事务和一次数据库提交应用"""
+		data = request.get_json() or {}
+		operations = data.get('operations')
+		if not isinstance(operations, list) or not operations:
+			return jsonify({
+				'success': False,
+				'message': 'operations must be a non-empty list'
+			}), 400
+		
+		try:
+			result = RuleBatch().apply(operations)
+			if not result['applied']:
+				return jsonify({
+					'success': False,
+					'message': 'Batch validation failed, no changes applied',
+					'data': result['results']
+				}), 400
+			
+			return jsonify({
+				'success': True,
+				'message': f'Successfully applied {len(operations)} operations',
+				'data': result['results']
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to apply batch: {str(e)}'
+			}), 500
+
+
 class RuleImport(Resource):
 	@require_api_key
 	def post(self):
-		"""导入规则"""
+		"""流式导入规则文件（JSON数组、NDJSON或CSV）；?strict=true 时有无效行即不导入"""
 		if 'file' not in request.files:
 			return jsonify({
 				'success': False,
@@ -166,33 +330,73 @@ class RuleImport(Resource):
 				'message': 'No selected file'
 			}), 400
 		
+		fmt = request.args.get('format')
+		strict = request.args.get('strict', 'false').lower() == 'true'
+		
+		# 上传内容先落盘，请求结束后由后台任务流式导入
+		fd, path = tempfile.mkstemp(prefix='rule-import-', suffix=os.path.splitext(file.filename)[1])
 		try:
-			# 读取文件内容
-			content = file.read().decode('utf-8')
-			rules_data = json.loads(content)
-			
-			# 导入规则
-			firewall_manager = FirewallManager()
-			imported_rules = firewall_manager.import_rules_from_data(rules_data)
-			
-			return jsonify({
-				'success': True,
-				'message': f'Successfully imported {len(imported_rules)} rules',
-				'data': [rule.to_dict() for rule in imported_rules]
-			})
+			with os.fdopen(fd, 'wb') as f:
+				file.save(f)
 		except Exception as e:
+			os.remove(path)
 			return jsonify({
 				'success': False,
 				'message': f'Failed to import rules: {str(e)}'
 			}), 500
+		
+		filename = file.filename
+		
+		def import_rules(job):
+			try:
+				size = os.path.getsize(path) or 1
+				with open(path, 'rb') as f:
+					progress = lambda imported: job.progress(f.tell() * 100 / size, f'{imported} rules imported')
+					result = RuleImporter(strict=strict, progress=progress).import_stream(f, filename, fmt)
+			finally:
+				os.remove(path)
+			
+			if result['applied']:
+				job.progress(message=f"Successfully imported {result['imported']} rules, {result['invalid']} invalid")
+			else:
+				job.progress(message=f"{result['invalid']} invalid rules, nothing imported")
+			return result
+		
+		job = job_queue.submit('rule_import', import_rules, lock=RULESET_LOCK)
+		return jsonify({
+			'success': True,
+			'message': 'Rule import started',
+			'data': job.to_dict()
+		})
 
 
 class RuleExport(Resource):
 	@require_api_key
 	def get(self):
-		"""导出规则"""
+		"""导出规则；支持If-None-Match条件请求，?format= 指定 json/ndjson/csv/iptables/nftables 时流式导出"""
 		rule_type = request.args.get('type', 'all')
 		
+		generation = current_generation()
+		etag = representation_etag(generation)
+		cached = not_modified(etag)
+		if cached is not None:
+			return cached
+		
+		fmt = request.args.get('format')
+		if fmt:
+			if fmt not in EXPORT_FORMATS:
+				return jsonify({
+					'success': False,
+					'message': f'Unsupported export format: {fmt}'
+				}), 400
+			
+			mimetype, extension = EXPORT_FORMATS[fmt]
+			exporter = RuleExporter(rule_type)
+			response = current_app.response_class(stream_with_context(exporter.stream(fmt)), mimetype=mimetype)
+			response.headers['Content-Disposition'] = f'attachment; filename=firewall_rules.{extension}'
+			response.set_etag(etag)
+			return response
+		
 		# 根据类型筛选规则
 		if rule_type != 'all':
 			rules = FirewallRule.query.filter_by(rule_type=rule_type).all()
@@ -202,29 +406,239 @@ class RuleExport(Resource):
 		# 导出为JSON
 		rules_data = [rule.to_dict() for rule in rules]
 		
-		return jsonify({
+		response = jsonify({
 			'success': True,
+			'generation': generation,
 			'data': rules_data
 		})
+		response.set_etag(etag)
+		return response
 
 
 class RuleSync(Resource):
 	@require_api_key
 	def post(self):
-		"""同步服务器现有规则"""
+		"""在后台同步服务器现有规则"""
+		def sync_rules(job):
+			summary = FirewallManager().sync_from_server()
+			job.progress(message=f"Successfully synced rules: {summary['added']} added, {summary['updated']} updated, "
+			                     f"{summary['unchanged']} unchanged, {summary['orphaned']} orphaned")
+			return summary
+		
+		job = job_queue.submit('rule_sync', sync_rules, lock=RULESET_LOCK)
+		return jsonify({
+			'success': True,
+			'message': 'Rule sync started',
+			'data': job.to_dict()
+		})
+
+
+class RuleStats(Resource):
+	@require_api_key
+	def get(self, rule_id):
+		"""获取规则在时间窗口内的命中速率和计数器时间序列"""
+		rule = FirewallRule.query.get_or_404(rule_id)
+		window = request.args.get('window', 3600, type=int)
+		since = datetime.utcnow() - timedelta(seconds=window)
+		
+		samples = RuleCounterSample.query.filter(
+			RuleCounterSample.rule_id == rule.id,
+			RuleCounterSample.timestamp >= since
+		).order_by(RuleCounterSample.timestamp).all()
+		
+		packets = sum(sample.packets for sample in samples)
+		size = sum(sample.bytes for sample in samples)
+		last_hit = RuleCounterSample.query.filter_by(rule_id=rule.id).order_by(
+			RuleCounterSample.timestamp.desc()).first()
+		
+		return jsonify({
+			'success': True,
+			'data': {
+				'rule_id': rule.id,
+				'window': window,
+				'packets': packets,
+				'bytes': size,
+				'pps': round(packets / window, 3) if window else None,
+				'bps': round(size / window, 3) if window else None,
+				'last_hit': last_hit.timestamp.isoformat() if last_hit else None,
+				'samples': [sample.to_dict() for sample in samples]
+			}
+		})
+
+
+class RuleReconcile(Resource):
+	@require_api_key
+	def get(self):
+		"""预览协调计划（不修改内核）"""
+		rule_type = request.args.get('type', 'all')
+		
 		try:
-			firewall_manager = FirewallManager()
-			synced_rules = firewall_manager.sync_from_server()
+			reconciler = RuleReconciler()
+			result = reconciler.reconcile(rule_type, dry_run=True)
 			
 			return jsonify({
 				'success': True,
-				'message': f'Successfully synced {len(synced_rules)} rules',
-				'data': [rule.to_dict() for rule in synced_rules]
+				'data': result
 			})
 		except Exception as e:
 			return jsonify({
 				'success': False,
-				'message': f'Failed to sync rules: {str(e)}'
+				'message': f'Failed to plan reconciliation: {str(e)}'
+			}), 500
+	
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def post(self):
+		"""按数据库中的期望状态协调内核规则"""
+		data = request.get_json() or {}
+		rule_type = data.get('rule_type', 'all')
+		dry_run = data.get('dry_run', False)
+		
+		try:
+			reconciler = RuleReconciler()
+			result = reconciler.reconcile(rule_type, dry_run=dry_run)
+			
+			return jsonify({
+				'success': True,
+				'message': 'Reconciliation planned' if dry_run else 'Rules reconciled successfully',
+				'data': result
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to reconcile rules: {str(e)}'
+			}), 500
+
+
+class RuleAnalysis(Resource):
+	@require_api_key
+	def get(self):
+		"""分析被遮蔽、冗余和相互冲突的规则"""
+		rule_type = request.args.get('type', 'all')
+		chain = request.args.get('chain')
+		
+		try:
+			analyzer = RuleAnalyzer()
+			result = analyzer.analyze(rule_type, chain)
+			
+			return jsonify({
+				'success': True,
+				'data': result
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to analyze rules: {str(e)}'
+			}), 500
+
+
+class RuleShards(Resource):
+	@require_api_key
+	def get(self):
+		"""受管链的分片树，以及分片前后每包依次经过的规则数估算"""
+		rule_type = request.args.get('type', 'nftables')
+		if rule_type not in ('iptables', 'nftables'):
+			return jsonify({
+				'success': False,
+				'message': f'Invalid rule type: {rule_type}'
+			}), 400
+		
+		try:
+			return jsonify({
+				'success': True,
+				'data': shard_report(RuleReconciler(), rule_type)
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to build shard report: {str(e)}'
+			}), 500
+
+
+class RuleSimulate(Resource):
+	@require_api_key
+	def post(self):
+		"""在进程内模拟数据包经过规则链的判定结果，不访问内核"""
+		data = request.get_json() or {}
+		packets = data.get('packets')
+		if packets is None:
+			packets = [data.get('packet') or {}]
+		if not isinstance(packets, list):
+			return jsonify({
+				'success': False,
+				'message': 'packets must be a list'
+			}), 400
+		
+		try:
+			simulator = RuleSimulator(data.get('rule_type', 'iptables')).compile()
+			
+			started = time.perf_counter()
+			results = simulator.simulate_batch(packets, data.get('chain', 'INPUT'))
+			elapsed = time.perf_counter() - started
+			
+			return jsonify({
+				'success': True,
+				'data': {
+					'results': results,
+					'skipped': simulator.skipped,
+					'elapsed_us': round(elapsed * 1e6 / max(len(packets), 1), 2)
+				}
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to simulate packets: {str(e)}'
+			}), 500
+
+
+class RuleReorder(Resource):
+	@require_api_key
+	def get(self):
+		"""根据命中计数预览规则重排方案及每条链的平均匹配次数"""
+		rule_type = request.args.get('type', 'all')
+		chain = request.args.get('chain')
+		
+		try:
+			optimizer = RuleOptimizer()
+			result = optimizer.propose(rule_type, chain)
+			
+			return jsonify({
+				'success': True,
+				'data': result
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to propose rule order: {str(e)}'
+			}), 500
+	
+	@require_api_key
+	@job_queue.exclusive(RULESET_LOCK)
+	def post(self):
+		"""生成重排方案，apply为True时重新分配优先级并应用"""
+		data = request.get_json() or {}
+		rule_type = data.get('rule_type', 'all')
+		chain = data.get('chain')
+		
+		try:
+			optimizer = RuleOptimizer()
+			if data.get('apply', False):
+				result = optimizer.apply(rule_type, chain)
+				message = 'Rules reordered successfully'
+			else:
+				result = optimizer.propose(rule_type, chain)
+				message = 'Rule order proposed'
+			
+			return jsonify({
+				'success': True,
+				'message': message,
+				'data': result
+			})
+		except Exception as e:
+			db.session.rollback()
+			return jsonify({
+				'success': False,
+				'message': f'Failed to reorder rules: {str(e)}'
 			}), 500
 
 
@@ -257,11 +671,20 @@ class RuleTemplateList(Resource):
 				'message': 'Template name already exists'
 			}), 400
 		
+		try:
+			rule_json, parameters = template_fields(data['rule_json'], data.get('parameters', []))
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
 		# 创建模板
 		template = RuleTemplate(
 			name=data['name'],
 			description=data.get('description', ''),
-			rule_json=data['rule_json']
+			rule_json=rule_json,
+			parameters=parameters
 		)
 		
 		db.session.add(template)
@@ -290,13 +713,22 @@ class RuleTemplateDetail(Resource):
 		template = RuleTemplate.query.get_or_404(template_id)
 		data = request.get_json()
 		
+		try:
+			rule_json, parameters = template_fields(data.get('rule_json', template.rule_json),
+			                                        data.get('parameters', template.parameters or []))
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
 		# 更新字段
 		if 'name' in data:
 			template.name = data['name']
 		if 'description' in data:
 			template.description = data['description']
-		if 'rule_json' in data:
-			template.rule_json = data['rule_json']
+		template.rule_json = rule_json
+		template.parameters = parameters
 		
 		db.session.commit()
 		
@@ -310,6 +742,11 @@ class RuleTemplateDetail(Resource):
 	def delete(self, template_id):
 		"""删除模板"""
 		template = RuleTemplate.query.get_or_404(template_id)
+		# 已生成的规则保留，只解除与模板的关联；批量更新不触发flush事件，显式记录规则集代数
+		rules = FirewallRule.query.filter_by(template_id=template.id)
+		if rules.first() is not None:
+			generation = bump_generation(db.session)
+			rules.update({'template_id': None, 'generation': generation}, synchronize_session=False)
 		db.session.delete(template)
 		db.session.commit()
 		
@@ -319,11 +756,74 @@ class RuleTemplateDetail(Resource):
 		})
 
 
+class RuleTemplatePreview(Resource):
+	@require_api_key
+	def post(self, template_id):
+		"""按参数取值展开模板，返回规则数、前100条规则和编译后的内核规则数/集合"""
+		template = RuleTemplate.query.get_or_404(template_id)
+		data = request.get_json() or {}
+		
+		try:
+			result = TemplateExpander().preview(template, data.get('values'))
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
+		return jsonify({
+			'success': True,
+			'data': result
+		})
+
+
+class RuleTemplateApply(Resource):
+	@require_api_key
+	def post(self, template_id):
+		"""在后台展开并批量应用模板；replace为true时替换此前由该模板生成的规则"""
+		template = RuleTemplate.query.get_or_404(template_id)
+		data = request.get_json() or {}
+		values = data.get('values')
+		replace = bool(data.get('replace', False))
+		
+		# 先在请求中展开校验，结果进入缓存，任务中直接复用
+		try:
+			count = len(TemplateExpander().expand(template, values)['rules'])
+		except ValueError as e:
+			return jsonify({
+				'success': False,
+				'message': str(e)
+			}), 400
+		
+		def apply_template(job):
+			job.progress(message=f'Applying {count} rules')
+			result = TemplateExpander().apply(RuleTemplate.query.get(template_id), values, replace)
+			job.progress(message=f"Successfully applied template: {result['created']} rules created, "
+			                     f"{result['replaced']} replaced")
+			return result
+		
+		job = job_queue.submit('template_apply', apply_template, lock=RULESET_LOCK)
+		return jsonify({
+			'success': True,
+			'message': 'Template apply started',
+			'data': job.to_dict()
+		})
+
+
 # 注册API资源
 api.add_resource(RuleList, '')
 api.add_resource(RuleDetail, '/<int:rule_id>')
+api.add_resource(RuleStats, '/<int:rule_id>/stats')
+api.add_resource(RuleBatchOperations, '/batch')
 api.add_resource(RuleImport, '/import')
 api.add_resource(RuleExport, '/export')
 api.add_resource(RuleSync, '/sync')
+api.add_resource(RuleReconcile, '/reconcile')
+api.add_resource(RuleAnalysis, '/analysis')
+api.add_resource(RuleReorder, '/reorder')
+api.add_resource(RuleSimulate, '/simulate')
+api.add_resource(RuleShards, '/shards')
 api.add_resource(RuleTemplateList, '/templates')
 api.add_resource(RuleTemplateDetail, '/templates/<int:template_id>')
+api.add_resource(RuleTemplatePreview, '/templates/<int:template_id>/preview')
+api.add_resource(RuleTemplateApply, '/templates/<int:template_id>/apply')
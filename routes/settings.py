@@ -3,6 +3,7 @@ from flask import Blueprint, request, jsonify, current_app
 from flask_restful import Api, Resource
 from models import db, SystemSetting, SystemBackup
 from services.system_manager import SystemManager
+from services.job_queue import job_queue, RULESET_LOCK
 from utils.security import require_api_key
 import os
 
@@ -85,23 +86,20 @@ class BackupDetail(Resource):
 	
 	@require_api_key
 	def post(self, backup_id):
-		"""从备份恢复系统"""
-		backup = SystemBackup.query.get_or_404(backup_id)
+		"""在后台从备份恢复系统"""
+		SystemBackup.query.get_or_404(backup_id)
 		
-		try:
-			system_manager = SystemManager()
-			result = system_manager.restore_system(backup_id)
-			
-			return jsonify({
-				'success': True,
-				'message': 'System restored successfully',
-				'data': result
-			})
-		except Exception as e:
-			return jsonify({
-				'success': False,
-				'message': f'Failed to restore system: {str(e)}'
-			}), 500
+		def restore_system(job):
+			result = SystemManager().restore_system(backup_id)
+			job.progress(message='System restored successfully')
+			return result
+		
+		job = job_queue.submit('system_restore', restore_system, lock=RULESET_LOCK)
+		return jsonify({
+			'success': True,
+			'message': 'System restore started',
+			'data': job.to_dict()
+		})
 	
 	@require_api_key
 	def delete(self, backup_id):
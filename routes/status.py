@@ -3,6 +3,7 @@ from flask import Blueprint, request, jsonify
 from flask_restful import Api, Resource
 from models import db, FirewallStatus, ConnectionStat
 from services.status_monitor import FirewallMonitor
+from services.rule_verifier import RuleVerifier
 from utils.security import require_api_key
 from datetime import datetime, timedelta
 
@@ -100,6 +101,31 @@ class RuleVerification(Resource):
 			}), 500
 
 
+class RulesetVerification(Resource):
+	@require_api_key
+	def post(self):
+		"""基于每个后端一次内核快照批量验证所有受管规则，返回缺失、多余和漂移的规则"""
+		rule_type = request.args.get('type', 'all')
+		if rule_type not in ('all', 'iptables', 'nftables'):
+			return jsonify({
+				'success': False,
+				'message': f'Invalid rule type: {rule_type}'
+			}), 400
+		
+		try:
+			report = RuleVerifier().verify(rule_type)
+			
+			return jsonify({
+				'success': True,
+				'data': report
+			})
+		except Exception as e:
+			return jsonify({
+				'success': False,
+				'message': f'Failed to verify rules: {str(e)}'
+			}), 500
+
+
 class FirewallControl(Resource):
 	@require_api_key
 	def post(self):
@@ -146,5 +172,6 @@ class FirewallControl(Resource):
 # 注册API资源
 api.add_resource(StatusCheck, '')
 api.add_resource(ConnectionStats, '/connections')
+api.add_resource(RulesetVerification, '/verify')
 api.add_resource(RuleVerification, '/verify/<int:rule_id>')
 api.add_resource(FirewallControl, '/control')
@@ -0,0 +1,107 @@
+# scripts/benchmark_ruleset_parser.py
+"""规则集解析基准：生成大量规则的 iptables-save 和 nft -j 输出，计时流式解析
+
+不需要真实的防火墙：生成的输出写入临时文件，通过 cat 经管道交给与 RulesetReader 相同的
+command_output 和解析器，两个后端也按 RulesetReader 的方式并发读取一次。
+
+用法（在项目根目录）：python scripts/benchmark_ruleset_parser.py [--rules 50000]
+"""
+import argparse
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.ruleset_parser import IptablesSaveParser, NftRulesetParser, command_output, iter_nft_json
+
+
+def _address(index):
+	return f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'
+
+
+def iptables_save_output(count):
+	lines = ['# Generated by benchmark', '*filter', ':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]',
+	         ':OUTPUT ACCEPT [0:0]', ':FWM_INPUT - [0:0]']
+	for index in range(count):
+		action = 'ACCEPT' if index % 3 else 'DROP'
+		lines.append(f'-A FWM_INPUT -s {_address(index)}/32 -p tcp -m tcp --dport {1024 + index % 60000} '
+		             f'-m comment --comment "rule {index}" -j {action}')
+	lines.append('COMMIT')
+	return '\n'.join(lines) + '\n'
+
+
+def nft_json_output(count):
+	items = [{'metainfo': {'json_schema_version': 1}},
+	         {'table': {'family': 'ip', 'name': 'filter', 'handle': 1}},
+	         {'chain': {'family': 'ip', 'table': 'filter', 'name': 'FWM_INPUT', 'handle': 2}}]
+	for index in range(count):
+		items.append({'rule': {
+			'family': 'ip',
+			'table': 'filter',
+			'chain': 'FWM_INPUT',
+			'handle': index + 3,
+			'expr': [
+				{'match': {'op': '==', 'left': {'payload': {'protocol': 'ip', 'field': 'saddr'}}, 'right': _address(index)}},
+				{'match': {'op': '==', 'left': {'payload': {'protocol': 'tcp', 'field': 'dport'}}, 'right': 1024 + index % 60000}},
+				{'counter': {'packets': index, 'bytes': index * 60}},
+				{'accept': None} if index % 3 else {'drop': None}
+			]
+		}})
+	return json.dumps({'nftables': items})
+
+
+def read_iptables(path):
+	with command_output(['cat', path]) as stdout:
+		return len(list(IptablesSaveParser().parse(stdout)))
+
+
+def read_nftables(path):
+	with command_output(['cat', path]) as stdout:
+		return len(list(NftRulesetParser().parse(iter_nft_json(stdout))))
+
+
+def read_shlex_baseline(path):
+	"""对照：逐行 shlex 分词（解析器改为流式之前的做法）"""
+	with open(path) as f:
+		return sum(1 for line in f if line.startswith('-A ') and shlex.split(line))
+
+
+def timed(label, func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	print(f'{label:<28} {time.perf_counter() - start:7.2f}s  ({result} rules)')
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rules', type=int, default=50000, help='每个后端生成的规则数')
+	args = parser.parse_args()
+	
+	with tempfile.TemporaryDirectory() as directory:
+		iptables_path = os.path.join(directory, 'iptables.rules')
+		nftables_path = os.path.join(directory, 'nftables.json')
+		with open(iptables_path, 'w') as f:
+			f.write(iptables_save_output(args.rules))
+		with open(nftables_path, 'w') as f:
+			f.write(nft_json_output(args.rules))
+		
+		timed('iptables-save (shlex)', read_shlex_baseline, iptables_path)
+		timed('iptables-save', read_iptables, iptables_path)
+		timed('nft -j list ruleset', read_nftables, nftables_path)
+		
+		def read_both():
+			with ThreadPoolExecutor(max_workers=2) as executor:
+				futures = [executor.submit(read_iptables, iptables_path), executor.submit(read_nftables, nftables_path)]
+				return sum(future.result() for future in futures)
+		
+		timed('both, concurrently', read_both)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,268 @@
+# services/chain_sharder.py
+import re
+from collections import Counter, OrderedDict
+from flask import current_app
+from models import db, FirewallLog
+from models.rule import managed_chain_name, rule_signature, NFT_COUNTER, _nft_match, _nft_port
+from services.rule_compiler import CompiledGroup, unit_rules, _port_interval
+
+# 分片子链名称中的分隔符：基础链名称只允许字母、数字和下划线，子链不会与之冲突
+SHARD_SEPARATOR = '.'
+
+# iptables链名称的最大长度
+CHAIN_NAME_MAXLEN = 28
+
+# 按目的端口分桶的协议
+SHARD_PORT_PROTOCOLS = ('tcp', 'udp')
+
+# 估算每包深度时使用的最近日志条数
+SHARD_TRAFFIC_SAMPLE = 10000
+
+# 日志中的目的端口
+LOG_DPT = re.compile(r'DPT=(\d+)')
+
+
+def shard_chain(chain):
+	"""是否为分片子链（期望状态中的伪基础链，例如 INPUT.tcp）"""
+	return SHARD_SEPARATOR in chain
+
+
+def base_chain(chain):
+	"""分片子链所属的基础链（例如 INPUT.tcp.0 -> INPUT），其他链原样返回"""
+	return chain.split(SHARD_SEPARATOR, 1)[0]
+
+
+def sharding_chains():
+	"""配置为分片编译的基础链"""
+	value = current_app.config.get('RULE_SHARD_CHAINS') or ''
+	return {chain.strip() for chain in value.split(',') if chain.strip()}
+
+
+def _rule_port_interval(protocol, signature):
+	"""规则在该协议下匹配的目的端口区间；匹配任意端口（包括对象组）时返回None"""
+	if signature[0] != protocol or signature[3] == 'any' or signature[3].startswith('@'):
+		return None
+	return _port_interval(signature[3])
+
+
+class ShardJump:
+	"""分片分发规则：按协议（及目的端口区间）goto到子链，不对应数据库规则
+	
+	goto不返回分发链，子链末尾即该包在受管规则中的终点，其中的RETURN与未分片时一样回到基础链。
+	"""
+	
+	id = None
+	rules = ()
+	
+	def __init__(self, chain, protocol, port, target):
+		self.chain = chain
+		self.protocol = protocol
+		self.port = port
+		self.target = target
+		self.kernel_handle = None
+		self.kernel_position = None
+		self.kernel_set = None
+	
+	@property
+	def kernel_chain(self):
+		return managed_chain_name(self.chain)
+	
+	@property
+	def kernel_target(self):
+		return managed_chain_name(self.target)
+	
+	def matches(self, protocol, port):
+		"""(协议, 目的端口) 的包是否被分发到子链；端口未知时只匹配任意端口的分发"""
+		if protocol != self.protocol:
+			return False
+		if self.port == 'any':
+			return True
+		start, end = _port_interval(self.port)
+		return port is not None and start <= port <= end
+	
+	def signature(self):
+		return rule_signature(self.protocol, 'any', 'any', self.port, self.kernel_target)
+	
+	def iptables_rule_spec(self):
+		spec = ['-p', self.protocol]
+		if self.port != 'any':
+			spec.extend(['--dport', self.port.replace('-', ':')])
+		spec.extend(['-g', self.kernel_target])
+		return spec
+	
+	def to_nftables_json(self, verb='add', position=None):
+		expr = [_nft_match('ip', 'protocol', self.protocol)]
+		if self.port != 'any':
+			expr.append(_nft_match(self.protocol, 'dport', _nft_port(self.port)))
+		expr.extend([NFT_COUNTER, {'goto': {'target': self.kernel_target}}])
+		rule = {
+			'family': 'ip',
+			'table': 'filter',
+			'chain': self.kernel_chain,
+			'expr': expr
+		}
+		if position is not None:
+			rule['handle'] = position
+		return {verb: {'rule': rule}}
+
+
+class ChainSharder:
+	"""把配置的基础链按协议、再按目的端口桶拆分为goto子链，使一个包只经过可能匹配它的规则
+	
+	基础链先按协议分发：协议子链包含该协议和协议为all的规则（保持原有顺序），
+	基础链自身只保留协议为all的规则，供其他协议的包匹配。tcp/udp子链再按规则中具体端口
+	聚成的区间分桶，每个桶包含与其重叠的规则和不限端口的规则。分发规则按协议和端口排序，
+	与流量无关，规则不变时期望状态也不变。
+	"""
+	
+	def __init__(self, chains=None, min_rules=None, port_buckets=None):
+		self.chains = sharding_chains() if chains is None else set(chains)
+		self.min_rules = min_rules or current_app.config.get('RULE_SHARD_MIN_RULES', 32)
+		self.port_buckets = port_buckets or current_app.config.get('RULE_SHARD_PORT_BUCKETS', 8)
+	
+	def shard(self, chain, rules):
+		"""拆分一条基础链中按优先级排好序的规则，返回 子链 -> (分发规则, 规则) 的有序字典
+		
+		未配置分片、规则数不足或子链名称过长时只返回基础链本身。
+		"""
+		unsharded = OrderedDict([(chain, ([], rules))])
+		if chain not in self.chains or len(rules) < self.min_rules:
+			return unsharded
+		
+		signatures = {id(rule): rule.signature() for rule in rules}
+		protocols = sorted({signature[0] for signature in signatures.values()} - {'all'})
+		if not protocols:
+			return unsharded
+		
+		shards = OrderedDict()
+		jumps = [ShardJump(chain, protocol, 'any', f'{chain}{SHARD_SEPARATOR}{protocol}') for protocol in protocols]
+		shards[chain] = (jumps, [rule for rule in rules if signatures[id(rule)][0] == 'all'])
+		for jump in jumps:
+			members = [rule for rule in rules if signatures[id(rule)][0] in (jump.protocol, 'all')]
+			shards.update(self._shard_ports(jump.target, jump.protocol, members, signatures))
+		
+		if any(len(managed_chain_name(name)) > CHAIN_NAME_MAXLEN for name in shards):
+			return unsharded
+		return shards
+	
+	def _shard_ports(self, chain, protocol, rules, signatures):
+		intervals = [_rule_port_interval(protocol, signatures[id(rule)]) for rule in rules]
+		if protocol not in SHARD_PORT_PROTOCOLS or len(rules) < self.min_rules:
+			return [(chain, ([], rules))]
+		buckets = self._port_buckets(Counter(interval for interval in intervals if interval is not None))
+		if not buckets:
+			return [(chain, ([], rules))]
+		
+		shards = []
+		jumps = []
+		for index, (start, end) in enumerate(buckets):
+			port = str(start) if start == end else f'{start}-{end}'
+			jump = ShardJump(chain, protocol, port, f'{chain}{SHARD_SEPARATOR}{index}')
+			jumps.append(jump)
+			shards.append((jump.target, ([], [rule for rule, interval in zip(rules, intervals)
+			                                  if interval is None or (interval[0] <= end and start <= interval[1])])))
+		# 不在任何桶中的端口只可能匹配不限端口的规则
+		shards.insert(0, (chain, (jumps, [rule for rule, interval in zip(rules, intervals) if interval is None])))
+		return shards
+	
+	def _port_buckets(self, intervals):
+		"""把重叠的端口区间聚为互不重叠的桶，桶过多时合并相邻且规则最少的两个"""
+		clusters = []
+		for (start, end), count in sorted(intervals.items()):
+			if clusters and start <= clusters[-1][1]:
+				clusters[-1][1] = max(clusters[-1][1], end)
+				clusters[-1][2] += count
+			else:
+				clusters.append([start, end, count])
+		
+		while len(clusters) > self.port_buckets:
+			index = min(range(len(clusters) - 1), key=lambda i: clusters[i][2] + clusters[i + 1][2])
+			left, right = clusters[index], clusters[index + 1]
+			clusters[index:index + 2] = [[left[0], right[1], left[2] + right[2]]]
+		return [(start, end) for start, end, _ in clusters]
+
+
+def traffic_profile(limit=SHARD_TRAFFIC_SAMPLE):
+	"""最近日志中各 (协议, 目的端口) 的包数，用于按实际流量加权估算每包深度"""
+	profile = Counter()
+	rows = db.session.query(FirewallLog.protocol, FirewallLog.raw_log).order_by(FirewallLog.id.desc()).limit(limit)
+	for protocol, raw_log in rows:
+		match = LOG_DPT.search(raw_log or '')
+		profile[((protocol or 'all').lower(), int(match.group(1)) if match else None)] += 1
+	return profile
+
+
+def packet_depth(desired, chain, protocol, port):
+	"""(协议, 目的端口) 的包在受管规则中最多依次经过的内核规则数（没有规则命中时）"""
+	depth = 0
+	units = desired.get(chain, [])
+	index = 0
+	while index < len(units):
+		unit = units[index]
+		depth += 1
+		if isinstance(unit, ShardJump) and unit.matches(protocol, port):
+			units, index = desired.get(unit.target, []), 0
+			continue
+		index += 1
+	return depth
+
+
+def _representative_packets(desired, chains):
+	"""每条分发路径的一个代表包，以及不被任何分发规则匹配的包"""
+	packets = {(None, None)}
+	for chain in chains:
+		for unit in desired.get(chain, []):
+			if isinstance(unit, ShardJump):
+				packets.add((unit.protocol, None if unit.port == 'any' else _port_interval(unit.port)[0]))
+	return packets
+
+
+def _depth_summary(desired, chain, chains, profile):
+	packets = _representative_packets(desired, chains)
+	depths = {packet: packet_depth(desired, chain, *packet) for packet in packets}
+	if profile:
+		total = sum(profile.values())
+		average = sum(packet_depth(desired, chain, *packet) * count for packet, count in profile.items()) / total
+	else:
+		average = sum(depths.values()) / len(depths)
+	return {'average': round(average, 2), 'max': max(depths.values())}
+
+
+def _tree(desired, chain, match=None):
+	units = desired.get(chain, [])
+	return {
+		'chain': chain,
+		'managed_chain': managed_chain_name(chain),
+		'match': match,
+		'kernel_rules': len(units),
+		'rules': sum(len(unit_rules(unit)) for unit in units),
+		'sets': sum(1 for unit in units if isinstance(unit, CompiledGroup)),
+		'children': [_tree(desired, unit.target, {'protocol': unit.protocol, 'port': unit.port})
+		             for unit in units if isinstance(unit, ShardJump)]
+	}
+
+
+def shard_report(reconciler, rule_type):
+	"""各基础链的分片树，以及分片前后每个包依次经过的内核规则数估算（平均值按最近日志的流量加权）"""
+	sharded = reconciler.build_desired_state(rule_type)
+	flat = reconciler.build_desired_state(rule_type, shard=False)
+	profile = traffic_profile()
+	
+	chains = []
+	for chain in sorted(flat):
+		shard_chains = [name for name in sharded if name == chain or name.startswith(f'{chain}{SHARD_SEPARATOR}')]
+		chains.append({
+			'chain': chain,
+			'sharded': len(shard_chains) > 1,
+			'rules': sum(len(unit_rules(unit)) for unit in flat[chain]),
+			'flat_depth': _depth_summary(flat, chain, [chain], profile),
+			'depth': _depth_summary(sharded, chain, shard_chains, profile),
+			'tree': _tree(sharded, chain)
+		})
+	
+	return {
+		'rule_type': rule_type,
+		'sharding_chains': sorted(sharding_chains()),
+		'traffic_samples': sum(profile.values()),
+		'chains': chains
+	}
@@ -0,0 +1,385 @@
+# services/drift_watcher.py
+import json
+import queue
+import subprocess
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from models import db
+from models.rule import MANAGED_CHAIN_PREFIX, managed_chain_name, rule_signature, current_generation
+from services.nftables_backend import NFTABLES_FAMILY, NFTABLES_TABLE
+from services.rule_compiler import CompiledGroup, element_key, unit_rules
+from services.rule_reconciler import RuleReconciler
+from services.ruleset_cache import ruleset_cache
+from services.ruleset_parser import parse_iptables_rule, parse_nft_rule
+
+# 变化需要保持该时间（秒）才判定为漂移：数据库与内核先后提交之间的短暂不一致不报告
+DRIFT_SETTLE_SECONDS = 2
+
+# 读取快照后等待事件流安静的时间（秒），期间到达的事件可能已包含在快照中
+RESYNC_QUIET_SECONDS = 0.2
+
+# 读取快照期间不断有事件到达时最多重新读取的次数
+RESYNC_ATTEMPTS = 3
+
+# 监听进程退出后重新启动前的等待时间（秒）
+MONITOR_RESTART_DELAY = 5
+
+# 规则签名各字段的名称
+SIGNATURE_FIELDS = ('protocol', 'source', 'destination', 'port', 'action')
+
+
+def _rule_key(chain, rule_data):
+	return ('rule', chain, rule_signature(rule_data.get('protocol'), rule_data.get('source'),
+	                                      rule_data.get('destination'), rule_data.get('port'),
+	                                      rule_data.get('action')))
+
+
+class KernelMirror:
+	"""内核受管状态的内存镜像：受管链中 (链, 规则签名) 和编译集合中 (集合, 元素键) 的计数"""
+	
+	def __init__(self, live_state=None, elements=True):
+		self.counts = Counter()
+		# nftables句柄 -> 键，删除事件按句柄定位
+		self.handles = {}
+		if live_state is not None:
+			self.load(live_state, elements)
+	
+	def load(self, live_state, elements=True):
+		"""由协调器读取的现状初始化"""
+		self.counts.clear()
+		self.handles.clear()
+		for chain, entries in live_state['rules'].items():
+			for entry in entries:
+				self.add(('rule', chain, entry['signature']), entry.get('handle'))
+		if elements:
+			for name, live_elements in live_state['sets'].items():
+				for key in live_elements:
+					self.add(('element', name, key))
+	
+	def contains(self, key=None, handle=None):
+		"""镜像中是否已有该句柄的规则或该集合元素（集合中同一元素只能出现一次）"""
+		if handle is not None:
+			return handle in self.handles
+		return key is not None and key[0] == 'element' and key in self.counts
+	
+	def add(self, key, handle=None):
+		self.counts[key] += 1
+		if handle is not None:
+			self.handles[handle] = key
+	
+	def remove(self, key=None, handle=None):
+		"""删除一项，返回其键；按句柄删除时句柄未知则返回None"""
+		if handle is not None:
+			key = self.handles.pop(handle, None) or key
+		if key is None:
+			return None
+		self.counts[key] -= 1
+		if self.counts[key] <= 0:
+			del self.counts[key]
+		return key
+
+
+class DriftWatcher:
+	"""事件驱动的漂移检测：消费 nft monitor / xtables-monitor 事件流，增量更新内核镜像并与数据库比对
+	
+	只在启动和监听进程重启时读取一次完整规则集，此后不做周期性全量读取。
+	发生变化的键在 DRIFT_SETTLE_SECONDS 后与数据库期望状态比对，出现或消失的差异通过
+	SocketIO 的 rule_drift 事件推送；数据库规则变化时，期望状态的差异同样参与比对。
+	"""
+	
+	def __init__(self, app, socketio=None, rule_type='nftables'):
+		self.app = app
+		self.socketio = socketio
+		self.rule_type = rule_type
+		self.running = False
+		self.process = None
+		# 监听进程输出的事件行，进程退出时放入None
+		self.events = queue.Queue()
+		self.mirror = KernelMirror()
+		# 待比对的键 -> 最近一次变化的时间
+		self.dirty = {}
+		# 当前存在漂移的键 -> 类型（missing/extra）
+		self.drifted = {}
+		self.desired = Counter()
+		self.desired_rules = {}
+		self.desired_generation = None
+		self.local_generation = ruleset_cache.generation
+		self._lock = threading.Lock()
+	
+	def start(self):
+		self.running = True
+		for target in (self._watch, self._evaluate_loop):
+			thread = threading.Thread(target=target, daemon=True, name=f'drift-{self.rule_type}-{target.__name__}')
+			thread.start()
+	
+	def stop(self):
+		self.running = False
+		if self.process is not None:
+			self.process.terminate()
+	
+	def command(self):
+		if self.rule_type == 'nftables':
+			return [self.app.config.get('NFTABLES_PATH', '/sbin/nft'), '-j', 'monitor', 'ruleset']
+		return [self.app.config.get('XTABLES_MONITOR_PATH', '/usr/sbin/xtables-monitor'), '--event']
+	
+	def _watch(self):
+		while self.running:
+			with self.app.app_context():
+				try:
+					# 先订阅事件再读取快照，两者之间的变化不会丢失；快照已包含的事件在resync中丢弃
+					self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE,
+					                                stderr=subprocess.DEVNULL, text=True)
+					self.events = queue.Queue()
+					threading.Thread(target=self._read, args=(self.process, self.events), daemon=True,
+					                 name=f'drift-{self.rule_type}-read').start()
+					self.resync()
+					while self.running:
+						line = self.events.get()
+						if line is None:
+							break
+						self.apply_event(line)
+				except FileNotFoundError:
+					self.app.logger.warning(f"{self.rule_type} monitor is not available, drift watching disabled")
+					self.running = False
+					return
+				except Exception as e:
+					self.app.logger.error(f"Error watching {self.rule_type} ruleset: {e}")
+				finally:
+					if self.process is not None and self.process.poll() is None:
+						self.process.terminate()
+					db.session.remove()
+			time.sleep(MONITOR_RESTART_DELAY)
+	
+	@staticmethod
+	def _read(process, events):
+		for line in process.stdout:
+			events.put(line)
+		events.put(None)
+	
+	def _drain(self):
+		"""丢弃已排队的事件，返回是否仍有事件（或进程已退出）"""
+		while True:
+			try:
+				line = self.events.get_nowait()
+			except queue.Empty:
+				return False
+			if line is None:
+				self.events.put(None)
+				return True
+	
+	def resync(self):
+		"""重新读取一次完整规则集作为镜像，并比对所有键
+		
+		读取前丢弃已排队的事件（其结果已在快照中），读取后仍有事件到达时重新读取，
+		避免快照之前的事件再次计入镜像。只读取不修改内核，不使共享快照缓存失效。
+		"""
+		for _ in range(RESYNC_ATTEMPTS):
+			self._drain()
+			live_state = RuleReconciler().fetch_live_state(self.rule_type)
+			time.sleep(RESYNC_QUIET_SECONDS)
+			if self.events.empty():
+				break
+		with self._lock:
+			self.mirror.load(live_state, elements=self.rule_type == 'nftables')
+			now = time.monotonic()
+			for key in set(self.mirror.counts) | set(self.desired) | set(self.drifted):
+				self.dirty[key] = now
+	
+	def apply_event(self, line):
+		"""把一行事件应用到镜像"""
+		if self.rule_type == 'nftables':
+			self._apply_nftables_event(line)
+		else:
+			self._apply_iptables_event(line)
+	
+	def _apply_nftables_event(self, line):
+		try:
+			event = json.loads(line)
+		except ValueError:
+			return
+		if not isinstance(event, dict) or len(event) != 1:
+			return
+		verb, body = next(iter(event.items()))
+		if not isinstance(body, dict) or len(body) != 1:
+			return
+		kind, definition = next(iter(body.items()))
+		if not isinstance(definition, dict) or definition.get('family') != NFTABLES_FAMILY or \
+				definition.get('table', definition.get('name')) != NFTABLES_TABLE:
+			return
+		
+		if kind == 'rule':
+			chain = definition.get('chain') or ''
+			if not chain.startswith(MANAGED_CHAIN_PREFIX):
+				return
+			key = _rule_key(chain, parse_nft_rule(definition)) if definition.get('expr') else None
+			with self._lock:
+				if verb == 'add' and self.mirror.contains(handle=definition.get('handle')):
+					# 快照中已有该句柄
+					return
+				if verb == 'add':
+					self.mirror.add(key, definition.get('handle'))
+				elif verb == 'delete':
+					key = self.mirror.remove(key, definition.get('handle'))
+				self._touch(key)
+			if key is None:
+				# 镜像中没有该句柄，无法确定删除的规则
+				self.resync()
+		elif kind == 'element':
+			name = definition.get('name') or ''
+			if not name.startswith(MANAGED_CHAIN_PREFIX):
+				return
+			unknown = False
+			with self._lock:
+				for element in definition.get('elem', []):
+					key = ('element', name, element_key(element))
+					if verb == 'add':
+						if not self.mirror.contains(key):
+							self.mirror.add(key)
+					elif verb == 'delete':
+						# 判决映射的删除事件可能只带键，与镜像中的元素对不上
+						unknown = unknown or key not in self.mirror.counts
+						self.mirror.remove(key)
+					self._touch(key)
+			if unknown:
+				self.resync()
+		elif verb in ('delete', 'flush') or (verb == 'add' and kind in ('set', 'map') and definition.get('elem')):
+			# 删除/清空链、集合或表等结构性变化无法逐项跟踪，重新读取一次
+			self.resync()
+	
+	def _apply_iptables_event(self, line):
+		parts = line.split()
+		if not parts or parts[0] != 'EVENT:' or '-4' not in parts:
+			return
+		table = parts[parts.index('-t') + 1] if '-t' in parts[:-1] else 'filter'
+		if table != 'filter':
+			return
+		
+		for index, part in enumerate(parts):
+			if part in ('-A', '-I', '-D'):
+				break
+			if part in ('-N', '-X', '-F', '-P', '-E'):
+				if any(chain.startswith(MANAGED_CHAIN_PREFIX) for chain in parts[index + 1:index + 2]) or part == '-F':
+					self.resync()
+				return
+		else:
+			return
+		
+		chain = parts[index + 1] if index + 1 < len(parts) else ''
+		if not chain.startswith(MANAGED_CHAIN_PREFIX):
+			return
+		spec = parts[index + 2:]
+		if part == '-I' and spec and spec[0].isdigit():
+			spec = spec[1:]
+		key = _rule_key(chain, parse_iptables_rule(' '.join(['-A', chain] + spec)))
+		with self._lock:
+			if part == '-D':
+				self.mirror.remove(key)
+			else:
+				self.mirror.add(key)
+			self._touch(key)
+	
+	def _touch(self, key):
+		if key is not None:
+			self.dirty[key] = time.monotonic()
+	
+	def _evaluate_loop(self):
+		while self.running:
+			time.sleep(DRIFT_SETTLE_SECONDS / 2)
+			with self.app.app_context():
+				try:
+					for event in self.evaluate():
+						self._emit(event)
+				except Exception as e:
+					self.app.logger.error(f"Error evaluating {self.rule_type} drift: {e}")
+				finally:
+					db.session.remove()
+	
+	def evaluate(self, now=None):
+		"""比对已稳定的变化键，返回新出现或已消除的漂移事件"""
+		now = time.monotonic() if now is None else now
+		self._refresh_desired(now)
+		
+		with self._lock:
+			if ruleset_cache.generation != self.local_generation:
+				# 本进程刚修改过内核，推迟比对直到其事务（包括数据库提交）完成
+				self.local_generation = ruleset_cache.generation
+				for key in self.dirty:
+					self.dirty[key] = now
+				return []
+			ready = [key for key, changed in self.dirty.items() if now - changed >= DRIFT_SETTLE_SECONDS]
+			actual = {key: self.mirror.counts.get(key, 0) for key in ready}
+			for key in ready:
+				del self.dirty[key]
+		
+		events = []
+		for key in ready:
+			expected = self.desired.get(key, 0)
+			drift = 'missing' if actual[key] < expected else 'extra' if actual[key] > expected else None
+			previous = self.drifted.get(key)
+			if drift == previous:
+				continue
+			if drift:
+				self.drifted[key] = drift
+			else:
+				del self.drifted[key]
+			events.append(self._event(key, drift or 'resolved', expected, actual[key]))
+		return events
+	
+	def _refresh_desired(self, now):
+		"""数据库规则集代数变化时重建期望状态，发生变化的键加入待比对"""
+		generation = current_generation()
+		if generation == self.desired_generation:
+			return
+		
+		desired = Counter()
+		desired_rules = {}
+		reconciler = RuleReconciler()
+		desired_state = reconciler.build_desired_state(self.rule_type)
+		for chain, units in desired_state.items():
+			managed_chain = managed_chain_name(chain)
+			for unit in units:
+				key = ('rule', managed_chain, unit.signature())
+				desired[key] += 1
+				desired_rules.setdefault(key, []).extend(rule.id for rule in unit_rules(unit))
+				if isinstance(unit, CompiledGroup) and self.rule_type == 'nftables':
+					for rule, element, _ in unit.rule_elements():
+						key = ('element', unit.name, element)
+						desired[key] += 1
+						desired_rules.setdefault(key, []).append(rule.id)
+		if self.rule_type == 'nftables':
+			for group_set in reconciler.object_group_sets(self.rule_type, desired_state):
+				for key in group_set.elements():
+					desired[('element', group_set.name, key)] += 1
+		
+		with self._lock:
+			for key in set(desired) | set(self.desired):
+				if desired.get(key, 0) != self.desired.get(key, 0):
+					# 路由先提交数据库再写内核，与内核事件一样等待稳定后再比对
+					self.dirty[key] = now
+			self.desired = desired
+			self.desired_rules = desired_rules
+			self.desired_generation = generation
+	
+	def _event(self, key, drift, expected, actual):
+		kind, container, value = key
+		event = {
+			'rule_type': self.rule_type,
+			'drift': drift,
+			'expected': expected,
+			'actual': actual,
+			'rule_ids': self.desired_rules.get(key, []),
+			'timestamp': datetime.utcnow().isoformat()
+		}
+		if kind == 'rule':
+			event.update({'chain': container, 'rule': dict(zip(SIGNATURE_FIELDS, value))})
+		else:
+			event.update({'set': container, 'element': json.loads(value)})
+		return event
+	
+	def _emit(self, event):
+		self.app.logger.warning(f"Ruleset drift ({event['drift']}) in {self.rule_type}: "
+		                        f"{event.get('chain') or event.get('set')}")
+		if self.socketio:
+			self.socketio.emit('rule_drift', event)
@@ -1,391 +1,637 @@
 # services/firewall_manager.py
 import subprocess
-import re
 import json
+import bisect
+from datetime import datetime
+from sqlalchemy import or_
 from models import db, FirewallRule
+from models.rule import MANAGED_CHAIN_PREFIX, managed_chain_name, rule_signature, bump_generation, object_group_refs, \
+	iptables_restore_line
+from services.nftables_backend import NftablesBackend, NFTABLES_FAMILY, NFTABLES_TABLE, table_ref, chain_ref, rule_ref, \
+	jump_rule
+from services.rule_compiler import RuleCompiler, element_ref, expiring_rule, crosses_overlap, timeout_set, \
+	element_counter, element_lookup_key
+from services.ipset_backend import IpsetBackend, IpsetRuleCompiler, ipset_element_ref
+from services.object_group import object_group_sets
+from services.chain_sharder import sharding_chains, base_chain
+from services.ruleset_parser import RulesetReader, parse_iptables_rule, parse_nft_rule
+from services.ruleset_cache import ruleset_cache
+from services.rule_order import rule_order_index, order_key
 from flask import current_app
 import tempfile
 import os
 
+# nftables内置链对应的钩子
+NFTABLES_BASE_CHAIN_HOOKS = {
+	'INPUT': 'input',
+	'OUTPUT': 'output',
+	'FORWARD': 'forward'
+}
+
+# 本进程内已确认存在的受管链，避免每次应用规则都重复检查
+_ensured_chains = set()
+
 
 class FirewallManager:
 	def __init__(self):
 		self.iptables_path = current_app.config.get('IPTABLES_PATH', '/sbin/iptables')
 		self.nftables_path = current_app.config.get('NFTABLES_PATH', '/sbin/nft')
+		self.iptables_restore_path = current_app.config.get('IPTABLES_RESTORE_PATH', '/sbin/iptables-restore')
+		self.nftables = NftablesBackend(self.nftables_path)
+		self.ipset = IpsetBackend(current_app.config.get('IPSET_PATH', '/sbin/ipset'))
+	
+	def ensure_managed_chain(self, rule_type, chain):
+		"""确保受管链存在，并且基础链中有跳转到受管链的规则"""
+		if (rule_type, chain) in _ensured_chains:
+			return
+		
+		managed_chain = managed_chain_name(chain)
+		try:
+			if rule_type == 'iptables':
+				result = subprocess.run([self.iptables_path, '-S', managed_chain], check=False, capture_output=True,
+				                        text=True)
+				if result.returncode != 0:
+					ruleset_cache.invalidate()
+					subprocess.run([self.iptables_path, '-N', managed_chain], check=True, capture_output=True, text=True)
+				
+				result = subprocess.run([self.iptables_path, '-C', chain, '-j', managed_chain], check=False,
+				                        capture_output=True, text=True)
+				if result.returncode != 0:
+					ruleset_cache.invalidate()
+					subprocess.run([self.iptables_path, '-I', chain, '1', '-j', managed_chain], check=True,
+					               capture_output=True, text=True)
+			else:
+				commands = [{'add': table_ref()}]
+				hook = NFTABLES_BASE_CHAIN_HOOKS.get(chain)
+				if hook:
+					commands.append({'add': chain_ref(chain, hook)})
+				commands.append({'add': chain_ref(managed_chain)})
+				self.nftables.run(commands)
+				
+				has_jump = any(
+					parse_nft_rule(item['rule']).get('action') == managed_chain
+					for item in self.nftables.list(chain_ref(chain)) if 'rule' in item
+				)
+				if not has_jump:
+					self.nftables.run([{'insert': jump_rule(chain, managed_chain)}])
+		except subprocess.CalledProcessError as e:
+			current_app.logger.error(f"Error preparing managed chain {managed_chain}: {e.stderr}")
+			raise Exception(f"Failed to prepare managed chain {managed_chain}: {e.stderr}")
+		
+		_ensured_chains.add((rule_type, chain))
+	
+	def mark_managed_chain(self, rule_type, chain):
+		"""记录受管链已由其他事务（如规则协调）创建"""
+		_ensured_chains.add((rule_type, chain))
 	
 	def apply_iptables_rule(self, rule):
-		"""应用iptables规则"""
+		"""按优先级将iptables规则直接插入到受管链中的位置（-I 链 N），并记录该位置"""
 		if not rule.enabled:
 			return True
+		if rule.chain in sharding_chains():
+			return self.reconcile_rules('iptables')
+		if expiring_rule(rule) and self.ipset.available():
+			return self.apply_expiring_rule(rule)
+		
+		self.ensure_object_group_sets('iptables', [rule])
+		self.ensure_managed_chain('iptables', rule.chain)
+		order = rule_order_index.chain(self, 'iptables', rule.chain)
+		key = order_key(rule)
+		index, _ = order.placement(key)
+		position = index + 1
 		
 		# 生成iptables命令
 		cmd = [self.iptables_path]
-		cmd.extend(rule.to_iptables_command())
+		cmd.extend(rule.to_iptables_command(position))
 		
 		# 执行命令
+		generation = ruleset_cache.generation
+		ruleset_cache.invalidate()
 		try:
 			result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-			return True
 		except subprocess.CalledProcessError as e:
+			rule_order_index.written(generation)
 			current_app.logger.error(f"Error applying iptables rule: {e.stderr}")
 			raise Exception(f"Failed to apply iptables rule: {e.stderr}")
+		
+		self._open_iptables_position(rule.chain, position)
+		rule.kernel_position = position
+		order.insert(index, key)
+		rule_order_index.written(generation)
+		return True
 	
 	def apply_nftables_rule(self, rule):
-		"""应用nftables规则"""
+		"""按优先级将nftables规则插入到其后一条规则之前（insert rule ... position H），
+		并通过 --echo --handle 记录内核句柄"""
 		if not rule.enabled:
 			return True
+		if rule.chain in sharding_chains():
+			return self.reconcile_rules('nftables')
+		if expiring_rule(rule):
+			return self.apply_expiring_rule(rule)
 		
-		# 生成nftables命令
-		cmd_str = rule.to_nftables_command()
+		self.ensure_object_group_sets('nftables', [rule])
+		self.ensure_managed_chain('nftables', rule.chain)
+		order = rule_order_index.chain(self, 'nftables', rule.chain)
+		key = order_key(rule)
+		index, next_handle = order.placement(key)
+		command = rule.to_nftables_json('insert', next_handle) if next_handle else rule.to_nftables_json()
 		
-		# 执行命令
+		# 通过JSON API提交，echo输出中带有新规则的句柄
+		generation = ruleset_cache.generation
 		try:
-			result = subprocess.run([self.nftables_path, '-c', cmd_str], check=True, capture_output=True, text=True)
-			return True
+			items = self.nftables.run([command], echo=True)
+		except Exception as e:
+			rule_order_index.written(generation)
+			current_app.logger.error(f"Error applying nftables rule: {e}")
+			raise Exception(f"Failed to apply nftables rule: {e}")
+		
+		handles = NftablesBackend.echo_handles(items)
+		rule.kernel_handle = handles[0] if handles else None
+		if rule.kernel_handle:
+			order.insert(index, key, rule.kernel_handle)
+			rule_order_index.written(generation)
+		else:
+			rule_order_index.invalidate()
+		return True
+	
+	def apply_expiring_rule(self, rule):
+		"""将有效期内的地址规则放入超时集合，由内核到期自动删除
+		
+		集合已在内核中、且规则不需要越过与其重叠的规则前移到集合规则处时只添加一个带超时的元素；
+		否则协调该后端，由编译器决定集合的成员和位置。
+		"""
+		compiler = IpsetRuleCompiler() if rule.rule_type == 'iptables' else RuleCompiler()
+		group = compiler.expiring_group(rule.chain, [rule])
+		anchor = FirewallRule.query.filter(FirewallRule.kernel_set == group.name, FirewallRule.id != rule.id).order_by(
+			FirewallRule.priority, FirewallRule.id).first()
+		if anchor is None or order_key(rule) < order_key(anchor) or \
+				crosses_overlap(rule, self._rules_between(rule, anchor, group.name)):
+			return self.reconcile_rules(rule.rule_type)
+		
+		_, _, element = next(group.rule_elements())
+		try:
+			if rule.rule_type == 'iptables':
+				self.ipset.restore([f'add {group.name} {element}'])
+			else:
+				self.nftables.run([{'add': {'element': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE,
+				                                        'name': group.name, 'elem': [element]}}}])
+		except Exception as e:
+			current_app.logger.error(f"Error adding expiring rule to {group.name}: {e}")
+			raise Exception(f"Failed to add expiring rule to {group.name}: {e}")
+		
+		rule.kernel_set = group.name
+		rule.kernel_handle = anchor.kernel_handle
+		rule.kernel_position = anchor.kernel_position
+		return True
+	
+	def _rules_between(self, rule, anchor, kernel_set):
+		"""同一链中排在anchor与rule之间、不属于该集合的启用规则"""
+		rows = FirewallRule.query.filter_by(rule_type=rule.rule_type, chain=rule.chain, enabled=True).filter(
+			FirewallRule.id != rule.id,
+			FirewallRule.priority.between(anchor.priority, rule.priority),
+			or_(FirewallRule.kernel_set.is_(None), FirewallRule.kernel_set != kernel_set))
+		return [row for row in rows if order_key(anchor) < order_key(row) < order_key(rule)]
+	
+	def reconcile_rules(self, rule_type, exclude=()):
+		"""以一次协调写入该后端的期望状态；exclude为即将删除、不再属于期望状态的规则id
+		
+		分片链中的一条规则可能在多条子链中各有一份，只能整体协调。
+		"""
+		# 局部导入：rule_reconciler 依赖本模块
+		from services.rule_reconciler import RuleReconciler
+		reconciler = RuleReconciler(self)
+		reconciler.apply_plan(reconciler.plan(rule_type, exclude))
+		return True
+	
+	def ensure_object_group_sets(self, rule_type, rules):
+		"""写入规则之前，创建其引用、但内核中还没有的对象组集合（含全部成员）"""
+		if not any(object_group_refs(rule) for rule in rules):
+			return
+		if rule_type == 'iptables' and not self.ipset.available():
+			raise Exception('Rules referencing object groups require ipset')
+		
+		live_names = self.live_set_names(rule_type)
+		missing = [group_set for group_set in object_group_sets(rule_type, rules) if group_set.name not in live_names]
+		if not missing:
+			return
+		
+		if rule_type == 'iptables':
+			lines = []
+			for group_set in missing:
+				lines.extend(self.ipset.render_set(group_set.name, group_set.set_type, group_set.elements()))
+			self.ipset.restore(lines)
+			return
+		
+		commands = [{'add': table_ref()}]
+		for group_set in missing:
+			commands.append({'add': group_set.set_object()})
+			elements = list(group_set.elements().values())
+			if elements:
+				commands.append({'add': {'element': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE,
+				                                     'name': group_set.name, 'elem': elements}}})
+		try:
+			self.nftables.run(commands)
+		except Exception as e:
+			current_app.logger.error(f"Error creating object group sets: {e}")
+			raise Exception(f"Failed to create object group sets: {e}")
+	
+	def run_iptables_restore(self, payload):
+		"""通过一次 iptables-restore --noflush 提交payload"""
+		ruleset_cache.invalidate()
+		try:
+			return subprocess.run([self.iptables_restore_path, '--noflush'], input=payload, check=True,
+			                      capture_output=True, text=True)
 		except subprocess.CalledProcessError as e:
-			current_app.logger.error(f"Error applying nftables rule: {e.stderr}")
-			raise Exception(f"Failed to apply nftables rule: {e.stderr}")
+			current_app.logger.error(f"Error applying iptables batch: {e.stderr}")
+			raise Exception(f"Failed to apply iptables batch: {e.stderr}")
 	
 	def remove_iptables_rule(self, rule):
-		"""从iptables移除规则"""
-		# 复制规则命令，但将-A替换为-D
-		cmd = [self.iptables_path]
-		iptables_cmd = rule.to_iptables_command()
-		if iptables_cmd[0] == '-A':
-			iptables_cmd[0] = '-D'
-		cmd.extend(iptables_cmd)
+		"""从iptables移除规则，并前移同链后续规则记录的位置"""
+		if rule.chain in sharding_chains():
+			return self.reconcile_rules('iptables', exclude={rule.id})
+		if rule.kernel_set:
+			# 规则已编译进ipset，只删除对应的集合元素
+			self._remove_set_elements([rule])
+			return True
+		
+		# 记录的位置上仍是该规则时按位置删除（-D 链 N），不需要内核逐条比对规则内容；
+		# 位置缺失或已失效时按规则内容删除
+		if rule.kernel_position and self._iptables_signature_at(rule.kernel_chain, rule.kernel_position) == \
+				rule.signature():
+			cmd = [self.iptables_path, '-D', rule.kernel_chain, str(rule.kernel_position)]
+		else:
+			cmd = [self.iptables_path, '-D', rule.kernel_chain] + rule.iptables_rule_spec()
 		
+		generation = ruleset_cache.generation
+		ruleset_cache.invalidate()
 		try:
 			result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+			self._shift_iptables_positions(rule.chain, [rule.kernel_position])
+			rule.kernel_position = None
+			rule_order_index.removed(rule.rule_type, rule.chain, order_key(rule), generation)
 			return True
 		except subprocess.CalledProcessError as e:
+			rule_order_index.invalidate()
 			current_app.logger.error(f"Error removing iptables rule: {e.stderr}")
 			raise Exception(f"Failed to remove iptables rule: {e.stderr}")
 	
 	def remove_nftables_rule(self, rule):
-		"""从nftables移除规则"""
-		# 为了移除nftables规则，我们需要找到规则的句柄
-		table = 'filter'
+		"""从nftables移除规则，优先使用应用时记录的句柄"""
+		if rule.chain in sharding_chains():
+			return self.reconcile_rules('nftables', exclude={rule.id})
+		if rule.kernel_set:
+			# 规则已编译进集合，只删除对应的集合元素
+			self._remove_set_elements([rule])
+			return True
+		
+		if rule.kernel_handle:
+			try:
+				generation = ruleset_cache.generation
+				self.nftables.run([{'delete': rule_ref(rule.kernel_chain, rule.kernel_handle)}])
+				rule.kernel_handle = None
+				rule_order_index.removed(rule.rule_type, rule.chain, order_key(rule), generation)
+				return True
+			except Exception:
+				current_app.logger.warning(f"Stale nftables handle {rule.kernel_handle} for rule {rule.id}")
 		
-		# 获取规则列表
+		# 句柄缺失或已失效时，列出一次规则表并建立索引查找
 		try:
-			# 获取规则句柄
-			list_cmd = f"list table {table}"
-			result = subprocess.run([self.nftables_path, '-j', list_cmd], check=True, capture_output=True, text=True)
-			rules_json = json.loads(result.stdout)
-			
-			# 查找匹配的规则并删除
-			# 这里需要根据实际情况进行匹配，这只是一个简化的示例
-			rule_handle = self._find_nftables_rule_handle(rules_json, rule)
+			handle_index = self._index_nftables_handles()
+			rule_handle = self._take_nftables_handle(handle_index, rule)
 			
 			if rule_handle:
-				delete_cmd = f"delete rule {table} {rule.chain} handle {rule_handle}"
-				result = subprocess.run([self.nftables_path, delete_cmd], check=True, capture_output=True, text=True)
+				self.nftables.run([{'delete': rule_ref(rule.kernel_chain, rule_handle)}])
+				rule.kernel_handle = None
 				return True
 			else:
 				current_app.logger.warning(f"Rule not found in nftables: {rule.id}")
 				return False
 		
-		except subprocess.CalledProcessError as e:
-			current_app.logger.error(f"Error removing nftables rule: {e.stderr}")
-			raise Exception(f"Failed to remove nftables rule: {e.stderr}")
+		except Exception as e:
+			current_app.logger.error(f"Error removing nftables rule: {e}")
+			raise Exception(f"Failed to remove nftables rule: {e}")
 	
-	def _find_nftables_rule_handle(self, rules_json, rule):
-		"""在nftables JSON输出中查找匹配规则的句柄"""
-		# 这是一个简化的实现，实际情况可能需要更复杂的匹配逻辑
-		if 'nftables' not in rules_json:
-			return None
+	def _remove_set_elements(self, rules):
+		"""删除集合成员规则对应的nftables集合元素/ipset元素；仍被其他规则共享的元素保留"""
+		removed_ids = {rule.id for rule in rules}
+		# 超时集合中已过期的元素已由内核删除
+		now = datetime.utcnow()
+		expired = [rule for rule in rules
+		           if timeout_set(rule.kernel_set) and rule.expires_at and rule.expires_at <= now]
+		rules = [rule for rule in rules if rule not in expired]
+		for rule in expired:
+			rule.kernel_handle = None
+			rule.kernel_position = None
+			rule.kernel_set = None
+		
+		shared = {
+			(other.kernel_set, other.signature())
+			for other in FirewallRule.query.filter(FirewallRule.kernel_set.in_({rule.kernel_set for rule in rules}))
+			if other.id not in removed_ids
+		}
 		
-		for item in rules_json['nftables']:
-			if 'rule' in item:
-				rule_data = item['rule']
-				if rule_data.get('chain') == rule.chain:
-					# 这里需要根据规则的具体内容进行匹配
-					# 简化示例：仅检查协议、源IP和目标IP
-					expr = rule_data.get('expr', [])
-					matches = 0
-					needed_matches = 0
-					
-					if rule.protocol and rule.protocol != 'all':
-						needed_matches += 1
-						for e in expr:
-							if e.get('match', {}).get('left', {}).get('payload', {}).get('protocol') == rule.protocol:
-								matches += 1
-								break
-					
-					if rule.source and rule.source != 'any':
-						needed_matches += 1
-						for e in expr:
-							if e.get('match', {}).get('left', {}).get('payload', {}).get('field') == 'saddr' and \
-									e.get('match', {}).get('right') == rule.source:
-								matches += 1
-								break
-					
-					if rule.destination and rule.destination != 'any':
-						needed_matches += 1
-						for e in expr:
-							if e.get('match', {}).get('left', {}).get('payload', {}).get('field') == 'daddr' and \
-									e.get('match', {}).get('right') == rule.destination:
-								matches += 1
-								break
-					
-					if matches == needed_matches:
-						return rule_data.get('handle')
-		
-		return None
+		commands = []
+		ipset_lines = []
+		for rule in rules:
+			key = (rule.kernel_set, rule.signature())
+			if key in shared:
+				continue
+			shared.add(key)
+			if rule.rule_type == 'iptables':
+				ipset_lines.append(f'del {rule.kernel_set} {ipset_element_ref(rule)}')
+			else:
+				commands.append({'delete': element_ref(rule)})
+		
+		if ipset_lines:
+			self.ipset.restore(ipset_lines)
+		if commands:
+			try:
+				self.nftables.run(commands)
+			except Exception as e:
+				current_app.logger.error(f"Error removing nftables set element: {e}")
+				raise Exception(f"Failed to remove nftables set element: {e}")
+		
+		for rule in rules:
+			rule.kernel_handle = None
+			rule.kernel_position = None
+			rule.kernel_set = None
 	
-	def sync_from_server(self):
-		"""从服务器同步现有规则"""
-		synced_rules = []
-		
-		# 同步iptables规则
-		iptables_rules = self._get_iptables_rules()
-		for rule_data in iptables_rules:
-			rule = self._create_or_update_rule('iptables', rule_data)
-			if rule:
-				synced_rules.append(rule)
-		
-		# 同步nftables规则
-		nftables_rules = self._get_nftables_rules()
-		for rule_data in nftables_rules:
-			rule = self._create_or_update_rule('nftables', rule_data)
-			if rule:
-				synced_rules.append(rule)
-		
-		return synced_rules
+	def snapshot(self, backend, max_age=0):
+		"""读取内核规则集快照：nftables（整个规则集的对象列表）、iptables（filter表的 -S 输出行）
+		或 ipset（受管集合）；内容未变时复用已解析的快照，max_age只用于展示类读取"""
+		if backend == 'nftables':
+			return ruleset_cache.get('nftables', self.nftables.dump,
+			                         lambda raw: json.loads(raw).get('nftables', []) if raw.strip() else [], max_age)
+		if backend == 'ipset':
+			return ruleset_cache.get('ipset', self.ipset.dump, self.ipset.parse_save, max_age)
+		return ruleset_cache.get('iptables', self._dump_iptables, str.splitlines, max_age)
 	
-	def _get_iptables_rules(self):
-		"""获取服务器上的iptables规则"""
-		rules = []
-		
+	def _dump_iptables(self):
 		try:
-			# 获取iptables规则列表
-			result = subprocess.run([self.iptables_path, '-S'], check=True, capture_output=True, text=True)
-			lines = result.stdout.strip().split('\n')
-			
-			for line in lines:
-				if line.startswith('-A'):  # 只处理添加规则的命令
-					parts = line.split()
-					rule_data = {
-						'chain': parts[1] if len(parts) > 1 else None,
-						'protocol': None,
-						'source': None,
-						'destination': None,
-						'port': None,
-						'action': None,
-						'comment': None
-					}
-					
-					# 解析规则参数
-					i = 2
-					while i < len(parts):
-						if parts[i] == '-p' and i + 1 < len(parts):
-							rule_data['protocol'] = parts[i + 1]
-							i += 2
-						elif parts[i] == '-s' and i + 1 < len(parts):
-							rule_data['source'] = parts[i + 1]
-							i += 2
-						elif parts[i] == '-d' and i + 1 < len(parts):
-							rule_data['destination'] = parts[i + 1]
-							i += 2
-						elif parts[i] == '--dport' and i + 1 < len(parts):
-							rule_data['port'] = parts[i + 1]
-							i += 2
-						elif parts[i] == '-j' and i + 1 < len(parts):
-							rule_data['action'] = parts[i + 1]
-							i += 2
-						elif parts[i] == '-m' and i + 1 < len(parts) and parts[i + 1] == 'comment' and i + 3 < len(
-								parts) and parts[i + 2] == '--comment':
-							rule_data['comment'] = parts[i + 3].strip('"\'')
-							i += 4
-						else:
-							i += 1
-					
-					rules.append(rule_data)
-			
-			return rules
+			return subprocess.run([self.iptables_path, '-S'], check=True, capture_output=True, text=True).stdout
 		except subprocess.CalledProcessError as e:
-			current_app.logger.error(f"Error getting iptables rules: {e.stderr}")
-			return []
+			current_app.logger.error(f"Error listing iptables rules: {e.stderr}")
+			raise Exception(f"Failed to list iptables rules: {e.stderr}")
 	
-	def _get_nftables_rules(self):
-		"""获取服务器上的nftables规则"""
-		rules = []
-		
+	def _iptables_signature_at(self, chain, position):
+		"""快照中受管链第position条规则的签名；读取失败或没有该位置时返回None"""
 		try:
-			# 获取nftables规则列表
-			result = subprocess.run([self.nftables_path, '-j', 'list', 'ruleset'], check=True, capture_output=True,
-			                        text=True)
-			rules_json = json.loads(result.stdout)
-			
-			if 'nftables' in rules_json:
-				for item in rules_json['nftables']:
-					if 'rule' in item:
-						rule_data = {
-							'chain': item['rule'].get('chain'),
-							'protocol': None,
-							'source': None,
-							'destination': None,
-							'port': None,
-							'action': None,
-							'comment': None
-						}
-						
-						# 解析表达式
-						for expr in item['rule'].get('expr', []):
-							# 解析协议
-							if 'match' in expr and 'left' in expr['match'] and 'payload' in expr['match']['left']:
-								payload = expr['match']['left']['payload']
-								if payload.get('protocol') in ['tcp', 'udp', 'icmp']:
-									rule_data['protocol'] = payload.get('protocol')
-							
-							# 解析源IP
-							if 'match' in expr and 'left' in expr['match'] and 'payload' in expr['match']['left']:
-								payload = expr['match']['left']['payload']
-								if payload.get('field') == 'saddr' and 'right' in expr['match']:
-									rule_data['source'] = expr['match']['right']
-							
-							# 解析目标IP
-							if 'match' in expr and 'left' in expr['match'] and 'payload' in expr['match']['left']:
-								payload = expr['match']['left']['payload']
-								if payload.get('field') == 'daddr' and 'right' in expr['match']:
-									rule_data['destination'] = expr['match']['right']
-							
-							# 解析端口
-							if 'match' in expr and 'left' in expr['match'] and 'payload' in expr['match']['left']:
-								payload = expr['match']['left']['payload']
-								if payload.get('field') == 'dport' and 'right' in expr['match']:
-									rule_data['port'] = str(expr['match']['right'])
-							
-							# 解析动作
-							if expr.get('accept') is not None:
-								rule_data['action'] = 'ACCEPT'
-							elif expr.get('drop') is not None:
-								rule_data['action'] = 'DROP'
-							elif expr.get('reject') is not None:
-								rule_data['action'] = 'REJECT'
-							elif expr.get('log') is not None:
-								rule_data['action'] = 'LOG'
-							
-							# 解析注释
-							if expr.get('comment') is not None:
-								rule_data['comment'] = expr['comment']
-						
-						rules.append(rule_data)
-			
-			return rules
-		except subprocess.CalledProcessError as e:
-			current_app.logger.error(f"Error getting nftables rules: {e.stderr}")
-			return []
-		except json.JSONDecodeError as e:
-			current_app.logger.error(f"Error parsing nftables JSON: {e}")
-			return []
+			signatures = self.snapshot('iptables').derive('chain_signatures', self._build_iptables_chain_signatures)
+		except Exception:
+			return None
+		chain_signatures = signatures.get(chain, [])
+		return chain_signatures[position - 1] if position <= len(chain_signatures) else None
 	
-	def _create_or_update_rule(self, rule_type, rule_data):
-		"""创建或更新规则"""
-		# 尝试查找匹配的现有规则
-		existing_rule = FirewallRule.query.filter_by(
-			rule_type=rule_type,
-			chain=rule_data['chain'],
-			protocol=rule_data['protocol'],
-			source=rule_data['source'],
-			destination=rule_data['destination'],
-			port=rule_data['port'],
-			action=rule_data['action']
-		).first()
-		
-		if existing_rule:
-			# 更新现有规则
-			if rule_data['comment']:
-				existing_rule.comment = rule_data['comment']
-			db.session.commit()
-			return existing_rule
-		else:
-			# 创建新规则
-			new_rule = FirewallRule(
-				rule_type=rule_type,
-				chain=rule_data['chain'],
-				protocol=rule_data['protocol'] or 'all',
-				source=rule_data['source'] or 'any',
-				destination=rule_data['destination'] or 'any',
-				port=rule_data['port'] or 'any',
-				action=rule_data['action'],
-				comment=rule_data['comment'] or '',
-				priority=100,  # 默认优先级
-				enabled=True
-			)
-			db.session.add(new_rule)
-			db.session.commit()
-			return new_rule
+	@staticmethod
+	def _build_iptables_chain_signatures(lines):
+		signatures = {}
+		for line in lines:
+			if line.startswith(f'-A {MANAGED_CHAIN_PREFIX}'):
+				rule_data = parse_iptables_rule(line)
+				signatures.setdefault(rule_data['chain'], []).append(rule_signature(
+					rule_data.get('protocol'), rule_data.get('source'), rule_data.get('destination'),
+					rule_data.get('port'), rule_data.get('action')))
+		return signatures
 	
-	def import_rules_from_data(self, rules_data):
-		"""从数据导入规则"""
-		imported_rules = []
-		
-		for rule_data in rules_data:
-			# 检查必填字段
-			required_fields = ['rule_type', 'chain', 'action']
-			if all(field in rule_data for field in required_fields):
-				# 创建规则对象
-				rule = FirewallRule(
-					rule_type=rule_data['rule_type'],
-					chain=rule_data['chain'],
-					protocol=rule_data.get('protocol', 'all'),
-					source=rule_data.get('source', 'any'),
-					destination=rule_data.get('destination', 'any'),
-					port=rule_data.get('port', 'any'),
-					action=rule_data['action'],
-					comment=rule_data.get('comment', ''),
-					priority=rule_data.get('priority', 100),
-					enabled=rule_data.get('enabled', True)
-				)
-				
-				# 保存到数据库
-				db.session.add(rule)
-				db.session.commit()
-				
-				# 应用规则
-				try:
-					if rule.rule_type == 'iptables':
-						self.apply_iptables_rule(rule)
-					else:
-						self.apply_nftables_rule(rule)
-					
-					imported_rules.append(rule)
-				except Exception as e:
-					current_app.logger.error(f"Error applying imported rule: {e}")
-					db.session.delete(rule)
-					db.session.commit()
-		
-		return imported_rules
+	def nftables_rule_index(self):
+		"""快照中filter表规则的 (链, 规则签名) -> 句柄列表 索引（共享，不得修改）"""
+		return self.snapshot('nftables').derive('rule_index', self._build_nftables_rule_index)
 	
-	def import_rules_from_file(self, file_path):
-		"""从文件导入规则"""
-		try:
-			with open(file_path, 'r') as f:
-				rules_data = json.load(f)
-			
-			return self.import_rules_from_data(rules_data)
-		except Exception as e:
-			current_app.logger.error(f"Error importing rules from file: {e}")
-			raise
+	@staticmethod
+	def _build_nftables_rule_index(items):
+		index = {}
+		for item in items:
+			rule_json = item.get('rule')
+			if rule_json and rule_json.get('family') == NFTABLES_FAMILY and rule_json.get('table') == NFTABLES_TABLE:
+				rule_data = parse_nft_rule(rule_json)
+				key = (rule_data['chain'], rule_signature(rule_data['protocol'], rule_data['source'],
+				                                          rule_data['destination'], rule_data['port'],
+				                                          rule_data['action']))
+				index.setdefault(key, []).append(rule_data['handle'])
+		return index
 	
-	def export_rules_to_file(self, file_path, rule_type='all'):
-		"""导出规则到文件"""
-		try:
-			# 根据类型筛选规则
-			if rule_type != 'all':
-				rules = FirewallRule.query.filter_by(rule_type=rule_type).all()
-			else:
-				rules = FirewallRule.query.all()
+	def nftables_chain_handles(self):
+		"""快照中filter表各链的规则句柄，按链中的顺序排列（共享，不得修改）"""
+		return self.snapshot('nftables').derive('chain_handles', self._build_nftables_chain_handles)
+	
+	@staticmethod
+	def _build_nftables_chain_handles(items):
+		chains = {}
+		for item in items:
+			rule_json = item.get('rule')
+			if rule_json and rule_json.get('family') == NFTABLES_FAMILY and rule_json.get('table') == NFTABLES_TABLE:
+				chains.setdefault(rule_json.get('chain'), []).append(rule_json.get('handle'))
+		return chains
+	
+	def live_set_names(self, rule_type):
+		"""快照中已有的受管集合名称：nftables命名集合/映射，或ipset（共享，不得修改）"""
+		if rule_type == 'iptables':
+			return self.snapshot('ipset').data if self.ipset.available() else {}
+		return self.snapshot('nftables').derive('set_names', self._build_nftables_set_names)
+	
+	@staticmethod
+	def _build_nftables_set_names(items):
+		names = set()
+		for item in items:
+			for kind, definition in item.items():
+				if kind in ('set', 'map') and definition.get('family') == NFTABLES_FAMILY and \
+						definition.get('table') == NFTABLES_TABLE:
+					names.add(definition.get('name'))
+		return names
+	
+	def _index_nftables_handles(self):
+		"""建立 (链, 规则签名) -> 句柄列表 的索引；返回副本，取出句柄时不影响共享的快照"""
+		return {key: list(handles) for key, handles in self.nftables_rule_index().items()}
+	
+	def _take_nftables_handle(self, handle_index, rule):
+		"""从索引中取出与规则匹配的句柄（取出后移除，避免重复规则共用同一句柄）"""
+		handles = handle_index.get((rule.kernel_chain, rule.signature()))
+		if not handles:
+			return None
+		if rule.kernel_handle in handles:
+			handles.remove(rule.kernel_handle)
+			return rule.kernel_handle
+		return handles.pop(0)
+	
+	def _open_iptables_position(self, chain, position):
+		"""规则插入到某一位置后，后移同一受管链中原来位于该位置及其后的规则所记录的位置"""
+		rules = FirewallRule.query.filter(
+			FirewallRule.rule_type == 'iptables',
+			FirewallRule.chain == chain,
+			FirewallRule.kernel_position >= position
+		).all()
+		for rule in rules:
+			rule.kernel_position += 1
+	
+	def _shift_iptables_positions(self, chain, removed_positions):
+		"""规则被删除后，前移同一受管链中位于其后的规则所记录的位置"""
+		removed_positions = sorted(position for position in removed_positions if position)
+		if not removed_positions:
+			return
+		
+		rules = FirewallRule.query.filter(
+			FirewallRule.rule_type == 'iptables',
+			FirewallRule.chain == chain,
+			FirewallRule.kernel_position > removed_positions[0]
+		).all()
+		for rule in rules:
+			if rule.kernel_position not in removed_positions:
+				rule.kernel_position -= bisect.bisect_left(removed_positions, rule.kernel_position)
+	
+	def read_counters(self, rule_type):
+		"""一次列出规则计数器：rules为 (受管链, 位置/句柄) -> (包数, 字节数)，chains为受管链 -> 进入的包数，
+		elements为编译集合 -> 元素查找键 -> (包数, 字节数)（只包含开启了元素计数器的集合）"""
+		counters = {'rules': {}, 'chains': {}, 'elements': {}}
+		
+		if rule_type == 'iptables':
+			try:
+				result = subprocess.run([self.iptables_path, '-L', '-v', '-x', '-n', '--line-numbers'], check=True,
+				                        capture_output=True, text=True)
+			except subprocess.CalledProcessError as e:
+				current_app.logger.error(f"Error reading iptables counters: {e.stderr}")
+				raise Exception(f"Failed to read iptables counters: {e.stderr}")
 			
-			# 导出为JSON
-			rules_data = [rule.to_dict() for rule in rules]
+			chain = None
+			for line in result.stdout.splitlines():
+				parts = line.split()
+				if len(parts) >= 2 and parts[0] == 'Chain':
+					chain = parts[1]
+				elif len(parts) >= 4 and parts[0].isdigit():
+					packets, size, target = int(parts[1]), int(parts[2]), parts[3]
+					if chain.startswith(MANAGED_CHAIN_PREFIX):
+						counters['rules'][(chain, int(parts[0]))] = (packets, size)
+					elif target.startswith(MANAGED_CHAIN_PREFIX):
+						counters['chains'][target] = counters['chains'].get(target, 0) + packets
 			
-			with open(file_path, 'w') as f:
-				json.dump(rules_data, f, indent=2)
+			if self.ipset.available():
+				for name, info in self.ipset.save().items():
+					if info['counters']:
+						counters['elements'][name] = info['counters']
+		else:
+			for item in self.nftables.list(table_ref()):
+				definition = item.get('set') or item.get('map')
+				if definition and definition.get('name', '').startswith(MANAGED_CHAIN_PREFIX):
+					elements = {}
+					for element in definition.get('elem', []):
+						counter = element_counter(element)
+						if counter is not None:
+							elements[element_lookup_key(element)] = counter
+					if elements:
+						counters['elements'][definition['name']] = elements
+				rule_json = item.get('rule')
+				if not rule_json:
+					continue
+				counter = next((expr['counter'] for expr in rule_json.get('expr', [])
+				                if isinstance(expr.get('counter'), dict)), None)
+				if counter is None:
+					continue
+				chain = rule_json.get('chain') or ''
+				packets, size = counter.get('packets', 0), counter.get('bytes', 0)
+				if chain.startswith(MANAGED_CHAIN_PREFIX):
+					counters['rules'][(chain, rule_json.get('handle'))] = (packets, size)
+				else:
+					target = parse_nft_rule(rule_json).get('action') or ''
+					if target.startswith(MANAGED_CHAIN_PREFIX):
+						counters['chains'][target] = counters['chains'].get(target, 0) + packets
+		
+		return counters
+	
+	def sync_from_server(self):
+		"""从服务器同步现有规则：每种类型一次查询建立索引，批量插入/更新，整体一次提交"""
+		summary = {'added': 0, 'updated': 0, 'unchanged': 0, 'orphaned': 0, 'orphaned_ids': []}
+		
+		# 两个后端并发读取；数据库规则只对应IPv4 filter表
+		rulesets, errors = RulesetReader().read(('iptables', 'nftables'))
+		for backend, error in errors.items():
+			current_app.logger.error(f"Error getting {backend} rules: {error}")
+		
+		for rule_type, kernel_rules in rulesets.items():
+			# 读取失败的后端不参与比对，避免把其全部规则报告为孤立规则
+			if rule_type in errors:
+				continue
+			if rule_type == 'iptables':
+				kernel_rules = (rule_data for rule_data in kernel_rules if rule_data['table'] == 'filter')
+			kernel_rules = [rule_data for rule_data in map(self._unmanage_rule_data, kernel_rules) if rule_data]
+			result = self._sync_rules(rule_type, kernel_rules)
+			for key in summary:
+				summary[key] += result[key]
+		
+		db.session.commit()
+		return summary
+	
+	def _sync_rules(self, rule_type, kernel_rules):
+		"""将一种类型的内核规则与数据库比对，按匹配条件 (链, 签名) 索引"""
+		existing = {}
+		for rule in FirewallRule.query.filter_by(rule_type=rule_type).all():
+			existing.setdefault(self._sync_key(rule.chain, rule.protocol, rule.source, rule.destination, rule.port,
+			                                   rule.action), rule)
+		
+		new_rows = []
+		updates = []
+		seen = set()
+		unchanged = 0
+		for rule_data in kernel_rules:
+			key = self._sync_key(rule_data['chain'], rule_data['protocol'], rule_data['source'],
+			                     rule_data['destination'], rule_data['port'], rule_data['action'])
+			if key in seen:
+				continue
+			seen.add(key)
 			
-			return len(rules_data)
-		except Exception as e:
-			current_app.logger.error(f"Error exporting rules to file: {e}")
-			raise
+			rule = existing.get(key)
+			if rule is None:
+				new_rows.append({
+					'rule_type': rule_type,
+					'chain': rule_data['chain'],
+					'protocol': rule_data['protocol'] or 'all',
+					'source': rule_data['source'] or 'any',
+					'destination': rule_data['destination'] or 'any',
+					'port': rule_data['port'] or 'any',
+					'action': rule_data['action'],
+					'comment': rule_data['comment'] or '',
+					'priority': 100,  # 默认优先级
+					'enabled': True
+				})
+			elif rule_data['comment'] and rule_data['comment'] != rule.comment:
+				updates.append({'id': rule.id, 'comment': rule_data['comment']})
+			else:
+				unchanged += 1
+		
+		# 批量写入不触发flush事件，显式记录规则集代数
+		if new_rows or updates:
+			generation = bump_generation(db.session)
+			for row in new_rows + updates:
+				row['generation'] = generation
+		if new_rows:
+			db.session.bulk_insert_mappings(FirewallRule, new_rows)
+		if updates:
+			db.session.bulk_update_mappings(FirewallRule, updates)
+		
+		# 数据库中已启用、内核中没有的规则
+		orphaned_ids = [rule.id for key, rule in existing.items() if rule.enabled and key not in seen]
+		return {
+			'added': len(new_rows),
+			'updated': len(updates),
+			'unchanged': unchanged,
+			'orphaned': len(orphaned_ids),
+			'orphaned_ids': orphaned_ids
+		}
+	
+	@staticmethod
+	def _sync_key(chain, protocol, source, destination, port, action):
+		return (chain,) + rule_signature(protocol, source, destination, port, action)
+	
+	def _unmanage_rule_data(self, rule_data):
+		"""将受管链（包括分片子链）中的规则映射回基础链，跳过指向受管链的跳转和分发规则
+		
+		分片后同一规则可能在多条子链中各有一份，映射后键相同，比对时只计一次。
+		"""
+		if (rule_data.get('action') or '').startswith(MANAGED_CHAIN_PREFIX):
+			return None
+		# 引用编译集合的规则由数据库规则编译而来，不再反向同步
+		if any(str(rule_data.get(field) or '').startswith('@') for field in ('source', 'port', 'action')):
+			return None
+		chain = rule_data.get('chain') or ''
+		if chain.startswith(MANAGED_CHAIN_PREFIX):
+			rule_data = dict(rule_data, chain=base_chain(chain[len(MANAGED_CHAIN_PREFIX):]))
+		return rule_data
@@ -0,0 +1,211 @@
+# services/ipset_backend.py
+import os
+import subprocess
+from datetime import datetime
+from flask import current_app
+from models.rule import MANAGED_CHAIN_PREFIX, normalize_address
+from services.ruleset_cache import ruleset_cache
+from services.rule_compiler import RuleCompiler, CompiledGroup, SET_KIND_SOURCE, SET_KIND_PORT, \
+	SET_KIND_SOURCE_PORT, SET_KIND_TIMEOUT, set_kind, timeout_seconds
+
+# 集合名称末尾的类型代码
+IPSET_TYPES = {
+	'i': 'hash:ip',
+	'n': 'hash:net',
+	'j': 'hash:ip,port',
+	'k': 'hash:net,port',
+	'b': 'bitmap:port'
+}
+
+# ipset集合名称的最大长度；全量重载时临时集合使用 <名称>_t
+IPSET_NAME_MAXLEN = 31
+IPSET_TEMP_SUFFIX = '_t'
+
+# ipset默认的最大元素数
+IPSET_DEFAULT_MAXELEM = 65536
+
+# --match-set 的方向参数
+IPSET_MATCH_FLAGS = {
+	SET_KIND_SOURCE: 'src',
+	SET_KIND_PORT: 'dst',
+	SET_KIND_SOURCE_PORT: 'src,dst',
+	SET_KIND_TIMEOUT: 'src'
+}
+
+
+def ipset_type(name):
+	"""由编译集合名称末尾的类型代码得到ipset类型"""
+	return IPSET_TYPES[name[-1]]
+
+
+def ipset_element(kind, protocol, signature):
+	"""规则签名对应的ipset元素文本"""
+	if kind == SET_KIND_PORT:
+		return signature[3]
+	address = signature[1]
+	if address.endswith('/32'):
+		address = address[:-3]
+	if kind in (SET_KIND_SOURCE, SET_KIND_TIMEOUT):
+		return address
+	return f'{address},{protocol}:{signature[3]}'
+
+
+def ipset_element_key(element):
+	"""ipset元素的规范化键（ipset save 输出中主机地址不带/32）"""
+	parts = element.split(',')
+	parts[0] = normalize_address(parts[0]) if '.' in parts[0] else parts[0]
+	return ','.join(part.lower() for part in parts)
+
+
+def ipset_element_ref(rule):
+	"""规则在其编译集合中对应的ipset元素"""
+	kind = set_kind(rule.kernel_set[:-1])
+	return ipset_element(kind, (rule.protocol or 'all').lower(), rule.signature())
+
+
+class IpsetGroup(CompiledGroup):
+	"""编译为ipset的规则组：一条 -m set --match-set 规则 + 一个ipset集合"""
+	
+	@property
+	def set_type(self):
+		return ipset_type(self.name)
+	
+	def rule_elements(self):
+		"""逐条产出 (规则, 元素规范化键, ipset元素文本)"""
+		for rule in self.rules:
+			element = ipset_element(self.kind, self.protocol, rule.signature())
+			yield rule, ipset_element_key(element), element
+	
+	def iptables_rule_spec(self):
+		protocol, source, destination, port, action = self.fixed
+		spec = []
+		
+		if protocol != 'all':
+			spec.extend(['-p', protocol])
+		if self.kind == SET_KIND_PORT and source != 'any':
+			spec.extend(['-s', source])
+		if destination != 'any':
+			spec.extend(['-d', destination])
+		if self.kind in (SET_KIND_SOURCE, SET_KIND_TIMEOUT) and port != 'any':
+			spec.extend(['--dport', port.replace('-', ':')])
+		
+		spec.extend(['-m', 'set', '--match-set', self.name, IPSET_MATCH_FLAGS[self.kind]])
+		spec.extend(['-j', self.rules[0].action])
+		return spec
+
+
+class IpsetTimeoutGroup(IpsetGroup):
+	"""有效期未到的地址规则编译成的超时ipset（hash:net，创建时带 timeout 0），元素带剩余有效期"""
+	
+	def rule_elements(self):
+		now = datetime.utcnow()
+		for rule in self.rules:
+			address = ipset_element(self.kind, self.protocol, rule.signature())
+			yield rule, ipset_element_key(address), f'{address} timeout {timeout_seconds(rule, now)}'
+
+
+class IpsetRuleCompiler(RuleCompiler):
+	"""iptables后端的规则编译：源地址集合、端口集合和源地址,端口集合，不支持判决映射"""
+	
+	kinds = (SET_KIND_SOURCE, SET_KIND_PORT, SET_KIND_SOURCE_PORT)
+	# ipset save 会把端口范围展开成单个端口，端口元素只使用单个端口
+	port_ranges = False
+	
+	def _make_group(self, kind, chain, fixed, occurrence, rules):
+		hosts = all(rule.signature()[1].endswith('/32') for rule in rules)
+		if kind == SET_KIND_SOURCE:
+			code = 'i' if hosts else 'n'
+		elif kind == SET_KIND_SOURCE_PORT:
+			code = 'j' if hosts else 'k'
+		else:
+			code = 'b'
+		
+		name = self._set_name(chain, kind, fixed, occurrence) + code
+		if len(name) + len(IPSET_TEMP_SUFFIX) > IPSET_NAME_MAXLEN:
+			# 链名过长时省略链名，摘要中已包含链
+			name = self._set_name('', kind, (chain,) + fixed, occurrence) + code
+		return IpsetGroup(kind, chain, name, rules)
+	
+	def _make_timeout_group(self, chain, fixed, rules):
+		name = self._set_name(chain, SET_KIND_TIMEOUT, fixed, 1) + 'n'
+		if len(name) + len(IPSET_TEMP_SUFFIX) > IPSET_NAME_MAXLEN:
+			name = self._set_name('', SET_KIND_TIMEOUT, (chain,) + fixed, 1) + 'n'
+		return IpsetTimeoutGroup(SET_KIND_TIMEOUT, chain, name, rules)
+
+
+class IpsetBackend:
+	"""通过 ipset restore 批量管理编译集合"""
+	
+	def __init__(self, ipset_path=None):
+		self.ipset_path = ipset_path or current_app.config.get('IPSET_PATH', '/sbin/ipset')
+	
+	def available(self):
+		return os.access(self.ipset_path, os.X_OK)
+	
+	def restore(self, lines):
+		"""通过一次 ipset restore 提交命令"""
+		ruleset_cache.invalidate()
+		try:
+			subprocess.run([self.ipset_path, 'restore', '-exist'], input='\n'.join(lines) + '\n', check=True,
+			               capture_output=True, text=True)
+		except subprocess.CalledProcessError as e:
+			current_app.logger.error(f"Error restoring ipsets: {e.stderr}")
+			raise Exception(f"Failed to restore ipsets: {e.stderr}")
+	
+	def save(self):
+		"""读取受管集合：名称 -> {'type', 'maxelem', 'elements': 规范化键 -> 元素}"""
+		return self.parse_save(self.dump())
+	
+	def dump(self):
+		"""ipset save 的原始输出"""
+		try:
+			return subprocess.run([self.ipset_path, 'save'], check=True, capture_output=True, text=True).stdout
+		except subprocess.CalledProcessError as e:
+			current_app.logger.error(f"Error listing ipsets: {e.stderr}")
+			raise Exception(f"Failed to list ipsets: {e.stderr}")
+	
+	@staticmethod
+	def parse_save(output):
+		"""解析 ipset save 输出中的受管集合"""
+		sets = {}
+		for line in output.splitlines():
+			parts = line.split()
+			if len(parts) < 3 or not parts[1].startswith(MANAGED_CHAIN_PREFIX):
+				continue
+			if parts[0] == 'create':
+				options = parts[3:]
+				sets[parts[1]] = {
+					'type': parts[2],
+					'maxelem': int(options[options.index('maxelem') + 1]) if 'maxelem' in options[:-1]
+					else IPSET_DEFAULT_MAXELEM,
+					'elements': {},
+					'counters': {}
+				}
+			elif parts[0] == 'add' and parts[1] in sets:
+				key = ipset_element_key(parts[2])
+				sets[parts[1]]['elements'][key] = parts[2]
+				# 带 counters 创建的集合，每个元素后附 packets N bytes M
+				options = parts[3:]
+				if 'packets' in options[:-1] and 'bytes' in options[:-1]:
+					sets[parts[1]]['counters'][key] = (int(options[options.index('packets') + 1]),
+					                                   int(options[options.index('bytes') + 1]))
+		return sets
+	
+	def render_create(self, name, set_type, size, timeout=False):
+		"""创建集合的命令：元素带计数器，按规则统计命中次数；timeout为True时集合支持元素超时（各元素单独指定）"""
+		if set_type == 'bitmap:port':
+			return f'create {name} {set_type} range 0-65535 counters'
+		line = f'create {name} {set_type} family inet maxelem {max(IPSET_DEFAULT_MAXELEM, size * 2)}'
+		return line + (' timeout 0 counters' if timeout else ' counters')
+	
+	def render_set(self, name, set_type, elements, full_reload=False, timeout=False):
+		"""渲染集合的完整内容：新集合直接创建并填充；全量重载时填充临时集合后swap，内核中始终有完整的集合"""
+		if not full_reload:
+			return [self.render_create(name, set_type, len(elements), timeout)] + [
+				f'add {name} {element}' for element in elements.values()]
+		
+		temp = name + IPSET_TEMP_SUFFIX
+		lines = [self.render_create(temp, set_type, len(elements), timeout), f'flush {temp}']
+		lines.extend(f'add {temp} {element}' for element in elements.values())
+		lines.extend([f'swap {temp} {name}', f'destroy {temp}'])
+		return lines
@@ -0,0 +1,168 @@
+# services/job_queue.py
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from models import db, Job
+from models.job import JOB_PENDING, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED
+
+# 同一任务进度推送的最小间隔（秒），开始和结束时总会推送
+JOB_PROGRESS_INTERVAL = 0.5
+
+# 所有修改内核规则集或规则表的操作共用的锁
+RULESET_LOCK = 'ruleset'
+
+
+class JobContext:
+	"""传给任务函数的上下文，用于上报进度"""
+	
+	def __init__(self, queue, job_id):
+		self.queue = queue
+		self.job_id = job_id
+	
+	def progress(self, percent=None, message=None):
+		self.queue.report(self.job_id, percent, message)
+
+
+class JobQueue:
+	"""后台任务队列：线程池执行耗时操作，任务记录持久化到数据库，进度通过SocketIO推送
+	
+	任务运行在独立的应用上下文中，使用各自的数据库会话。运行中的进度只保存在内存中
+	（避免在任务自己的事务之外另开写事务），结束时连同结果一起写入任务记录。
+	lock相同的任务串行执行，例如所有修改规则集的任务共用一个锁；同步执行的修改通过
+	exclusive() 持有同一个锁，与任务互斥。
+	"""
+	
+	def __init__(self):
+		self.app = None
+		self.socketio = None
+		self.executor = None
+		# 任务id -> [进度, 消息, 上次推送时间]
+		self.running = {}
+		self.locks = {}
+		self._state_lock = threading.Lock()
+	
+	def init_app(self, app, socketio=None):
+		self.app = app
+		self.socketio = socketio
+		self.executor = ThreadPoolExecutor(max_workers=app.config.get('JOB_WORKERS', 2),
+		                                   thread_name_prefix='job-worker')
+	
+	def submit(self, job_type, func, lock=None):
+		"""创建任务记录并加入队列，立即返回任务；func接收JobContext，返回值须可JSON序列化"""
+		job = Job(id=uuid.uuid4().hex, job_type=job_type, status=JOB_PENDING, progress=0, message='Queued')
+		db.session.add(job)
+		db.session.commit()
+		
+		self.executor.submit(self._run, job.id, func, lock)
+		return job
+	
+	def get(self, job_id):
+		"""查询任务；运行中的任务附带内存中的最新进度"""
+		job = Job.query.get(job_id)
+		if job is None:
+			return None
+		data = job.to_dict()
+		state = self.running.get(job_id)
+		if state is not None and job.status == JOB_RUNNING:
+			data['progress'], data['message'] = state[0], state[1]
+		return data
+	
+	def fail_interrupted(self):
+		"""将上次进程退出时未完成的任务标记为失败"""
+		count = Job.query.filter(Job.status.in_((JOB_PENDING, JOB_RUNNING))).update({
+			'status': JOB_FAILED,
+			'error': 'Interrupted by server restart',
+			'finished_at': datetime.utcnow()
+		}, synchronize_session=False)
+		db.session.commit()
+		return count
+	
+	def report(self, job_id, percent=None, message=None):
+		"""更新运行中任务的进度，按间隔节流推送"""
+		state = self.running.get(job_id)
+		if state is None:
+			return
+		if percent is not None:
+			state[0] = round(min(max(percent, 0), 100), 1)
+		if message is not None:
+			state[1] = message
+		
+		now = time.time()
+		if now - state[2] >= JOB_PROGRESS_INTERVAL:
+			state[2] = now
+			self._emit({'id': job_id, 'status': JOB_RUNNING, 'progress': state[0], 'message': state[1]})
+	
+	@contextmanager
+	def exclusive(self, name):
+		"""在当前线程持有与同名任务相同的锁，也可用作装饰器"""
+		with self._lock(name):
+			yield
+	
+	def _lock(self, name):
+		with self._state_lock:
+			# 可重入：持有锁的操作内部调用的同样加锁的函数不会自锁
+			return self.locks.setdefault(name, threading.RLock())
+	
+	def _run(self, job_id, func, lock):
+		with self.app.app_context():
+			try:
+				if lock:
+					with self._lock(lock):
+						self._execute(job_id, func)
+				else:
+					self._execute(job_id, func)
+			finally:
+				self.running.pop(job_id, None)
+				db.session.remove()
+	
+	def _execute(self, job_id, func):
+		job = Job.query.get(job_id)
+		job.status = JOB_RUNNING
+		job.message = 'Running'
+		job.started_at = datetime.utcnow()
+		db.session.commit()
+		self.running[job_id] = [0, job.message, time.time()]
+		self._emit(job.to_dict())
+		
+		try:
+			result = func(JobContext(self, job_id))
+		except Exception as e:
+			self.app.logger.error(f"Error running {job.job_type} job {job_id}: {e}")
+			# 任务的未提交修改已无效，回滚后再记录失败
+			db.session.rollback()
+			self._finish(job_id, JOB_FAILED, error=str(e))
+			return
+		
+		db.session.rollback()
+		self._finish(job_id, JOB_SUCCEEDED, result=result)
+	
+	def _finish(self, job_id, status, result=None, error=None):
+		job = Job.query.get(job_id)
+		state = self.running.get(job_id)
+		job.status = status
+		job.progress = 100 if status == JOB_SUCCEEDED else (state[0] if state else job.progress)
+		if status == JOB_SUCCEEDED:
+			job.message = state[1] if state and state[1] != 'Running' else 'Completed'
+		else:
+			# 失败时最后上报的进度消息已不再准确
+			job.message = 'Failed'
+		job.result = json.dumps(result) if result is not None else None
+		job.error = error
+		job.finished_at = datetime.utcnow()
+		db.session.commit()
+		self._emit(job.to_dict())
+	
+	def _emit(self, data):
+		if self.socketio:
+			try:
+				self.socketio.emit('job_update', data)
+			except Exception as e:
+				self.app.logger.error(f"Error broadcasting job update: {e}")
+
+
+# 应用内共享的任务队列，由 app.py 初始化
+job_queue = JobQueue()
@@ -0,0 +1,137 @@
+# services/nftables_backend.py
+import json
+import subprocess
+import threading
+from flask import current_app
+from services.ruleset_cache import ruleset_cache
+
+try:
+	# libnftables的Python绑定（可选，随nftables软件包提供）
+	import nftables
+except ImportError:
+	nftables = None
+
+# nftables JSON命令的默认表
+NFTABLES_FAMILY = 'ip'
+NFTABLES_TABLE = 'filter'
+
+# 进程内共享的libnftables上下文，避免每批命令都重新创建
+_context = None
+_context_lock = threading.Lock()
+
+
+def rule_ref(chain, handle):
+	"""引用指定句柄规则的JSON对象"""
+	return {'rule': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'chain': chain, 'handle': handle}}
+
+
+def table_ref():
+	"""默认filter表的JSON对象"""
+	return {'table': {'family': NFTABLES_FAMILY, 'name': NFTABLES_TABLE}}
+
+
+def chain_ref(chain, hook=None):
+	"""链的JSON对象；指定hook时创建为基础链"""
+	chain_obj = {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'name': chain}
+	if hook:
+		chain_obj.update({'type': 'filter', 'hook': hook, 'prio': 0})
+	return {'chain': chain_obj}
+
+
+def jump_rule(chain, target):
+	"""从chain跳转到target的规则对象"""
+	return {'rule': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'chain': chain,
+	                 'expr': [{'counter': {'packets': 0, 'bytes': 0}}, {'jump': {'target': target}}]}}
+
+
+class NftablesBackend:
+	"""通过libnftables JSON API提交nftables命令
+	
+	优先使用进程内长期存在的libnftables上下文；未安装Python绑定时，
+	每批命令通过一次 nft -j -f - 调用提交。同一批命令在一个事务中生效。
+	"""
+	
+	def __init__(self, nftables_path=None):
+		self.nftables_path = nftables_path or current_app.config.get('NFTABLES_PATH', '/sbin/nft')
+	
+	def run(self, commands, echo=False):
+		"""提交一批JSON命令，返回输出中的对象列表（echo时包含新对象的句柄）"""
+		payload = {'nftables': [{'metainfo': {'json_schema_version': 1}}] + list(commands)}
+		if any('list' not in command for command in payload['nftables'][1:]):
+			ruleset_cache.invalidate()
+		
+		if nftables is not None:
+			return self._run_libnftables(payload, echo)
+		return self._run_cli(payload, echo)
+	
+	def list(self, target):
+		"""列出对象，例如 table_ref() 或 {'ruleset': None}"""
+		return self.run([{'list': target}])
+	
+	def dump(self):
+		"""整个规则集的JSON文本，省略计数器等状态信息（规则集不变时输出不变）"""
+		global _context
+		
+		if nftables is not None:
+			with _context_lock:
+				if _context is None:
+					_context = nftables.Nftables()
+					_context.set_json_output(True)
+				_context.set_stateless_output(True)
+				try:
+					rc, output, error = _context.cmd('list ruleset')
+				finally:
+					_context.set_stateless_output(False)
+			if rc != 0:
+				current_app.logger.error(f"Error listing nftables ruleset: {error}")
+				raise Exception(f"Failed to list nftables ruleset: {error}")
+			return output
+		
+		try:
+			return subprocess.run([self.nftables_path, '-j', '-s', 'list', 'ruleset'], check=True,
+			                      capture_output=True, text=True).stdout
+		except subprocess.CalledProcessError as e:
+			current_app.logger.error(f"Error listing nftables ruleset: {e.stderr}")
+			raise Exception(f"Failed to list nftables ruleset: {e.stderr}")
+	
+	def _run_libnftables(self, payload, echo):
+		global _context
+		
+		with _context_lock:
+			if _context is None:
+				_context = nftables.Nftables()
+				_context.set_json_output(True)
+			_context.set_echo_output(echo)
+			_context.set_handle_output(echo)
+			rc, output, error = _context.json_cmd(payload)
+		
+		if rc != 0:
+			current_app.logger.error(f"Error running nftables commands: {error}")
+			raise Exception(f"nftables commands failed: {error}")
+		return (output or {}).get('nftables', [])
+	
+	def _run_cli(self, payload, echo):
+		cmd = [self.nftables_path, '-j']
+		if echo:
+			cmd.extend(['--echo', '--handle'])
+		cmd.extend(['-f', '-'])
+		
+		try:
+			result = subprocess.run(cmd, input=json.dumps(payload), check=True, capture_output=True, text=True)
+		except subprocess.CalledProcessError as e:
+			current_app.logger.error(f"Error running nftables commands: {e.stderr}")
+			raise Exception(f"nftables commands failed: {e.stderr}")
+		
+		if not result.stdout.strip():
+			return []
+		return json.loads(result.stdout).get('nftables', [])
+	
+	@staticmethod
+	def echo_handles(items):
+		"""按顺序提取echo输出中新增规则的句柄"""
+		handles = []
+		for item in items:
+			for verb in ('add', 'insert'):
+				if 'rule' in (item.get(verb) or {}):
+					handles.append(item[verb]['rule'].get('handle'))
+		return handles
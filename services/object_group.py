@@ -0,0 +1,312 @@
+# services/object_group.py
+import re
+from flask import current_app
+from sqlalchemy import or_
+from models import db, FirewallRule, ObjectGroup, ObjectGroupMember
+from models.rule import MANAGED_CHAIN_PREFIX, OBJECT_GROUP_FIELDS, object_group_name, object_group_refs, \
+	normalize_address, normalize_port, bump_generation, _nft_address, _nft_port
+from services.nftables_backend import NFTABLES_FAMILY, NFTABLES_TABLE
+from services.rule_compiler import element_key, _address_key, _port_interval, _PrefixIndex, _IntervalIndex
+from services.ipset_backend import ipset_element_key
+
+# 对象组名称：字母开头，加上集合名称前缀和ipset临时集合后缀后不超过ipset名称的长度限制
+OBJECT_GROUP_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_]{0,19}$')
+
+# 对象组类型 -> ipset类型
+OBJECT_GROUP_IPSET_TYPES = {
+	'address': 'hash:net',
+	'port': 'bitmap:port'
+}
+
+# 对象组类型 -> nftables集合元素类型
+OBJECT_GROUP_NFT_TYPES = {
+	'address': 'ipv4_addr',
+	'port': 'inet_service'
+}
+
+
+def validate_group(name, group_type):
+	"""校验对象组名称和类型，返回错误信息"""
+	if not isinstance(name, str) or not OBJECT_GROUP_NAME.match(name) or name.startswith(MANAGED_CHAIN_PREFIX):
+		return f'Invalid group name: {name}'
+	if group_type not in OBJECT_GROUP_IPSET_TYPES:
+		return f'Invalid group_type: {group_type}'
+	return None
+
+
+def normalize_member(group_type, value):
+	"""校验并规范化一个成员：IPv4地址/网段，或端口/端口范围；无效时抛出ValueError"""
+	value = str(value).strip()
+	if group_type == 'address':
+		if _address_key(value) is None:
+			raise ValueError(f'Invalid address: {value}')
+		return normalize_address(value)
+	
+	port = normalize_port(value)
+	interval = _port_interval(port)
+	if interval is None or not 0 <= interval[0] <= interval[1] <= 65535:
+		raise ValueError(f'Invalid port: {value}')
+	return port
+
+
+def validate_object_group_refs(data):
+	"""规则字段中的 @组名 须引用已存在且类型匹配的对象组，返回错误信息"""
+	for field, group_type in OBJECT_GROUP_FIELDS.items():
+		name = object_group_name(data.get(field))
+		if name is None:
+			continue
+		group = ObjectGroup.query.filter_by(name=name).first()
+		if group is None:
+			return f'Unknown object group: @{name}'
+		if group.group_type != group_type:
+			return f'Object group @{name} cannot be used as {field}'
+	return None
+
+
+class MemberIndex:
+	"""成员的重叠检查：区间集合中完全相同的成员只保留一个，部分重叠的成员不能同时加入"""
+	
+	def __init__(self, group_type, values=()):
+		self.group_type = group_type
+		self.index = _PrefixIndex() if group_type == 'address' else _IntervalIndex()
+		self.values = set()
+		for value in values:
+			self.add(value)
+	
+	def _key(self, value):
+		return _address_key(value) if self.group_type == 'address' else _port_interval(value)
+	
+	def overlaps(self, value):
+		return value not in self.values and self.index.overlaps(self._key(value))
+	
+	def add(self, value):
+		if value not in self.values:
+			self.values.add(value)
+			self.index.add(self._key(value))
+
+
+class ObjectGroupSet:
+	"""对象组在一个后端中的集合：nftables命名集合或ipset，成员即集合元素
+	
+	与编译集合一起参与协调（没有种类、链和规则），集合名称只由组类型和组名决定，
+	成员变化时名称不变，引用它的规则也不变。
+	"""
+	
+	kind = None
+	chain = None
+	rules = ()
+	
+	def __init__(self, group, rule_type, members):
+		self.group_type = group.group_type
+		self.rule_type = rule_type
+		self.name = group.kernel_name
+		self.members = members
+	
+	@property
+	def set_type(self):
+		return OBJECT_GROUP_IPSET_TYPES[self.group_type]
+	
+	def kernel_element(self, value):
+		"""单个成员的集合元素：nftables JSON，或ipset元素文本（端口范围整体增删）"""
+		if self.rule_type == 'iptables':
+			return value[:-3] if value.endswith('/32') else value
+		return _nft_address(value) if self.group_type == 'address' else _nft_port(value)
+	
+	def elements(self):
+		"""规范化键 -> 集合元素，与内核中列出的元素比对（ipset save 把端口范围展开为单个端口）"""
+		elements = {}
+		for value in self.members:
+			if self.rule_type != 'iptables':
+				element = self.kernel_element(value)
+				elements[element_key(element)] = element
+			elif self.group_type == 'port':
+				start, end = _port_interval(value)
+				elements.update((str(port), str(port)) for port in range(start, end + 1))
+			else:
+				element = self.kernel_element(value)
+				elements[ipset_element_key(element)] = element
+		return elements
+	
+	def set_object(self):
+		return {'set': {
+			'family': NFTABLES_FAMILY,
+			'table': NFTABLES_TABLE,
+			'name': self.name,
+			'type': OBJECT_GROUP_NFT_TYPES[self.group_type],
+			'flags': ['interval']
+		}}
+
+
+def group_members(group_ids):
+	"""对象组id -> 按添加顺序排列的成员"""
+	members = {}
+	rows = db.session.query(ObjectGroupMember.group_id, ObjectGroupMember.value).filter(
+		ObjectGroupMember.group_id.in_(group_ids)).order_by(ObjectGroupMember.id)
+	for group_id, value in rows:
+		members.setdefault(group_id, []).append(value)
+	return members
+
+
+def object_group_sets(rule_type, rules):
+	"""规则引用的对象组在该后端中的集合（含全部成员），按名称排列"""
+	refs = {(group_type, name) for rule in rules for _, group_type, name in object_group_refs(rule)}
+	if not refs:
+		return []
+	
+	groups = ObjectGroup.query.filter(ObjectGroup.name.in_({name for _, name in refs})).order_by(ObjectGroup.name)
+	groups = [group for group in groups if (group.group_type, group.name) in refs]
+	members = group_members([group.id for group in groups])
+	return [ObjectGroupSet(group, rule_type, members.get(group.id, [])) for group in groups]
+
+
+class ObjectGroupService:
+	"""对象组的增删改：成员变化时只对内核中已有该组集合的后端逐元素增删，不重建引用它的规则
+	
+	内核中还没有的对象组集合在第一次写入引用它的规则时创建（FirewallManager.ensure_object_group_sets），
+	协调器把被引用的对象组集合作为期望集合，不再被引用的集合随之移除。
+	"""
+	
+	def __init__(self, firewall_manager):
+		self.firewall_manager = firewall_manager
+	
+	def members(self, group):
+		return group_members([group.id]).get(group.id, [])
+	
+	def create(self, name, group_type, description=None, members=()):
+		error = validate_group(name, group_type)
+		if error:
+			raise ValueError(error)
+		if ObjectGroup.query.filter_by(name=name).first():
+			raise ValueError(f'Object group already exists: {name}')
+		
+		values = self._normalize(group_type, members)
+		group = ObjectGroup(name=name, group_type=group_type, description=description)
+		db.session.add(group)
+		db.session.flush()
+		db.session.bulk_insert_mappings(ObjectGroupMember, [{'group_id': group.id, 'value': value} for value in values])
+		db.session.commit()
+		return group
+	
+	def add_members(self, group, values):
+		"""添加成员，返回实际新增的成员（已存在的忽略）"""
+		existing = self.members(group)
+		index = MemberIndex(group.group_type, existing)
+		added = []
+		for value in self._normalize(group.group_type, values):
+			if value in index.values:
+				continue
+			if index.overlaps(value):
+				raise ValueError(f'Member {value} overlaps an existing member of {group.name}')
+			index.add(value)
+			added.append(value)
+		
+		self._update(group, added, [])
+		return added
+	
+	def remove_members(self, group, values):
+		"""删除成员，返回实际删除的成员（不存在的忽略）"""
+		existing = set(self.members(group))
+		removed = [value for value in dict.fromkeys(normalize_member(group.group_type, value) for value in values)
+		           if value in existing]
+		self._update(group, [], removed)
+		return removed
+	
+	def replace_members(self, group, values):
+		"""以新的成员列表替换，只增删有差异的成员，返回 (新增, 删除)"""
+		desired = self._normalize(group.group_type, values)
+		existing = self.members(group)
+		desired_values = set(desired)
+		existing_values = set(existing)
+		added = [value for value in desired if value not in existing_values]
+		removed = [value for value in existing if value not in desired_values]
+		self._update(group, added, removed)
+		return added, removed
+	
+	def delete(self, group):
+		"""删除未被规则引用的对象组及其内核集合"""
+		reference = f'@{group.name}'
+		if FirewallRule.query.filter(or_(FirewallRule.source == reference, FirewallRule.destination == reference,
+		                                 FirewallRule.port == reference)).first():
+			raise ValueError(f'Object group {group.name} is referenced by rules')
+		
+		for rule_type in self._loaded_backends(group):
+			try:
+				if rule_type == 'iptables':
+					self.firewall_manager.ipset.restore([f'destroy {group.kernel_name}'])
+				else:
+					self.firewall_manager.nftables.run([{'delete': ObjectGroupSet(group, rule_type, []).set_object()}])
+			except Exception as e:
+				# 集合仍被内核中的其他规则引用时保留，由下一次协调移除
+				current_app.logger.warning(f"Error removing {rule_type} set {group.kernel_name}: {e}")
+		
+		ObjectGroupMember.query.filter_by(group_id=group.id).delete(synchronize_session=False)
+		db.session.delete(group)
+		db.session.commit()
+	
+	def _normalize(self, group_type, values):
+		"""校验并规范化成员列表，去除重复；列表内部分重叠的成员抛出ValueError"""
+		index = MemberIndex(group_type)
+		normalized = []
+		for value in values:
+			value = normalize_member(group_type, value)
+			if value in index.values:
+				continue
+			if index.overlaps(value):
+				raise ValueError(f'Member {value} overlaps another member')
+			index.add(value)
+			normalized.append(value)
+		return normalized
+	
+	def _update(self, group, added, removed):
+		"""写入成员变化：每个已加载该组集合的后端一次元素增删，成功后提交"""
+		if not added and not removed:
+			return
+		
+		if removed:
+			ObjectGroupMember.query.filter(ObjectGroupMember.group_id == group.id,
+			                               ObjectGroupMember.value.in_(removed)).delete(synchronize_session=False)
+		if added:
+			db.session.bulk_insert_mappings(ObjectGroupMember, [{'group_id': group.id, 'value': value}
+			                                                    for value in added])
+		# 引用该组的规则的内核期望状态随之变化
+		bump_generation(db.session)
+		
+		try:
+			for rule_type in self._loaded_backends(group):
+				self._apply_elements(ObjectGroupSet(group, rule_type, []), added, removed)
+		except Exception:
+			db.session.rollback()
+			raise
+		db.session.commit()
+	
+	def _apply_elements(self, group_set, added, removed):
+		name = group_set.name
+		try:
+			if group_set.rule_type == 'iptables':
+				lines = [f'del {name} {group_set.kernel_element(value)}' for value in removed]
+				lines.extend(f'add {name} {group_set.kernel_element(value)}' for value in added)
+				self.firewall_manager.ipset.restore(lines)
+				return
+			
+			commands = []
+			for verb, values in (('delete', removed), ('add', added)):
+				if values:
+					commands.append({verb: {'element': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'name': name,
+					                                    'elem': [group_set.kernel_element(value) for value in values]}}})
+			self.firewall_manager.nftables.run(commands)
+		except Exception as e:
+			current_app.logger.error(f"Error updating {group_set.rule_type} set {name}: {e}")
+			raise Exception(f"Failed to update {group_set.rule_type} set {name}: {e}")
+	
+	def _loaded_backends(self, group):
+		"""内核中已有该对象组集合的后端"""
+		backends = []
+		for rule_type in ('nftables', 'iptables'):
+			try:
+				names = self.firewall_manager.live_set_names(rule_type)
+			except Exception:
+				# 后端不可用
+				continue
+			if group.kernel_name in names:
+				backends.append(rule_type)
+		return backends
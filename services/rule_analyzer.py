@@ -0,0 +1,245 @@
+# services/rule_analyzer.py
+import bisect
+from collections import namedtuple
+from models import FirewallRule
+from models.rule import normalize_port
+from services.rule_compiler import _address_key, _port_interval
+
+# 命中后不再继续匹配后续规则的动作；LOG和跳转到自定义链的规则不会遮蔽后续规则
+TERMINAL_ACTIONS = ('ACCEPT', 'DROP', 'REJECT', 'RETURN')
+
+ANY_ADDRESS = (0, 0)
+ANY_PORTS = (0, 65535)
+
+# 规则的匹配空间：协议、源/目标网段的 (前缀长度, 网络号) 键、目标端口闭区间
+RuleSpace = namedtuple('RuleSpace', ['protocol', 'source', 'destination', 'ports'])
+
+
+def rule_space(rule):
+	"""规则的匹配空间；地址不是IPv4网段或端口无法解析时返回None"""
+	protocol = (rule.protocol or 'all').lower()
+	source_key = _network_key(rule.source)
+	destination_key = _network_key(rule.destination)
+	port = normalize_port(rule.port)
+	ports = ANY_PORTS
+	if protocol in ('tcp', 'udp') and port != 'any':
+		ports = _port_interval(port)
+	if source_key is None or destination_key is None or ports is None:
+		return None
+	return RuleSpace(protocol, source_key, destination_key, ports)
+
+
+def _network_key(value):
+	if not value or value == 'any':
+		return ANY_ADDRESS
+	return _address_key(value)
+
+
+def prefix_covers(outer, inner):
+	return outer[0] <= inner[0] and inner[1] >> (inner[0] - outer[0]) == outer[1]
+
+
+def prefix_ancestors(key):
+	"""网段及其所有上级网段的键"""
+	prefixlen, number = key
+	return [(length, number >> (prefixlen - length)) for length in range(prefixlen + 1)]
+
+
+def space_covers(outer, inner):
+	"""outer的匹配空间是否包含inner"""
+	return (outer.protocol == 'all' or outer.protocol == inner.protocol) and \
+	       prefix_covers(outer.source, inner.source) and \
+	       prefix_covers(outer.destination, inner.destination) and \
+	       outer.ports[0] <= inner.ports[0] and outer.ports[1] >= inner.ports[1]
+
+
+def spaces_overlap(a, b):
+	"""两个匹配空间是否有交集（网段重叠当且仅当其中一个包含另一个）"""
+	return (a.protocol == 'all' or b.protocol == 'all' or a.protocol == b.protocol) and \
+	       (prefix_covers(a.source, b.source) or prefix_covers(b.source, a.source)) and \
+	       (prefix_covers(a.destination, b.destination) or prefix_covers(b.destination, a.destination)) and \
+	       a.ports[0] <= b.ports[1] and b.ports[0] <= a.ports[1]
+
+
+class IntervalTree:
+	"""静态中心区间树，查询与给定闭区间重叠的条目，O(log n + k)"""
+	
+	def __init__(self, entries):
+		"""entries为 (下界, 上界, 数据) 列表"""
+		endpoints = sorted(point for entry in entries for point in entry[:2])
+		self.center = endpoints[len(endpoints) // 2]
+		here = [entry for entry in entries if entry[0] <= self.center <= entry[1]]
+		left = [entry for entry in entries if entry[1] < self.center]
+		right = [entry for entry in entries if entry[0] > self.center]
+		
+		self.by_low = sorted(here, key=lambda entry: entry[0])
+		self.by_high = sorted(here, key=lambda entry: entry[1], reverse=True)
+		self.left = IntervalTree(left) if left else None
+		self.right = IntervalTree(right) if right else None
+	
+	def overlapping(self, low, high):
+		results = []
+		node = self
+		stack = []
+		while node is not None:
+			if high < node.center:
+				for entry in node.by_low:
+					if entry[0] > high:
+						break
+					results.append(entry[2])
+				node = node.left
+			elif low > node.center:
+				for entry in node.by_high:
+					if entry[1] < low:
+						break
+					results.append(entry[2])
+				node = node.right
+			else:
+				results.extend(entry[2] for entry in node.by_low)
+				if node.right is not None:
+					stack.append(node.right)
+				node = node.left
+			if node is None and stack:
+				node = stack.pop()
+		return results
+
+
+class _NetworkIndex:
+	"""IPv4网段索引：上级网段按前缀逐级查找，下级网段按地址区间二分查找"""
+	
+	def __init__(self, keys):
+		self.keys = set(keys)
+		self.ranges = sorted((number << (32 - prefixlen), (prefixlen, number)) for prefixlen, number in self.keys)
+		self.starts = [start for start, key in self.ranges]
+	
+	def related(self, key):
+		"""与key重叠的网段：key本身、上级网段和下级网段"""
+		related = [ancestor for ancestor in prefix_ancestors(key) if ancestor in self.keys]
+		prefixlen, number = key
+		start = number << (32 - prefixlen)
+		end = start + (1 << (32 - prefixlen)) - 1
+		for index in range(bisect.bisect_left(self.starts, start), bisect.bisect_right(self.starts, end)):
+			other = self.ranges[index][1]
+			if other[0] > prefixlen:
+				related.append(other)
+		return related
+
+
+class ChainIndex:
+	"""一条链中终止规则的索引：源网段 -> 目标网段 -> 端口区间树
+	
+	网段通过 _NetworkIndex 只访问与查询规则重叠的桶，端口通过区间树查找。
+	"""
+	
+	def __init__(self, entries):
+		"""entries为 (顺序号, 规则, 匹配空间) 列表"""
+		buckets = {}
+		for entry in entries:
+			space = entry[2]
+			buckets.setdefault(space.source, {}).setdefault(space.destination, []).append(
+				(space.ports[0], space.ports[1], entry))
+		
+		self.buckets = {
+			source: {destination: IntervalTree(items) for destination, items in destinations.items()}
+			for source, destinations in buckets.items()
+		}
+		self.sources = _NetworkIndex(self.buckets)
+		self.destinations = {source: _NetworkIndex(destinations) for source, destinations in self.buckets.items()}
+	
+	def overlapping(self, space):
+		"""与匹配空间在地址和端口上重叠的条目（协议由调用方判断）"""
+		results = []
+		for source in self.sources.related(space.source):
+			destinations = self.buckets[source]
+			for destination in self.destinations[source].related(space.destination):
+				results.extend(destinations[destination].overlapping(*space.ports))
+		return results
+
+
+class RuleAnalyzer:
+	"""规则遮蔽/冗余/冲突分析
+	
+	按链和求值顺序（priority, id）分析启用的规则：
+	- shadowed：被前面动作不同的规则完全覆盖，永远不会命中；
+	- redundant：被前面动作相同的规则完全覆盖，可以删除；
+	- conflicts：与前面动作不同的规则部分重叠（互不包含），结果依赖规则顺序。
+	"""
+	
+	def analyze(self, rule_type='all', chain=None):
+		query = FirewallRule.query.filter_by(enabled=True)
+		if rule_type != 'all':
+			query = query.filter_by(rule_type=rule_type)
+		if chain:
+			query = query.filter_by(chain=chain)
+		rules = query.order_by(FirewallRule.priority, FirewallRule.id).all()
+		
+		chains = {}
+		for rule in rules:
+			chains.setdefault((rule.rule_type, rule.chain), []).append(rule)
+		
+		results = [self.analyze_chain(chain_rules) for chain_rules in chains.values()]
+		summary = {'rules': len(rules), 'shadowed': 0, 'redundant': 0, 'conflicts': 0, 'skipped': 0}
+		for result in results:
+			for key in ('shadowed', 'redundant', 'conflicts'):
+				summary[key] += len(result[key])
+			summary['skipped'] += len(result['skipped'])
+		
+		return {'summary': summary, 'chains': results}
+	
+	def analyze_chain(self, rules):
+		"""分析一条链中按求值顺序排列的规则"""
+		spaces = [rule_space(rule) for rule in rules]
+		terminal = [(rule.action or '').upper() in TERMINAL_ACTIONS for rule in rules]
+		
+		# 匹配空间完全相同的规则只索引第一条，其余直接判定为被其覆盖
+		first_seen = {}
+		for index, space in enumerate(spaces):
+			if space is not None and terminal[index]:
+				first_seen.setdefault(space, index)
+		index = ChainIndex([(position, rules[position], spaces[position]) for position in first_seen.values()])
+		
+		covered_by = {}
+		result = {
+			'rule_type': rules[0].rule_type,
+			'chain': rules[0].chain,
+			'rules': len(rules),
+			'shadowed': [],
+			'redundant': [],
+			'conflicts': [],
+			'skipped': []
+		}
+		
+		for position, (rule, space) in enumerate(zip(rules, spaces)):
+			if space is None:
+				result['skipped'].append(rule.id)
+				continue
+			
+			cover = None
+			conflicts = []
+			duplicate = first_seen.get(space)
+			if duplicate is not None and duplicate < position:
+				cover = covered_by.get(duplicate, duplicate)
+			else:
+				for earlier, other, other_space in index.overlapping(space):
+					if earlier >= position or earlier in covered_by:
+						continue
+					if other_space.protocol != 'all' and space.protocol != 'all' and \
+							other_space.protocol != space.protocol:
+						continue
+					if space_covers(other_space, space):
+						if cover is None or earlier < cover:
+							cover = earlier
+					elif terminal[position] and not space_covers(space, other_space) and \
+							other.action.upper() != rule.action.upper():
+						conflicts.append(other)
+			
+			if cover is not None:
+				covered_by[position] = cover
+				other = rules[cover]
+				kind = 'redundant' if other.action.upper() == rule.action.upper() else 'shadowed'
+				result[kind].append({'rule_id': rule.id, 'by': other.id})
+			else:
+				result['conflicts'].extend(
+					{'rule_id': rule.id, 'with': other.id} for other in sorted(conflicts, key=lambda r: r.id))
+		
+		return result
@@ -0,0 +1,226 @@
+# services/rule_batch.py
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from models import db, FirewallRule, RuleCounterSample
+from models.rule import normalize_port, object_group_name
+from services.rule_reconciler import RuleReconciler
+from services.object_group import validate_object_group_refs
+from utils.validators import validate_ip_network, validate_port, validate_protocol, validate_chain, validate_action
+
+# 批量操作类型
+BATCH_OPERATIONS = ('create', 'update', 'delete')
+
+# 创建规则时的必填字段和默认值
+RULE_REQUIRED_FIELDS = ('rule_type', 'chain', 'action')
+RULE_DEFAULTS = {
+	'protocol': 'all',
+	'source': 'any',
+	'destination': 'any',
+	'port': 'any',
+	'comment': '',
+	'priority': 100,
+	'enabled': True
+}
+
+# 可通过批量操作修改的规则字段
+RULE_FIELDS = ('rule_type', 'chain', 'protocol', 'source', 'destination', 'port', 'action', 'comment',
+               'priority', 'enabled')
+
+
+def validate_rule_data(data, partial=False):
+	"""校验规则字段，返回错误信息；partial为True时只校验出现的字段（用于更新）"""
+	if not partial:
+		for field in RULE_REQUIRED_FIELDS:
+			if not data.get(field):
+				return f'Missing required field: {field}'
+	
+	if 'rule_type' in data and data['rule_type'] not in ('iptables', 'nftables'):
+		return f"Invalid rule_type: {data['rule_type']}"
+	for field in ('chain', 'action'):
+		if field in data and not data[field]:
+			return f'Empty field: {field}'
+	
+	if data.get('chain') and not validate_chain(str(data['chain'])):
+		return f"Invalid chain: {data['chain']}"
+	# 动作为标准动作，或跳转到自定义链
+	action = data.get('action')
+	if action and not validate_action(str(action)) and not validate_chain(str(action)):
+		return f'Invalid action: {action}'
+	if data.get('protocol') and not validate_protocol(str(data['protocol'])):
+		return f"Invalid protocol: {data['protocol']}"
+	
+	# 地址和端口可以是 @组名 形式的对象组引用
+	for field in ('source', 'destination'):
+		value = data.get(field)
+		if value and value != 'any' and not object_group_name(value) and not validate_ip_network(str(value)):
+			return f'Invalid {field} address: {value}'
+	
+	port = data.get('port')
+	if port and port != 'any' and not object_group_name(port) and not validate_port(normalize_port(str(port))):
+		return f'Invalid port: {port}'
+	
+	error = validate_object_group_refs(data)
+	if error:
+		return error
+	
+	if 'priority' in data:
+		try:
+			int(data['priority'])
+		except (TypeError, ValueError):
+			return f"Invalid priority: {data['priority']}"
+	if 'enabled' in data and not isinstance(data['enabled'], bool):
+		return f"Invalid enabled flag: {data['enabled']}"
+	return None
+
+
+def rule_values(data, defaults=True):
+	"""已校验的规则数据中的规则字段，priority转换为整数；defaults为True时缺少的字段取默认值"""
+	values = {}
+	for field in RULE_FIELDS:
+		if field in data:
+			values[field] = data[field]
+		elif defaults:
+			values[field] = RULE_DEFAULTS.get(field)
+	if values.get('priority') is not None:
+		values['priority'] = int(values['priority'])
+	return values
+
+
+def parse_expiry(data):
+	"""临时规则的过期时间（UTC）：ttl为剩余秒数，expires_at为ISO 8601时间（无时区时按UTC）
+	
+	两者都未提供或为空时返回None（永久规则）；取值无效或已过期时抛出ValueError。
+	"""
+	if data.get('ttl') not in (None, ''):
+		try:
+			ttl = int(data['ttl'])
+		except (TypeError, ValueError):
+			raise ValueError(f"Invalid ttl: {data['ttl']}")
+		if ttl <= 0:
+			raise ValueError(f'Invalid ttl: {ttl}')
+		return datetime.utcnow() + timedelta(seconds=ttl)
+	
+	if not data.get('expires_at'):
+		return None
+	try:
+		expires_at = datetime.fromisoformat(str(data['expires_at']).replace('Z', '+00:00'))
+	except ValueError:
+		raise ValueError(f"Invalid expires_at: {data['expires_at']}")
+	if expires_at.tzinfo is not None:
+		expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+	if expires_at <= datetime.utcnow():
+		raise ValueError(f"expires_at is in the past: {data['expires_at']}")
+	return expires_at
+
+
+class RuleBatch:
+	"""批量创建/更新/删除规则：全部操作先校验，再以每个后端一次内核事务应用，数据库只提交一次
+	
+	创建和更新与单条写入一样支持ttl/expires_at：创建时设置过期时间，更新时提供其中之一即修改
+	（均为空表示改为永久规则）。
+	"""
+	
+	def __init__(self, reconciler=None):
+		self.reconciler = reconciler or RuleReconciler()
+	
+	def validate(self, operations):
+		"""校验所有操作，返回 (逐项结果, 是否全部有效, id -> 规则)"""
+		ids = [operation.get('id') for operation in operations
+		       if isinstance(operation, dict) and operation.get('op') in ('update', 'delete')]
+		rules = {rule.id: rule for rule in FirewallRule.query.filter(FirewallRule.id.in_(
+			[rule_id for rule_id in ids if isinstance(rule_id, int)])).all()} if ids else {}
+		
+		results = []
+		seen = set()
+		valid = True
+		for index, operation in enumerate(operations):
+			error = self._validate_operation(operation, rules, seen)
+			results.append({
+				'index': index,
+				'op': operation.get('op') if isinstance(operation, dict) else None,
+				'id': operation.get('id') if isinstance(operation, dict) else None,
+				'success': error is None,
+				'message': error or 'Valid'
+			})
+			valid = valid and error is None
+		
+		return results, valid, rules
+	
+	def _validate_operation(self, operation, rules, seen):
+		if not isinstance(operation, dict):
+			return 'Operation must be an object'
+		op = operation.get('op')
+		if op not in BATCH_OPERATIONS:
+			return f'Invalid op: {op}'
+		
+		data = operation.get('data') or {}
+		if op != 'delete':
+			try:
+				parse_expiry(data)
+			except ValueError as e:
+				return str(e)
+		if op == 'create':
+			return validate_rule_data(data)
+		
+		rule_id = operation.get('id')
+		if rule_id not in rules:
+			return f'Rule not found: {rule_id}'
+		if rule_id in seen:
+			return f'Rule {rule_id} appears in more than one operation'
+		seen.add(rule_id)
+		if op == 'update':
+			return validate_rule_data(data, partial=True)
+		return None
+	
+	def apply(self, operations):
+		"""校验并应用批量操作；有无效操作时不做任何修改，内核应用失败时回滚数据库和已应用的后端"""
+		results, valid, rules = self.validate(operations)
+		if not valid:
+			return {'applied': False, 'results': results}
+		
+		rule_types = set()
+		touched = []
+		for result, operation in zip(results, operations):
+			op = operation['op']
+			data = operation.get('data') or {}
+			if op == 'create':
+				rule = FirewallRule(expires_at=parse_expiry(data), **rule_values(data))
+				db.session.add(rule)
+			else:
+				rule = rules[operation['id']]
+				rule_types.add(rule.rule_type)
+				if op == 'update':
+					for field, value in rule_values(data, defaults=False).items():
+						setattr(rule, field, value)
+					if 'ttl' in data or 'expires_at' in data:
+						rule.expires_at = parse_expiry(data)
+				else:
+					RuleCounterSample.query.filter_by(rule_id=rule.id).delete()
+					db.session.delete(rule)
+			rule_types.add(rule.rule_type)
+			touched.append((result, op, rule))
+		db.session.flush()
+		
+		applied = []
+		try:
+			for rule_type in sorted(rule_types):
+				self.reconciler.apply_plan(self.reconciler.plan(rule_type))
+				applied.append(rule_type)
+		except Exception:
+			db.session.rollback()
+			# 数据库已回滚，按回滚后的规则重新协调已经应用的后端
+			for rule_type in applied:
+				try:
+					self.reconciler.reconcile(rule_type)
+				except Exception as e:
+					current_app.logger.error(f"Error reverting {rule_type} batch: {e}")
+			raise
+		
+		db.session.commit()
+		
+		for result, op, rule in touched:
+			result['id'] = rule.id
+			result['message'] = f'Rule {op}d successfully'
+			if op != 'delete':
+				result['data'] = rule.to_dict()
+		return {'applied': True, 'results': results}
@@ -0,0 +1,496 @@
+# services/rule_compiler.py
+import bisect
+import hashlib
+import ipaddress
+import json
+from collections import Counter
+from datetime import datetime
+from flask import current_app
+from models.rule import FirewallRule, managed_chain_name, rule_signature, object_group_refs, NFT_COUNTER, \
+	OBJECT_GROUP_PREFIXES, _nft_match, _nft_address, _nft_port, _nft_verdict
+from services.nftables_backend import NFTABLES_FAMILY, NFTABLES_TABLE
+
+# 编译集合的种类：源地址集合、端口集合、源地址.端口拼接集合、源地址判决映射
+SET_KIND_SOURCE = 's'
+SET_KIND_PORT = 'p'
+SET_KIND_SOURCE_PORT = 'sp'
+SET_KIND_VERDICT_MAP = 'v'
+# 带超时的源地址集合：有效期内的地址规则作为元素，由内核按超时自动删除
+SET_KIND_TIMEOUT = 't'
+
+# 各种类在规则签名 (protocol, source, destination, port, action) 中的固定字段与集合元素字段
+SET_KIND_FIELDS = {
+	SET_KIND_SOURCE: ((0, 2, 3, 4), (1,)),
+	SET_KIND_PORT: ((0, 1, 2, 4), (3,)),
+	SET_KIND_SOURCE_PORT: ((0, 2, 4), (1, 3)),
+	SET_KIND_VERDICT_MAP: ((0, 2, 3), (1, 4)),
+	SET_KIND_TIMEOUT: ((0, 2, 3, 4), (1,)),
+}
+
+# 相同长度时优先选择更简单的集合
+SET_KIND_ORDER = (SET_KIND_SOURCE, SET_KIND_PORT, SET_KIND_SOURCE_PORT, SET_KIND_VERDICT_MAP)
+
+SET_KIND_TYPES = {
+	SET_KIND_SOURCE: 'ipv4_addr',
+	SET_KIND_PORT: 'inet_service',
+	SET_KIND_SOURCE_PORT: ['ipv4_addr', 'inet_service'],
+	SET_KIND_VERDICT_MAP: 'ipv4_addr',
+	SET_KIND_TIMEOUT: 'ipv4_addr',
+}
+
+# 不能作为判决映射值的动作
+NON_MAP_ACTIONS = ('REJECT', 'LOG')
+
+
+def set_kind(name):
+	"""从编译集合名称（FWM_<链>_<种类><摘要>）中取出集合种类；对象组集合返回None"""
+	if name.startswith(tuple(OBJECT_GROUP_PREFIXES.values())):
+		return None
+	suffix = name.rsplit('_', 1)[-1]
+	return suffix[:-8]
+
+
+def timeout_set(name):
+	"""编译集合（nftables集合或末尾带类型代码的ipset）是否为超时集合"""
+	return bool(name) and SET_KIND_TIMEOUT in (set_kind(name), set_kind(name[:-1]))
+
+
+def expiring_rule(rule, now=None):
+	"""有效期未到、可作为超时集合元素的IPv4源地址规则"""
+	if not rule.expires_at or rule.expires_at <= (now or datetime.utcnow()) or object_group_refs(rule):
+		return False
+	return rule.source not in (None, 'any') and _address_key(rule.source) is not None
+
+
+def crosses_overlap(rule, passed):
+	"""rule前移越过passed中的规则时是否改变首次匹配的结果：与其中任一规则的匹配空间相交，
+	或无法确定匹配空间时返回True"""
+	# 局部导入：rule_analyzer 依赖本模块
+	from services.rule_analyzer import rule_space, spaces_overlap
+	space = rule_space(rule)
+	for other in passed:
+		other_space = rule_space(other)
+		if space is None or other_space is None or spaces_overlap(space, other_space):
+			return True
+	return False
+
+
+def timeout_seconds(rule, now=None):
+	"""规则剩余的有效秒数（至少1秒）"""
+	return max(1, int((rule.expires_at - (now or datetime.utcnow())).total_seconds()))
+
+
+def _address_key(value):
+	"""IPv4网段的 (前缀长度, 网络号) 键；非IPv4网段返回None"""
+	try:
+		network = ipaddress.ip_network(value, strict=False)
+	except ValueError:
+		return None
+	if network.version != 4:
+		return None
+	return network.prefixlen, int(network.network_address) >> (32 - network.prefixlen)
+
+
+def _port_interval(value):
+	"""端口/端口范围的闭区间；无法解析时返回None"""
+	start, _, end = value.partition('-')
+	try:
+		return int(start), int(end or start)
+	except ValueError:
+		return None
+
+
+class _PrefixIndex:
+	"""IPv4网段索引：两个网段重叠当且仅当其中一个包含另一个"""
+	
+	def __init__(self):
+		self.networks = set()
+		self.covered = set()
+	
+	def overlaps(self, key):
+		prefixlen, number = key
+		if key in self.covered:
+			return True
+		return any((length, number >> (prefixlen - length)) in self.networks for length in range(prefixlen + 1))
+	
+	def add(self, key):
+		prefixlen, number = key
+		self.networks.add(key)
+		self.covered.update((length, number >> (prefixlen - length)) for length in range(prefixlen + 1))
+
+
+class _IntervalIndex:
+	"""互不重叠闭区间的有序索引"""
+	
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+	
+	def overlaps(self, interval):
+		start, end = interval
+		index = bisect.bisect_right(self.starts, start)
+		if index > 0 and self.ends[index - 1] >= start:
+			return True
+		return index < len(self.starts) and self.starts[index] <= end
+	
+	def add(self, interval):
+		index = bisect.bisect_right(self.starts, interval[0])
+		self.starts.insert(index, interval[0])
+		self.ends.insert(index, interval[1])
+
+
+class _ElementIndex:
+	"""集合元素的重叠检查：完全相同的元素可共享，部分重叠的元素不能放进同一集合"""
+	
+	def __init__(self, kind):
+		self.kind = kind
+		self.elements = {}
+		self.addresses = _PrefixIndex()
+		self.ports = _IntervalIndex()
+		self.port_addresses = {}
+	
+	def try_add(self, signature):
+		"""元素可加入集合时记录并返回True"""
+		key = tuple(signature[i] for i in SET_KIND_FIELDS[self.kind][1])
+		if key in self.elements:
+			return True
+		
+		if self.kind == SET_KIND_PORT:
+			interval = _port_interval(signature[3])
+			if interval is None or self.ports.overlaps(interval):
+				return False
+			self.ports.add(interval)
+		else:
+			address = _address_key(signature[1])
+			if address is None:
+				return False
+			if self.kind == SET_KIND_SOURCE_PORT:
+				# 端口区间只允许完全相同或互不相交，同一端口区间下的地址互不重叠
+				interval = _port_interval(signature[3])
+				if interval is None:
+					return False
+				addresses = self.port_addresses.get(interval)
+				if addresses is None:
+					if self.ports.overlaps(interval):
+						return False
+					self.ports.add(interval)
+					addresses = self.port_addresses[interval] = _PrefixIndex()
+			else:
+				addresses = self.addresses
+			if addresses.overlaps(address):
+				return False
+			addresses.add(address)
+		
+		self.elements[key] = signature
+		return True
+
+
+def _element(kind, signature):
+	"""规则签名对应的集合元素（nftables JSON）"""
+	if kind in (SET_KIND_SOURCE, SET_KIND_TIMEOUT):
+		return _nft_address(signature[1])
+	if kind == SET_KIND_PORT:
+		return _nft_port(signature[3])
+	if kind == SET_KIND_SOURCE_PORT:
+		return {'concat': [_nft_address(signature[1]), _nft_port(signature[3])]}
+	return [_nft_address(signature[1]), _nft_verdict(signature[4])]
+
+
+def element_key(element):
+	"""集合元素的规范化键，用于比对期望元素与内核中的元素（忽略计数器、超时等元素属性）"""
+	if isinstance(element, list) and element and isinstance(element[0], dict) and 'elem' in element[0]:
+		# 带计数器的判决映射元素：[{elem: {val, counter}}, 判决]
+		element = [element[0]['elem'].get('val')] + element[1:]
+	if isinstance(element, dict) and 'elem' in element:
+		element = element['elem'].get('val')
+	return json.dumps(element, sort_keys=True)
+
+
+def plain_element(element):
+	"""去掉内核列出的元素中的计数器，删除元素时使用"""
+	if isinstance(element, list):
+		return [plain_element(element[0])] + element[1:] if element else element
+	if isinstance(element, dict) and 'counter' in element.get('elem', {}):
+		elem = {key: value for key, value in element['elem'].items() if key != 'counter'}
+		return elem['val'] if list(elem) == ['val'] else {'elem': elem}
+	return element
+
+
+def element_counter(element):
+	"""内核列出的集合元素自带的计数器 (包数, 字节数)；集合未开启元素计数器时返回None"""
+	if isinstance(element, list) and element:
+		element = element[0]
+	counter = element.get('elem', {}).get('counter') if isinstance(element, dict) else None
+	if not isinstance(counter, dict):
+		return None
+	return counter.get('packets', 0), counter.get('bytes', 0)
+
+
+def element_lookup_key(element):
+	"""集合查找键的规范化键（判决映射只取键），用于按元素读取计数器"""
+	if isinstance(element, list) and element:
+		element = element[0]
+	return element_key(element)
+
+
+def rule_element_key(rule):
+	"""编译进nftables集合的规则对应元素的查找键"""
+	return element_lookup_key(_element(set_kind(rule.kernel_set), rule.signature()))
+
+
+def element_ref(rule):
+	"""引用规则在其编译集合中对应元素的JSON对象（判决映射只需要键）"""
+	kind = set_kind(rule.kernel_set)
+	element = _element(kind, rule.signature())
+	if kind == SET_KIND_VERDICT_MAP:
+		element = element[0]
+	return {'element': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'name': rule.kernel_set,
+	                    'elem': [element]}}
+
+
+def unit_rules(unit):
+	"""编译单元包含的数据库规则（分片分发规则不包含任何规则）"""
+	return [unit] if isinstance(unit, FirewallRule) else unit.rules
+
+
+def assign_kernel_handle(unit, handle):
+	"""把内核规则句柄记录到编译单元的所有数据库规则上"""
+	kernel_set = unit.name if isinstance(unit, CompiledGroup) else None
+	for rule in unit_rules(unit):
+		rule.kernel_handle = handle
+		rule.kernel_set = kernel_set
+
+
+class CompiledGroup:
+	"""一组连续规则编译成的单条内核规则，匹配条件通过命名集合/判决映射查找"""
+	
+	def __init__(self, kind, chain, name, rules):
+		self.kind = kind
+		self.chain = chain
+		self.name = name
+		self.rules = rules
+		self.id = None
+		self.fixed = rules[0].signature()
+	
+	@property
+	def kernel_chain(self):
+		return managed_chain_name(self.chain)
+	
+	@property
+	def protocol(self):
+		return self.fixed[0]
+	
+	def signature(self):
+		"""与内核中解析出的集合规则签名一致：元素字段显示为 @集合名"""
+		values = list(self.fixed)
+		for index in SET_KIND_FIELDS[self.kind][1]:
+			values[index] = f'@{self.name}'
+		return rule_signature(*values)
+	
+	def rule_elements(self):
+		"""逐条产出 (规则, 元素规范化键, 集合元素)"""
+		for rule in self.rules:
+			element = _element(self.kind, rule.signature())
+			yield rule, element_key(element), element
+	
+	def elements(self):
+		"""规范化键 -> 集合元素，相同的元素只保留一个"""
+		return {key: element for _, key, element in self.rule_elements()}
+	
+	def set_object(self):
+		"""命名集合/判决映射的定义：每个元素带计数器，按规则统计命中次数"""
+		definition = {
+			'family': NFTABLES_FAMILY,
+			'table': NFTABLES_TABLE,
+			'name': self.name,
+			'type': SET_KIND_TYPES[self.kind],
+			'flags': ['interval'],
+			'stmt': [{'counter': None}]
+		}
+		if self.kind == SET_KIND_VERDICT_MAP:
+			definition['map'] = 'verdict'
+			return {'map': definition}
+		return {'set': definition}
+	
+	def to_nftables_json(self, verb='add', position=None):
+		rule = {
+			'family': NFTABLES_FAMILY,
+			'table': NFTABLES_TABLE,
+			'chain': self.kernel_chain,
+			'expr': self.nftables_expr()
+		}
+		if position is not None:
+			rule['handle'] = position
+		return {verb: {'rule': rule}}
+	
+	def nftables_expr(self):
+		protocol, source, destination, port, action = self.fixed
+		element_fields = SET_KIND_FIELDS[self.kind][1]
+		reference = f'@{self.name}'
+		saddr = {'payload': {'protocol': 'ip', 'field': 'saddr'}}
+		dport = {'payload': {'protocol': protocol, 'field': 'dport'}}
+		expr = []
+		
+		if protocol != 'all':
+			expr.append(_nft_match('ip', 'protocol', protocol))
+		if 1 not in element_fields and source != 'any':
+			expr.append(_nft_match('ip', 'saddr', _nft_address(source)))
+		if destination != 'any':
+			expr.append(_nft_match('ip', 'daddr', _nft_address(destination)))
+		if 3 not in element_fields and port != 'any' and protocol in ['tcp', 'udp']:
+			expr.append(_nft_match(protocol, 'dport', _nft_port(port)))
+		
+		if self.kind in (SET_KIND_SOURCE, SET_KIND_TIMEOUT):
+			expr.append(_nft_match('ip', 'saddr', reference))
+		elif self.kind == SET_KIND_PORT:
+			expr.append(_nft_match(protocol, 'dport', reference))
+		elif self.kind == SET_KIND_SOURCE_PORT:
+			expr.append({'match': {'op': '==', 'left': {'concat': [saddr, dport]}, 'right': reference}})
+		else:
+			expr.append(NFT_COUNTER)
+			expr.append({'vmap': {'key': saddr, 'data': reference}})
+			return expr
+		
+		expr.append(NFT_COUNTER)
+		expr.append(_nft_verdict(self.rules[0].action))
+		return expr
+
+
+class TimeoutGroup(CompiledGroup):
+	"""一条链中固定条件相同、有效期未到的地址规则：一条引用超时集合的规则，元素带剩余有效期"""
+	
+	def rule_elements(self):
+		now = datetime.utcnow()
+		for rule in self.rules:
+			address = _nft_address(rule.signature()[1])
+			yield rule, element_key(address), {'elem': {'val': address, 'timeout': timeout_seconds(rule, now)}}
+	
+	def set_object(self):
+		definition = super().set_object()
+		definition['set']['flags'] = ['interval', 'timeout']
+		return definition
+
+
+class RuleCompiler:
+	"""把连续的、只有源地址/端口（或动作）不同的规则编译为命名集合和判决映射
+	
+	只合并相邻规则，且同一集合中的元素互不重叠，因此编译前后规则的匹配顺序和结果不变。
+	"""
+	
+	# 可使用的集合种类，以及端口集合元素是否可以是端口范围
+	kinds = SET_KIND_ORDER
+	port_ranges = True
+	
+	def __init__(self, min_group_size=None):
+		self.min_group_size = min_group_size or current_app.config.get('RULE_COMPILE_MIN_GROUP', 4)
+	
+	def compile_chain(self, chain, rules):
+		"""编译一条基础链中按优先级排好序的规则，返回 FirewallRule 与 CompiledGroup 混合的列表
+		
+		有效期未到的地址规则按固定条件合并为超时集合，集合规则位于其中优先级最高的规则处，
+		成员只在前移不越过与其重叠的规则时合并；其余规则在超时集合规则之间分段编译。
+		"""
+		groups = self._timeout_groups(chain, rules)
+		members = {id(rule): group for group in groups for rule in group.rules}
+		occurrences = Counter()
+		units = []
+		segment = []
+		for rule in rules:
+			group = members.get(id(rule))
+			if group is None:
+				segment.append(rule)
+			elif group.rules[0] is rule:
+				units.extend(self._compile_segment(chain, segment, occurrences))
+				units.append(group)
+				segment = []
+		units.extend(self._compile_segment(chain, segment, occurrences))
+		return units
+	
+	def expiring_group(self, chain, rules):
+		"""规则所属超时集合的编译单元（集合名称只由链和固定条件决定）"""
+		fixed = tuple(rules[0].signature()[i] for i in SET_KIND_FIELDS[SET_KIND_TIMEOUT][0])
+		return self._make_timeout_group(chain, fixed, rules)
+	
+	def _timeout_groups(self, chain, rules):
+		now = datetime.utcnow()
+		# 固定条件 -> (元素索引, 成员, 第一个成员之后不属于该集合的规则)
+		grouped = {}
+		for rule in rules:
+			joined = None
+			if expiring_rule(rule, now):
+				signature = rule.signature()
+				fixed = tuple(signature[i] for i in SET_KIND_FIELDS[SET_KIND_TIMEOUT][0])
+				elements, members, passed = grouped.setdefault(fixed, (_ElementIndex(SET_KIND_TIMEOUT), [], []))
+				# 集合规则位于第一个成员处：越过与其重叠的规则，或与已有元素部分重叠时保留为单独的规则
+				if not crosses_overlap(rule, passed) and elements.try_add(signature):
+					members.append(rule)
+					joined = fixed
+			for fixed, (_, members, passed) in grouped.items():
+				if members and fixed != joined:
+					passed.append(rule)
+		return [self._make_timeout_group(chain, fixed, members) for fixed, (_, members, _) in grouped.items()]
+	
+	def _make_timeout_group(self, chain, fixed, rules):
+		return TimeoutGroup(SET_KIND_TIMEOUT, chain, self._set_name(chain, SET_KIND_TIMEOUT, fixed, 1), rules)
+	
+	def _compile_segment(self, chain, rules, occurrences):
+		signatures = [rule.signature() for rule in rules]
+		units = []
+		
+		index = 0
+		while index < len(rules):
+			kind, length = self._longest_run(signatures, index)
+			if length < self.min_group_size:
+				units.append(rules[index])
+				index += 1
+				continue
+			
+			fixed = tuple(signatures[index][i] for i in SET_KIND_FIELDS[kind][0])
+			occurrences[(kind, fixed)] += 1
+			units.append(self._make_group(kind, chain, fixed, occurrences[(kind, fixed)], rules[index:index + length]))
+			index += length
+		
+		return units
+	
+	def _longest_run(self, signatures, start):
+		"""从start开始，各集合种类能合并的最长连续规则数"""
+		best_kind, best_length = None, 0
+		for kind in self.kinds:
+			length = self._run_length(kind, signatures, start)
+			if length > best_length:
+				best_kind, best_length = kind, length
+		return best_kind, best_length
+	
+	def _run_length(self, kind, signatures, start):
+		fixed_fields, element_fields = SET_KIND_FIELDS[kind]
+		first = signatures[start]
+		if 3 in element_fields and first[0] not in ('tcp', 'udp'):
+			return 0
+		
+		elements = _ElementIndex(kind)
+		end = start
+		while end < len(signatures):
+			signature = signatures[end]
+			if any(signature[i] != first[i] for i in fixed_fields):
+				break
+			if any(signature[i] == 'any' for i in element_fields):
+				break
+			# 引用对象组的规则直接匹配对象组集合，不再编译
+			if any(value.startswith('@') for value in signature[1:4]):
+				break
+			if kind == SET_KIND_VERDICT_MAP and signature[4] in NON_MAP_ACTIONS:
+				break
+			if not self.port_ranges and 3 in element_fields and '-' in signature[3]:
+				break
+			if not elements.try_add(signature):
+				break
+			end += 1
+		return end - start
+	
+	def _make_group(self, kind, chain, fixed, occurrence, rules):
+		return CompiledGroup(kind, chain, self._set_name(chain, kind, fixed, occurrence), rules)
+	
+	def _set_name(self, chain, kind, fixed, occurrence):
+		"""由链、种类和固定匹配条件生成稳定的集合名，元素增减时名称不变"""
+		digest = hashlib.sha1(repr((kind, fixed, occurrence)).encode()).hexdigest()[:8]
+		return f'{managed_chain_name(chain)}_{kind}{digest}'
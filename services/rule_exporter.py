@@ -0,0 +1,153 @@
+# services/rule_exporter.py
+import csv
+import io
+import json
+from models import db, FirewallRule
+from sqlalchemy import or_
+from models.rule import managed_chain_name, iptables_restore_line, OBJECT_GROUP_FIELDS
+from services.nftables_backend import NFTABLES_FAMILY, NFTABLES_TABLE
+from services.ipset_backend import IpsetBackend
+from services.object_group import OBJECT_GROUP_NFT_TYPES, object_group_sets
+
+# 导出格式 -> (MIME类型, 文件扩展名)
+EXPORT_FORMATS = {
+	'json': ('application/json', 'json'),
+	'ndjson': ('application/x-ndjson', 'ndjson'),
+	'csv': ('text/csv', 'csv'),
+	'iptables': ('text/plain', 'rules'),
+	'nftables': ('text/plain', 'nft')
+}
+
+# 服务端游标每批读取的行数，以及每个输出块包含的规则数
+EXPORT_FETCH_SIZE = 1000
+EXPORT_CHUNK_ROWS = 500
+
+# iptables导出中ipset命令行的前缀：对iptables-restore是注释，可用 sed -n 's/^#ipset //p' 提取
+IPSET_LINE_PREFIX = '#ipset '
+
+# CSV导出的列
+CSV_FIELDS = ['id', 'rule_type', 'chain', 'protocol', 'source', 'destination', 'port', 'action', 'comment',
+              'priority', 'enabled']
+
+
+class RuleExporter:
+	"""流式导出规则：通过服务端游标（yield_per）逐批读取，按块产出文本，内存占用与规则数量无关
+	
+	iptables 和 nftables 格式只导出对应类型的启用规则，分别可直接用于
+	iptables-restore --noflush 和 nft -f。规则引用的对象组集合随之导出：nftables格式中
+	声明集合并填充成员，iptables格式中附带须先于规则恢复的ipset命令。
+	"""
+	
+	def __init__(self, rule_type='all'):
+		self.rule_type = rule_type
+		# 已产出的规则数
+		self.exported = 0
+	
+	def stream(self, fmt='json'):
+		"""按格式产出导出内容的文本块"""
+		if fmt not in EXPORT_FORMATS:
+			raise ValueError(f"Unsupported export format: {fmt}")
+		return getattr(self, f'_stream_{fmt}')()
+	
+	def _rules(self, rule_type=None, enabled_only=False):
+		query = FirewallRule.query
+		rule_type = rule_type or self.rule_type
+		if rule_type != 'all':
+			query = query.filter_by(rule_type=rule_type)
+		if enabled_only:
+			query = query.filter_by(enabled=True)
+		query = query.order_by(FirewallRule.rule_type, FirewallRule.chain, FirewallRule.priority, FirewallRule.id)
+		for rule in query.yield_per(EXPORT_FETCH_SIZE):
+			self.exported += 1
+			yield rule
+	
+	def _chunks(self, lines):
+		"""把逐行文本合并为块"""
+		buffer = []
+		for line in lines:
+			buffer.append(line)
+			if len(buffer) >= EXPORT_CHUNK_ROWS:
+				yield ''.join(buffer)
+				buffer = []
+		if buffer:
+			yield ''.join(buffer)
+	
+	def _stream_json(self):
+		yield '['
+		yield from self._chunks((',\n' if index else '\n') + json.dumps(rule.to_dict())
+		                        for index, rule in enumerate(self._rules()))
+		yield '\n]\n'
+	
+	def _stream_ndjson(self):
+		return self._chunks(json.dumps(rule.to_dict()) + '\n' for rule in self._rules())
+	
+	def _stream_csv(self):
+		buffer = io.StringIO()
+		writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction='ignore')
+		writer.writeheader()
+		yield buffer.getvalue()
+		
+		rows = 0
+		buffer.seek(0)
+		buffer.truncate()
+		for rule in self._rules():
+			writer.writerow(rule.to_dict())
+			rows += 1
+			if rows >= EXPORT_CHUNK_ROWS:
+				yield buffer.getvalue()
+				buffer.seek(0)
+				buffer.truncate()
+				rows = 0
+		if rows:
+			yield buffer.getvalue()
+	
+	def _managed_chains(self, rule_type):
+		rows = db.session.query(FirewallRule.chain).filter_by(rule_type=rule_type, enabled=True).distinct()
+		return sorted(managed_chain_name(chain) for chain, in rows)
+	
+	def _object_group_sets(self, rule_type):
+		"""启用规则引用的对象组集合"""
+		columns = [getattr(FirewallRule, field) for field in OBJECT_GROUP_FIELDS]
+		rows = db.session.query(*columns).filter_by(rule_type=rule_type, enabled=True).filter(
+			or_(*[column.startswith('@') for column in columns])).distinct()
+		return object_group_sets(rule_type, rows)
+	
+	def _stream_iptables(self):
+		header = []
+		group_sets = self._object_group_sets('iptables')
+		if group_sets:
+			# iptables-restore不能创建ipset，引用的集合须先通过 ipset restore 创建
+			ipset = IpsetBackend()
+			header.append(f"# Restore object group sets first with: sed -n 's/^{IPSET_LINE_PREFIX}//p' <file> | "
+			              f"ipset restore -exist\n")
+			for group_set in group_sets:
+				lines = [ipset.render_create(group_set.name, group_set.set_type, len(group_set.members)),
+				         f'flush {group_set.name}']
+				lines.extend(f'add {group_set.name} {group_set.kernel_element(value)}' for value in group_set.members)
+				header.extend(f'{IPSET_LINE_PREFIX}{line}\n' for line in lines)
+		
+		# 声明的受管链在 --noflush 恢复时会被清空；基础链到受管链的跳转由防火墙管理器维护
+		header.extend(['# Restore with: iptables-restore --noflush\n', '*filter\n'])
+		header.extend(f':{chain} - [0:0]\n' for chain in self._managed_chains('iptables'))
+		yield ''.join(header)
+		
+		yield from self._chunks(iptables_restore_line(rule.to_iptables_command()) + '\n'
+		                        for rule in self._rules('iptables', enabled_only=True))
+		yield 'COMMIT\n'
+	
+	def _stream_nftables(self):
+		header = ['# Restore with: nft -f\n', f'add table {NFTABLES_FAMILY} {NFTABLES_TABLE}\n']
+		# 对象组集合须先于引用它的规则声明
+		for group_set in self._object_group_sets('nftables'):
+			name = f'{NFTABLES_FAMILY} {NFTABLES_TABLE} {group_set.name}'
+			header.append(f'add set {name} {{ type {OBJECT_GROUP_NFT_TYPES[group_set.group_type]}; flags interval; }}\n')
+			header.append(f'flush set {name}\n')
+			if group_set.members:
+				header.append(f"add element {name} {{ {', '.join(group_set.members)} }}\n")
+		for chain in self._managed_chains('nftables'):
+			header.append(f'add chain {NFTABLES_FAMILY} {NFTABLES_TABLE} {chain}\n')
+			header.append(f'flush chain {NFTABLES_FAMILY} {NFTABLES_TABLE} {chain}\n')
+		yield ''.join(header)
+		
+		yield from self._chunks(rule.to_nftables_command() + '\n'
+		                        for rule in self._rules('nftables', enabled_only=True))
@@ -0,0 +1,199 @@
+# services/rule_importer.py
+import csv
+import io
+import json
+import os
+from flask import current_app
+from models import db, FirewallRule
+from models.rule import bump_generation
+from services.rule_batch import RULE_FIELDS, rule_values, validate_rule_data
+from services.rule_reconciler import RuleReconciler
+from services.ruleset_parser import JsonStreamError, iter_json_array
+
+# 支持导入的格式
+IMPORT_FORMATS = ('json', 'ndjson', 'csv')
+
+# 文件扩展名 -> 导入格式
+IMPORT_EXTENSIONS = {
+	'.json': 'json',
+	'.ndjson': 'ndjson',
+	'.jsonl': 'ndjson',
+	'.csv': 'csv'
+}
+
+# 每批写入数据库的规则数，以及每次读取的字节数
+IMPORT_BATCH_SIZE = 1000
+IMPORT_READ_SIZE = 1 << 16
+
+# 结果中最多列出的错误行数：总数记入invalid，超出时truncated为True
+IMPORT_MAX_ERRORS = 1000
+
+
+class RuleImporter:
+	"""流式导入规则：按行/元素增量解析 JSON 数组、NDJSON 和 CSV，内存占用与文件大小无关
+	
+	每行单独校验，无效行连同行号记入错误列表，有效行分批批量写入数据库；
+	全部写入后每个后端一次内核事务应用，数据库只提交一次。strict为True时有任何无效行即不导入。
+	progress为可选回调，每写入一批后以已导入的规则数调用。
+	"""
+	
+	def __init__(self, reconciler=None, strict=False, progress=None):
+		self.reconciler = reconciler or RuleReconciler()
+		self.strict = strict
+		self.progress = progress
+		self.imported = 0
+		self.invalid = 0
+		self.errors = []
+	
+	def import_stream(self, stream, filename=None, fmt=None):
+		"""从二进制流导入规则，返回导入结果摘要"""
+		fmt = fmt or self.detect_format(stream, filename)
+		if fmt not in IMPORT_FORMATS:
+			raise ValueError(f"Unsupported import format: {fmt}")
+		
+		text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+		try:
+			if self.strict:
+				# 先完整校验一遍，全部有效时再回到开头导入
+				for _ in self._valid_rows(self._rows(text, fmt)):
+					pass
+				if self.invalid:
+					return self._summary(fmt, applied=False)
+				text.seek(0)
+			self.import_rows(self._valid_rows(self._rows(text, fmt)))
+		finally:
+			# 不关闭调用方的流
+			text.detach()
+		
+		return self._summary(fmt, applied=True)
+	
+	@staticmethod
+	def detect_format(stream, filename=None):
+		"""按文件扩展名判断格式，无法判断时查看内容开头的第一个非空字符"""
+		extension = os.path.splitext(filename or '')[1].lower()
+		if extension in IMPORT_EXTENSIONS:
+			return IMPORT_EXTENSIONS[extension]
+		
+		head = stream.read(IMPORT_READ_SIZE)
+		stream.seek(0)
+		head = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+		if head.startswith(b'['):
+			return 'json'
+		if head.startswith(b'{'):
+			return 'ndjson'
+		return 'csv'
+	
+	def _summary(self, fmt, applied):
+		return {
+			'format': fmt,
+			'applied': applied,
+			'imported': self.imported if applied else 0,
+			'invalid': self.invalid,
+			'errors': self.errors,
+			'truncated': self.invalid > len(self.errors)
+		}
+	
+	def _rows(self, text, fmt):
+		"""产出 (行号, 规则数据或None, 解析错误)"""
+		if fmt == 'json':
+			return self._json_rows(text)
+		if fmt == 'ndjson':
+			return self._ndjson_rows(text)
+		return self._csv_rows(text)
+	
+	def _json_rows(self, text):
+		try:
+			for line, item in iter_json_array(text, read_size=IMPORT_READ_SIZE):
+				yield line, item, None
+		except JsonStreamError as e:
+			# 文档截断或语法错误时其后的内容无法继续解析
+			yield e.line, None, str(e)
+	
+	def _ndjson_rows(self, text):
+		for line, content in enumerate(text, 1):
+			if not content.strip():
+				continue
+			try:
+				yield line, json.loads(content), None
+			except ValueError as e:
+				yield line, None, f'Invalid JSON: {e}'
+	
+	def _csv_rows(self, text):
+		reader = csv.DictReader(text)
+		for row in reader:
+			# 空值视为使用默认值
+			data = {field: value.strip() for field, value in row.items()
+			        if field in RULE_FIELDS and value is not None and value.strip() != ''}
+			
+			error = None
+			if 'priority' in data:
+				try:
+					data['priority'] = int(data['priority'])
+				except ValueError:
+					error = f"Invalid priority: {data['priority']}"
+			if 'enabled' in data:
+				enabled = data['enabled'].lower()
+				if enabled in ('true', '1', 'yes'):
+					data['enabled'] = True
+				elif enabled in ('false', '0', 'no'):
+					data['enabled'] = False
+				else:
+					error = f"Invalid enabled flag: {data['enabled']}"
+			yield reader.line_num, None if error else data, error
+	
+	def _valid_rows(self, rows):
+		"""校验每一行，记录无效行，产出有效的规则字段映射"""
+		for line, data, error in rows:
+			if error is None:
+				if not isinstance(data, dict):
+					error = 'Rule must be an object'
+				else:
+					error = validate_rule_data(data)
+			if error is not None:
+				self.invalid += 1
+				if len(self.errors) < IMPORT_MAX_ERRORS:
+					self.errors.append({'line': line, 'message': error})
+				continue
+			yield rule_values(data)
+	
+	def import_rows(self, rows):
+		"""批量写入已校验的规则字段映射，每个后端一次内核事务应用后提交；失败时回滚并恢复已应用的后端"""
+		rule_types = set()
+		applied = []
+		batch = []
+		try:
+			for row in rows:
+				batch.append(row)
+				rule_types.add(row['rule_type'])
+				if len(batch) >= IMPORT_BATCH_SIZE:
+					self._insert(batch)
+					batch = []
+			if batch:
+				self._insert(batch)
+			
+			# 批量写入的规则尚未提交，按数据库状态为每个后端生成一次内核事务
+			for rule_type in sorted(rule_types):
+				self.reconciler.apply_plan(self.reconciler.plan(rule_type))
+				applied.append(rule_type)
+			db.session.commit()
+		except Exception as e:
+			current_app.logger.error(f"Error applying imported rules: {e}")
+			db.session.rollback()
+			self.imported = 0
+			# 数据库已回滚，按回滚后的规则重新协调已经应用的后端
+			for rule_type in applied:
+				try:
+					self.reconciler.reconcile(rule_type)
+				except Exception as revert_error:
+					current_app.logger.error(f"Error reverting {rule_type} import: {revert_error}")
+			raise
+	
+	def _insert(self, batch):
+		# 批量写入不触发flush事件，显式记录规则集代数
+		generation = bump_generation(db.session)
+		for row in batch:
+			row['generation'] = generation
+		db.session.bulk_insert_mappings(FirewallRule, batch)
+		self.imported += len(batch)
+		if self.progress:
+			self.progress(self.imported)
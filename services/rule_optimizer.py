@@ -0,0 +1,158 @@
+# services/rule_optimizer.py
+import heapq
+from models import db, FirewallRule
+from services.firewall_manager import FirewallManager
+from services.rule_analyzer import ChainIndex, TERMINAL_ACTIONS, rule_space
+from services.rule_reconciler import RuleReconciler
+
+# 应用重排时重新分配的优先级间隔，便于之后手工插入规则
+PRIORITY_STEP = 10
+
+
+class RuleOptimizer:
+	"""根据规则命中计数估算每条链每个包的平均规则匹配次数，并提出保持语义的重排方案
+	
+	只有匹配空间互不重叠的规则才会交换相对顺序；编译进同一集合的规则作为一个整体移动。
+	"""
+	
+	def __init__(self, firewall_manager=None):
+		self.firewall_manager = firewall_manager or FirewallManager()
+	
+	def propose(self, rule_type='all', chain=None):
+		"""读取计数器并为每条链生成重排方案"""
+		rule_types = ['iptables', 'nftables'] if rule_type == 'all' else [rule_type]
+		chains = []
+		
+		for current_type in rule_types:
+			query = FirewallRule.query.filter_by(rule_type=current_type, enabled=True)
+			if chain:
+				query = query.filter_by(chain=chain)
+			rules = query.order_by(FirewallRule.priority, FirewallRule.id).all()
+			if not rules:
+				continue
+			
+			counters = self.firewall_manager.read_counters(current_type)
+			by_chain = {}
+			for rule in rules:
+				by_chain.setdefault(rule.chain, []).append(rule)
+			for chain_rules in by_chain.values():
+				chains.append(self.propose_chain(chain_rules, counters))
+		
+		return {'chains': chains}
+	
+	def apply(self, rule_type='all', chain=None):
+		"""按方案重新分配优先级，并通过规则协调一次性应用到内核"""
+		proposal = self.propose(rule_type, chain)
+		
+		changed_types = set()
+		for chain_plan in proposal['chains']:
+			if not chain_plan['moves']:
+				continue
+			rules = {rule.id: rule for rule in FirewallRule.query.filter(
+				FirewallRule.id.in_(chain_plan['order'])).all()}
+			for index, rule_id in enumerate(chain_plan['order']):
+				rules[rule_id].priority = (index + 1) * PRIORITY_STEP
+			changed_types.add(chain_plan['rule_type'])
+		db.session.commit()
+		
+		reconciler = RuleReconciler(self.firewall_manager)
+		for changed_type in sorted(changed_types):
+			reconciler.reconcile(changed_type)
+		
+		proposal['applied'] = sorted(changed_types)
+		return proposal
+	
+	def propose_chain(self, rules, counters):
+		"""为一条链中按求值顺序排列的规则生成重排方案"""
+		units = self._units(rules)
+		hits = [counters['rules'].get(unit[0].kernel_key, (0, 0))[0] for unit in units]
+		terminal = [(unit[0].action or '').upper() in TERMINAL_ACTIONS for unit in units]
+		entering = counters['chains'].get(rules[0].kernel_chain)
+		
+		order = self._reorder(units, hits)
+		current = list(range(len(units)))
+		
+		moves = []
+		for new_position, index in enumerate(order):
+			if new_position != index:
+				moves.append({
+					'rule_ids': [rule.id for rule in units[index]],
+					'from': index + 1,
+					'to': new_position + 1,
+					'packets': hits[index]
+				})
+		
+		return {
+			'rule_type': rules[0].rule_type,
+			'chain': rules[0].chain,
+			'rules': len(units),
+			'packets': entering,
+			'current_cost': self.expected_cost(current, hits, terminal, entering),
+			'proposed_cost': self.expected_cost(order, hits, terminal, entering),
+			'moves': moves,
+			'order': [rule.id for index in order for rule in units[index]]
+		}
+	
+	def _units(self, rules):
+		"""把编译进同一集合的连续规则合并为一个移动单元"""
+		units = []
+		for rule in rules:
+			if units and rule.kernel_set and units[-1][0].kernel_set == rule.kernel_set:
+				units[-1].append(rule)
+			else:
+				units.append([rule])
+		return units
+	
+	def expected_cost(self, order, hits, terminal, entering=None):
+		"""每个包的平均规则匹配次数：命中终止规则的包在该规则处停止，其余包遍历整条链"""
+		matched = sum(hits[index] for index in order if terminal[index])
+		total = max(entering or 0, matched)
+		if not total:
+			return None
+		
+		cost = sum((position + 1) * hits[index] for position, index in enumerate(order) if terminal[index])
+		cost += (total - matched) * len(order)
+		return round(cost / total, 3)
+	
+	def _reorder(self, units, hits):
+		"""在保持重叠规则相对顺序的前提下，按命中数从高到低贪心排序（带约束的拓扑排序）"""
+		spaces = [[rule_space(rule) for rule in unit] for unit in units]
+		
+		# 无法解析匹配空间的规则作为屏障，不跨越它移动
+		order = []
+		start = 0
+		for index, unit_spaces in enumerate(spaces + [[None]]):
+			if any(space is None for space in unit_spaces):
+				order.extend(self._reorder_segment(list(range(start, index)), spaces, hits))
+				if index < len(units):
+					order.append(index)
+				start = index + 1
+		return order
+	
+	def _reorder_segment(self, indexes, spaces, hits):
+		if len(indexes) < 2:
+			return indexes
+		
+		entries = [(index, None, space) for index in indexes for space in spaces[index]]
+		chain_index = ChainIndex(entries)
+		successors = {index: set() for index in indexes}
+		blockers = {index: 0 for index in indexes}
+		for index, _, space in entries:
+			for earlier, _, other in chain_index.overlapping(space):
+				if earlier >= index or index in successors[earlier]:
+					continue
+				if other.protocol == 'all' or space.protocol == 'all' or other.protocol == space.protocol:
+					successors[earlier].add(index)
+					blockers[index] += 1
+		
+		ready = [(-hits[index], index) for index in indexes if not blockers[index]]
+		heapq.heapify(ready)
+		order = []
+		while ready:
+			_, index = heapq.heappop(ready)
+			order.append(index)
+			for successor in successors[index]:
+				blockers[successor] -= 1
+				if not blockers[successor]:
+					heapq.heappush(ready, (-hits[successor], successor))
+		return order
@@ -0,0 +1,116 @@
+# services/rule_order.py
+import bisect
+import threading
+from models import FirewallRule
+from models.rule import managed_chain_name
+from services.ruleset_cache import ruleset_cache
+
+
+def order_key(rule):
+	"""规则在受管链中的排序键，与协调器的期望顺序（优先级, id）一致"""
+	return (rule.priority if rule.priority is not None else 0, rule.id or 0)
+
+
+class ChainOrder:
+	"""一条受管链的排序索引：按内核中的顺序排列的排序键，以及对应的nftables句柄
+	
+	编译为集合/ipset的多条规则共享一条内核规则，以其中最小的键占据一个位置；
+	iptables规则的位置即下标加一，nftables规则以句柄定位。
+	"""
+	
+	def __init__(self, units):
+		self.keys = [key for key, _ in units]
+		self.handles = [handle for _, handle in units]
+	
+	def placement(self, key):
+		"""新规则的插入下标，以及插入位置之后第一条内核规则的句柄（插在末尾时为None）"""
+		index = bisect.bisect_right(self.keys, key)
+		return index, self.handles[index] if index < len(self.handles) else None
+	
+	def insert(self, index, key, handle=None):
+		self.keys.insert(index, key)
+		self.handles.insert(index, handle)
+	
+	def remove(self, key):
+		"""移除单独内核规则的键，返回其下标；找不到时返回None"""
+		index = bisect.bisect_left(self.keys, key)
+		if index < len(self.keys) and self.keys[index] == key:
+			del self.keys[index]
+			del self.handles[index]
+			return index
+		return None
+
+
+class RuleOrderIndex:
+	"""进程内各受管链的排序索引：插入时二分查找位置，直接插入到位，不重写规则集
+	
+	本进程逐条插入/删除规则时同步更新索引；其他方式的内核修改（协调、批量应用、恢复）
+	使规则集缓存的代数变化，索引随之整体失效，下次使用时由数据库记录重建。
+	"""
+	
+	def __init__(self):
+		self.chains = {}
+		self.generation = None
+		self._lock = threading.Lock()
+	
+	def chain(self, manager, rule_type, chain):
+		"""返回受管链的排序索引，失效时重建"""
+		with self._lock:
+			if self.generation != ruleset_cache.generation:
+				self.chains.clear()
+				self.generation = ruleset_cache.generation
+			order = self.chains.get((rule_type, chain))
+		
+		if order is None:
+			order = ChainOrder(self._load(manager, rule_type, chain))
+			with self._lock:
+				self.chains[(rule_type, chain)] = order
+		return order
+	
+	def written(self, generation):
+		"""本进程的一次修改已同步到索引：generation为修改前的代数，期间有其他修改时索引全部失效"""
+		with self._lock:
+			if self.generation == generation and ruleset_cache.generation == generation + 1:
+				self.generation = ruleset_cache.generation
+				return
+		self.invalidate()
+	
+	def removed(self, rule_type, chain, key, generation):
+		"""本进程删除了一条单独的内核规则：从索引中移除其键，找不到时索引全部失效"""
+		with self._lock:
+			valid = self.generation == generation
+			order = self.chains.get((rule_type, chain))
+		# 尚未加载的链以后由数据库记录构建，不受影响
+		if valid and (order is None or order.remove(key) is not None):
+			self.written(generation)
+		else:
+			self.invalidate()
+	
+	def invalidate(self):
+		with self._lock:
+			self.chains.clear()
+			self.generation = None
+	
+	@staticmethod
+	def _load(manager, rule_type, chain):
+		"""由数据库中记录的内核位置/句柄构建索引，按内核中的顺序排列"""
+		query = FirewallRule.query.filter_by(rule_type=rule_type, chain=chain, enabled=True)
+		if rule_type == 'iptables':
+			rules = query.filter(FirewallRule.kernel_position.isnot(None)).order_by(FirewallRule.kernel_position)
+			units = {}
+			for rule in rules:
+				key = order_key(rule)
+				units[rule.kernel_position] = min(units.get(rule.kernel_position, key), key)
+			return [(units[position], None) for position in sorted(units)]
+		
+		units = {}
+		for rule in query.filter(FirewallRule.kernel_handle.isnot(None)):
+			key = order_key(rule)
+			units[rule.kernel_handle] = min(units.get(rule.kernel_handle, key), key)
+		# 只保留内核中仍存在的句柄，并按其在链中的实际顺序排列
+		live_handles = manager.nftables_chain_handles().get(managed_chain_name(chain), [])
+		return [(units[handle], handle) for handle in live_handles if handle in units]
+
+
+# 进程内共享的排序索引
+rule_order_index = RuleOrderIndex()
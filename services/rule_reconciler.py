@@ -0,0 +1,458 @@
+# services/rule_reconciler.py
+from collections import Counter
+from datetime import datetime
+from difflib import SequenceMatcher
+from sqlalchemy import or_
+from models import db, FirewallRule
+from models.rule import MANAGED_CHAIN_PREFIX, managed_chain_name, rule_signature, iptables_restore_line
+from services.firewall_manager import FirewallManager, NFTABLES_BASE_CHAIN_HOOKS
+from services.nftables_backend import NftablesBackend, NFTABLES_FAMILY, NFTABLES_TABLE, table_ref, chain_ref, rule_ref, \
+	jump_rule
+from services.rule_compiler import RuleCompiler, CompiledGroup, SET_KIND_VERDICT_MAP, SET_KIND_TIMEOUT, set_kind, \
+	element_key, plain_element, unit_rules, assign_kernel_handle
+from services.ipset_backend import IpsetRuleCompiler
+from services.chain_sharder import ChainSharder, shard_chain
+from services.object_group import object_group_sets
+from services.ruleset_parser import parse_iptables_rule, parse_nft_rule
+
+
+class RuleReconciler:
+	"""期望状态协调器：以数据库规则为准，与内核受管链比对后只应用差异"""
+	
+	def __init__(self, firewall_manager=None, compiler=None):
+		self.firewall_manager = firewall_manager or FirewallManager()
+		self.compiler = compiler or RuleCompiler()
+		self.ipset_compiler = IpsetRuleCompiler()
+	
+	def reconcile(self, rule_type='all', dry_run=False):
+		"""协调规则；dry_run为True时只生成计划，不修改内核"""
+		rule_types = ['iptables', 'nftables'] if rule_type == 'all' else [rule_type]
+		plans = [self.plan(t) for t in rule_types]
+		
+		if not dry_run:
+			for plan in plans:
+				self.apply_plan(plan)
+			db.session.commit()
+		
+		return {
+			'dry_run': dry_run,
+			'plans': [self.plan_to_dict(plan) for plan in plans]
+		}
+	
+	def build_desired_state(self, rule_type, exclude=(), shard=True):
+		"""根据数据库规则构建期望状态：基础链 -> 按优先级排序的编译单元列表
+		
+		配置为分片的基础链拆分为多条子链（以 基础链.协议[.端口桶] 为键），每条子链开头是分发规则；
+		exclude为不计入期望状态的规则id（即将删除的规则），shard为False时不拆分。
+		"""
+		# 已过期的规则等待批量清理，不再属于期望状态（超时集合中的元素已由内核删除）
+		query = FirewallRule.query.filter_by(rule_type=rule_type, enabled=True).filter(
+			or_(FirewallRule.expires_at.is_(None), FirewallRule.expires_at > datetime.utcnow()))
+		if exclude:
+			query = query.filter(FirewallRule.id.notin_(list(exclude)))
+		rules = query.order_by(FirewallRule.priority, FirewallRule.id).all()
+		
+		desired = {}
+		for rule in rules:
+			desired.setdefault(rule.chain, []).append(rule)
+		
+		shards = {}
+		sharder = ChainSharder(chains=None if shard else ())
+		for chain, chain_rules in desired.items():
+			shards.update(sharder.shard(chain, chain_rules))
+		
+		# 将连续的同类规则编译为nftables命名集合/判决映射，或iptables使用的ipset
+		if rule_type == 'nftables':
+			compiler = self.compiler
+		elif self.firewall_manager.ipset.available():
+			compiler = self.ipset_compiler
+		else:
+			return {chain: jumps + chain_rules for chain, (jumps, chain_rules) in shards.items()}
+		return {chain: jumps + compiler.compile_chain(chain, chain_rules)
+		        for chain, (jumps, chain_rules) in shards.items()}
+	
+	def fetch_live_state(self, rule_type, max_age=0):
+		"""一次性读取内核现状：已存在的链、受管链中的规则、已有的跳转
+		
+		计划据此按位置/句柄删除规则，因此默认总是重新读取内核校验快照；
+		max_age只用于不写入内核的展示类读取（如验证）。
+		"""
+		if rule_type == 'iptables':
+			return self._fetch_iptables_state(max_age)
+		return self._fetch_nftables_state(max_age)
+	
+	def _fetch_iptables_state(self, max_age=0):
+		"""由filter表的 -S 快照和 ipset save 快照得到现状（内容未变时复用解析结果）"""
+		manager = self.firewall_manager
+		state = dict(manager.snapshot('iptables', max_age).derive('live_state', self._build_iptables_state))
+		
+		if manager.ipset.available():
+			snapshot = manager.snapshot('ipset', max_age)
+			state['set_info'] = snapshot.data
+			state['sets'] = snapshot.derive('elements', lambda sets: {
+				name: info['elements'] for name, info in sets.items()
+			})
+		return state
+	
+	def _build_iptables_state(self, lines):
+		state = {'chains': set(), 'rules': {}, 'jumps': set(), 'sets': {}, 'set_info': {}}
+		for line in lines:
+			parts = line.split()
+			if len(parts) < 2:
+				continue
+			if parts[0] in ('-P', '-N'):
+				state['chains'].add(parts[1])
+			elif parts[0] == '-A':
+				self._add_live_rule(state, parse_iptables_rule(line))
+		return state
+	
+	def _fetch_nftables_state(self, max_age=0):
+		"""由规则集快照中的filter表得到现状（包括编译集合及其元素，内容未变时复用解析结果）"""
+		try:
+			snapshot = self.firewall_manager.snapshot('nftables', max_age)
+		except Exception:
+			return {'chains': set(), 'rules': {}, 'jumps': set(), 'sets': {}}
+		return snapshot.derive('live_state', self._build_nftables_state)
+	
+	def _build_nftables_state(self, items):
+		state = {'chains': set(), 'rules': {}, 'jumps': set(), 'sets': {}}
+		for item in items:
+			kind, definition = next(iter(item.items()))
+			if not isinstance(definition, dict) or definition.get('family') != NFTABLES_FAMILY or \
+					definition.get('table') != NFTABLES_TABLE:
+				continue
+			
+			if kind == 'chain':
+				state['chains'].add(definition.get('name'))
+			elif kind in ('set', 'map'):
+				if definition.get('name', '').startswith(MANAGED_CHAIN_PREFIX):
+					state['sets'][definition['name']] = {
+						element_key(element): plain_element(element) for element in definition.get('elem', [])
+					}
+			elif kind == 'rule':
+				self._add_live_rule(state, parse_nft_rule(definition))
+		
+		return state
+	
+	def _add_live_rule(self, state, rule_data):
+		"""将解析出的内核规则记入现状"""
+		chain = rule_data.get('chain') or ''
+		action = rule_data.get('action') or ''
+		
+		if action.startswith(MANAGED_CHAIN_PREFIX) and not chain.startswith(MANAGED_CHAIN_PREFIX):
+			state['jumps'].add(chain)
+		elif chain.startswith(MANAGED_CHAIN_PREFIX):
+			chain_rules = state['rules'].setdefault(chain, [])
+			chain_rules.append({
+				'position': len(chain_rules) + 1,
+				'handle': rule_data.get('handle'),
+				'signature': rule_signature(rule_data.get('protocol'), rule_data.get('source'),
+				                            rule_data.get('destination'), rule_data.get('port'), action)
+			})
+	
+	def plan(self, rule_type, exclude=()):
+		"""计算把内核受管链变为期望状态所需的最小增删/移动计划"""
+		desired = self.build_desired_state(rule_type, exclude)
+		live = self.fetch_live_state(rule_type)
+		
+		base_chains = set(desired)
+		base_chains.update(chain[len(MANAGED_CHAIN_PREFIX):] for chain in live['rules'])
+		
+		chains = []
+		for base_chain in sorted(base_chains):
+			managed_chain = managed_chain_name(base_chain)
+			chain_plan = self._plan_chain(desired.get(base_chain, []), live['rules'].get(managed_chain, []))
+			# 分片子链只由其上一级受管链中的分发规则goto进入
+			shard = shard_chain(base_chain)
+			chain_plan.update({
+				'base_chain': base_chain,
+				'managed_chain': managed_chain,
+				'create_base_chain': not shard and base_chain not in live['chains'],
+				'create_chain': managed_chain not in live['chains'],
+				'create_jump': not shard and base_chain not in live['jumps']
+			})
+			chains.append(chain_plan)
+		
+		plan = {'rule_type': rule_type, 'chains': chains, 'sets': [], 'obsolete_sets': []}
+		self._plan_sets(plan, live['sets'], live.get('set_info', {}), self.object_group_sets(rule_type, desired))
+		return plan
+	
+	def object_group_sets(self, rule_type, desired):
+		"""期望状态中单独的规则所引用的对象组集合"""
+		if rule_type == 'iptables' and not self.firewall_manager.ipset.available():
+			return []
+		return object_group_sets(rule_type, [unit for units in desired.values() for unit in units
+		                                     if not isinstance(unit, CompiledGroup)])
+	
+	def _plan_sets(self, plan, live_sets, set_info, group_sets=()):
+		"""比对编译集合和对象组集合的元素，只增删有变化的元素；不再使用的集合在规则删除后移除
+		
+		ipset中变化超过一半的集合（或超出其maxelem）改为全量重载：填充临时集合后swap。
+		"""
+		desired_sets = [unit for chain_plan in plan['chains'] for unit in chain_plan['rules']
+		                if isinstance(unit, CompiledGroup)]
+		desired_sets.extend(group_sets)
+		
+		desired_names = set()
+		for unit in desired_sets:
+			desired_names.add(unit.name)
+			desired_elements = unit.elements()
+			live_elements = live_sets.get(unit.name, {})
+			set_plan = {
+				'group': unit,
+				'elements': desired_elements,
+				'create': unit.name not in live_sets,
+				'add': [element for key, element in desired_elements.items() if key not in live_elements],
+				'delete': [element for key, element in live_elements.items() if key not in desired_elements],
+				'full_reload': False
+			}
+			if unit.name in set_info:
+				changes = len(set_plan['add']) + len(set_plan['delete'])
+				set_plan['full_reload'] = changes > len(desired_elements) // 2 or \
+				                          len(desired_elements) > set_info[unit.name]['maxelem']
+			plan['sets'].append(set_plan)
+		
+		plan['obsolete_sets'] = sorted(name for name in live_sets if name not in desired_names)
+	
+	def _plan_chain(self, desired_rules, live_rules):
+		"""基于最长公共子序列比对单条链，保留的规则不动，其余删除或插入"""
+		live_signatures = [entry['signature'] for entry in live_rules]
+		desired_signatures = [rule.signature() for rule in desired_rules]
+		
+		matcher = SequenceMatcher(None, live_signatures, desired_signatures, autojunk=False)
+		kept = {}  # 期望索引 -> 现状索引
+		for block in matcher.get_matching_blocks():
+			for offset in range(block.size):
+				kept[block.b + offset] = block.a + offset
+		kept_live = set(kept.values())
+		
+		deletes = [entry for index, entry in enumerate(live_rules) if index not in kept_live]
+		
+		# 从后向前记录每条新增规则之后最近的保留规则，nftables据此确定插入位置
+		inserts = []
+		anchor = None
+		for index in range(len(desired_rules) - 1, -1, -1):
+			if index in kept:
+				anchor = live_rules[kept[index]]
+			else:
+				inserts.append({'index': index, 'rule': desired_rules[index], 'before': anchor})
+		inserts.reverse()
+		
+		# 同一签名既被删除又被插入，即为移动
+		deleted = Counter(entry['signature'] for entry in deletes)
+		inserted = Counter(desired_signatures[insert['index']] for insert in inserts)
+		moves = sum(min(count, inserted[signature]) for signature, count in deleted.items())
+		
+		return {
+			'rules': desired_rules,
+			'kept': {index: live_rules[live_index] for index, live_index in kept.items()},
+			'deletes': deletes,
+			'inserts': inserts,
+			'moves': moves,
+			'unchanged': len(kept)
+		}
+	
+	def plan_has_changes(self, plan):
+		return plan['obsolete_sets'] or any(
+			set_plan['create'] or set_plan['add'] or set_plan['delete'] for set_plan in plan['sets']
+		) or self.chains_have_changes(plan)
+	
+	def chains_have_changes(self, plan):
+		return any(
+			chain_plan['deletes'] or chain_plan['inserts'] or chain_plan['create_chain'] or chain_plan['create_jump']
+			for chain_plan in plan['chains']
+		)
+	
+	def apply_plan(self, plan):
+		"""以单个内核事务应用计划，并刷新规则记录的内核位置/句柄"""
+		if not self.plan_has_changes(plan):
+			return False
+		
+		if plan['rule_type'] == 'iptables':
+			# 集合先于引用它们的规则就绪；不再引用的集合在规则删除后销毁
+			ipset = self.firewall_manager.ipset
+			if plan['sets']:
+				ipset.restore(self.render_ipset_plan(plan))
+			if self.chains_have_changes(plan):
+				self.firewall_manager.run_iptables_restore(self.render_iptables_plan(plan))
+			if plan['obsolete_sets']:
+				ipset.restore([f'destroy {name}' for name in plan['obsolete_sets']])
+			
+			for chain_plan in plan['chains']:
+				for index, unit in enumerate(chain_plan['rules']):
+					for rule in unit_rules(unit):
+						rule.kernel_position = index + 1
+						rule.kernel_set = getattr(unit, 'name', None)
+		else:
+			items = self.firewall_manager.nftables.run(self.build_nftables_commands(plan), echo=True)
+			
+			# echo输出的句柄顺序与提交的新增规则顺序一致（跳转规则对应None）
+			inserted = []
+			for chain_plan in plan['chains']:
+				inserted.extend(insert['rule'] for insert in chain_plan['inserts'])
+				if chain_plan['create_jump']:
+					inserted.append(None)
+			for unit, handle in zip(inserted, NftablesBackend.echo_handles(items)):
+				if unit is not None:
+					assign_kernel_handle(unit, handle)
+			
+			for chain_plan in plan['chains']:
+				for index, entry in chain_plan['kept'].items():
+					assign_kernel_handle(chain_plan['rules'][index], entry['handle'])
+		
+		for chain_plan in plan['chains']:
+			self.firewall_manager.mark_managed_chain(plan['rule_type'], chain_plan['base_chain'])
+		
+		return True
+	
+	def render_iptables_plan(self, plan):
+		"""渲染为iptables-restore输入：先按位置倒序删除，再按目标位置顺序插入"""
+		lines = ['*filter']
+		for chain_plan in plan['chains']:
+			if chain_plan['create_base_chain'] and chain_plan['base_chain'] not in NFTABLES_BASE_CHAIN_HOOKS:
+				lines.append(f":{chain_plan['base_chain']} - [0:0]")
+			if chain_plan['create_chain']:
+				lines.append(f":{chain_plan['managed_chain']} - [0:0]")
+		
+		for chain_plan in plan['chains']:
+			managed_chain = chain_plan['managed_chain']
+			for entry in sorted(chain_plan['deletes'], key=lambda e: e['position'], reverse=True):
+				lines.append(f"-D {managed_chain} {entry['position']}")
+			for insert in chain_plan['inserts']:
+				spec = iptables_restore_line(insert['rule'].iptables_rule_spec())
+				lines.append(f"-I {managed_chain} {insert['index'] + 1} {spec}")
+			if chain_plan['create_jump']:
+				lines.append(f"-I {chain_plan['base_chain']} 1 -j {managed_chain}")
+		
+		lines.append('COMMIT')
+		return '\n'.join(lines) + '\n'
+	
+	def render_ipset_plan(self, plan):
+		"""渲染为ipset restore输入"""
+		ipset = self.firewall_manager.ipset
+		lines = []
+		for set_plan in plan['sets']:
+			group = set_plan['group']
+			timeout = group.kind == SET_KIND_TIMEOUT
+			if set_plan['create']:
+				lines.extend(ipset.render_set(group.name, group.set_type, set_plan['elements'], timeout=timeout))
+			elif set_plan['full_reload']:
+				lines.extend(ipset.render_set(group.name, group.set_type, set_plan['elements'], full_reload=True,
+				                              timeout=timeout))
+			else:
+				lines.extend(f'del {group.name} {element}' for element in set_plan['delete'])
+				lines.extend(f'add {group.name} {element}' for element in set_plan['add'])
+		return lines
+	
+	def build_nftables_commands(self, plan):
+		"""构建JSON命令批次：按句柄删除，插入到其后最近保留规则之前"""
+		commands = [{'add': table_ref()}]
+		for chain_plan in plan['chains']:
+			base_chain = chain_plan['base_chain']
+			managed_chain = chain_plan['managed_chain']
+			
+			if chain_plan['create_base_chain']:
+				commands.append({'add': chain_ref(base_chain, NFTABLES_BASE_CHAIN_HOOKS.get(base_chain))})
+			if chain_plan['create_chain']:
+				commands.append({'add': chain_ref(managed_chain)})
+		
+		# 集合元素先于引用它们的规则更新，整批在同一事务中生效
+		for set_plan in plan['sets']:
+			group = set_plan['group']
+			if set_plan['create']:
+				commands.append({'add': group.set_object()})
+			if set_plan['delete']:
+				elements = set_plan['delete']
+				if group.kind == SET_KIND_VERDICT_MAP:
+					elements = [self._map_element_key(element) for element in elements]
+				commands.append({'delete': self._element_object(group.name, elements)})
+			if set_plan['add']:
+				commands.append({'add': self._element_object(group.name, set_plan['add'])})
+		
+		for chain_plan in plan['chains']:
+			base_chain = chain_plan['base_chain']
+			managed_chain = chain_plan['managed_chain']
+			
+			for entry in chain_plan['deletes']:
+				commands.append({'delete': rule_ref(managed_chain, entry['handle'])})
+			for insert in chain_plan['inserts']:
+				if insert['before']:
+					command = insert['rule'].to_nftables_json('insert', position=insert['before']['handle'])
+				else:
+					command = insert['rule'].to_nftables_json()
+				# 分片子链中的规则副本按其数据库记录仍指向基础链的受管链
+				next(iter(command.values()))['rule']['chain'] = managed_chain
+				commands.append(command)
+			if chain_plan['create_jump']:
+				commands.append({'insert': jump_rule(base_chain, managed_chain)})
+		
+		for name in plan['obsolete_sets']:
+			kind = 'map' if set_kind(name) == SET_KIND_VERDICT_MAP else 'set'
+			commands.append({'delete': {kind: {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'name': name}}})
+		
+		return commands
+	
+	def _element_object(self, name, elements):
+		return {'element': {'family': NFTABLES_FAMILY, 'table': NFTABLES_TABLE, 'name': name, 'elem': elements}}
+	
+	def _map_element_key(self, element):
+		"""判决映射元素 [键, 判决] 删除时只需要键"""
+		if isinstance(element, dict) and 'elem' in element:
+			element = element['elem'].get('val')
+		return element[0] if isinstance(element, list) else element
+	
+	def plan_to_dict(self, plan):
+		"""将计划转换为可序列化的结构"""
+		chains = []
+		summary = {'add': 0, 'delete': 0, 'move': 0, 'unchanged': 0}
+		
+		for chain_plan in plan['chains']:
+			chains.append({
+				'chain': chain_plan['base_chain'],
+				'managed_chain': chain_plan['managed_chain'],
+				'create_chain': chain_plan['create_chain'],
+				'create_jump': chain_plan['create_jump'],
+				'add': [{
+					'rule_id': insert['rule'].id,
+					'rule_ids': [rule.id for rule in unit_rules(insert['rule'])],
+					'set': getattr(insert['rule'], 'name', None),
+					'position': insert['index'] + 1,
+					'signature': list(insert['rule'].signature())
+				} for insert in chain_plan['inserts']],
+				'delete': [{
+					'position': entry['position'],
+					'handle': entry['handle'],
+					'signature': list(entry['signature'])
+				} for entry in chain_plan['deletes']],
+				'move': chain_plan['moves'],
+				'unchanged': chain_plan['unchanged']
+			})
+			summary['add'] += len(chain_plan['inserts'])
+			summary['delete'] += len(chain_plan['deletes'])
+			summary['move'] += chain_plan['moves']
+			summary['unchanged'] += chain_plan['unchanged']
+		
+		sets = []
+		summary.update({'elements_added': 0, 'elements_deleted': 0})
+		for set_plan in plan['sets']:
+			group = set_plan['group']
+			sets.append({
+				'name': group.name,
+				'kind': group.kind,
+				'chain': group.chain,
+				'rule_ids': [rule.id for rule in group.rules],
+				'create': set_plan['create'],
+				'full_reload': set_plan['full_reload'],
+				'add': len(set_plan['add']),
+				'delete': len(set_plan['delete'])
+			})
+			summary['elements_added'] += len(set_plan['add'])
+			summary['elements_deleted'] += len(set_plan['delete'])
+		
+		return {
+			'rule_type': plan['rule_type'],
+			'chains': chains,
+			'sets': sets,
+			'obsolete_sets': plan['obsolete_sets'],
+			'summary': summary
+		}
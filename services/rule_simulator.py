@@ -0,0 +1,226 @@
+# services/rule_simulator.py
+import bisect
+import socket
+import struct
+from models import FirewallRule
+from services.rule_analyzer import TERMINAL_ACTIONS, ANY_PORTS, rule_space
+
+# 命中后记录并继续匹配后续规则的动作
+NON_TERMINAL_ACTIONS = ('LOG',)
+
+# 跳转到自定义链的最大嵌套深度
+MAX_JUMP_DEPTH = 16
+
+
+def _parse_address(value):
+	"""IPv4地址字符串 -> 整数（inet_pton比ipaddress模块快一个数量级）"""
+	try:
+		return struct.unpack('!I', socket.inet_pton(socket.AF_INET, value or '0.0.0.0'))[0]
+	except (OSError, TypeError):
+		raise ValueError(f"Invalid packet address: {value}")
+
+
+class _PortIndex:
+	"""端口区间的线段树：按端口查找顺序号大于给定值的第一条规则，O(log² n)
+	
+	区间按基本端口段拆分到线段树节点上，每个节点保存排好序的顺序号；
+	查询时沿叶子到根的路径在每个节点二分查找。
+	"""
+	
+	def __init__(self, items):
+		"""items为 (端口下界, 端口上界, 顺序号) 列表"""
+		self.bounds = sorted({point for low, high, _ in items for point in (low, high + 1)})
+		self.size = 1
+		while self.size < len(self.bounds):
+			self.size *= 2
+		
+		nodes = {}
+		any_ports = []
+		for low, high, position in items:
+			if (low, high) == ANY_PORTS:
+				any_ports.append(position)
+			left = bisect.bisect_left(self.bounds, low) + self.size
+			right = bisect.bisect_left(self.bounds, high + 1) + self.size
+			while left < right:
+				if left & 1:
+					nodes.setdefault(left, []).append(position)
+					left += 1
+				if right & 1:
+					right -= 1
+					nodes.setdefault(right, []).append(position)
+				left >>= 1
+				right >>= 1
+		
+		self.nodes = {node: sorted(positions) for node, positions in nodes.items()}
+		self.any_ports = sorted(any_ports)
+	
+	def first_after(self, port, after):
+		"""包含port（为None时只看未限定端口的规则）且顺序号大于after的最小顺序号"""
+		if port is None:
+			positions = self.any_ports
+			index = bisect.bisect_right(positions, after)
+			return positions[index] if index < len(positions) else None
+		
+		segment = bisect.bisect_right(self.bounds, port) - 1
+		if segment < 0 or segment >= len(self.bounds) - 1:
+			return None
+		
+		best = None
+		node = segment + self.size
+		while node:
+			positions = self.nodes.get(node)
+			if positions:
+				index = bisect.bisect_right(positions, after)
+				if index < len(positions) and (best is None or positions[index] < best):
+					best = positions[index]
+			node >>= 1
+		return best
+
+
+class _CompiledChain:
+	"""一条链的判定结构：协议 -> 源网段 -> 目标网段 -> 端口线段树
+	
+	查询一个数据包时只访问包地址各级上级网段中实际存在的桶（按规则中出现过的前缀长度逐级查找），
+	再在这些桶的端口线段树中按顺序号逐条取出下一条匹配的规则。
+	"""
+	
+	def __init__(self, entries):
+		"""entries为 (顺序号, 规则, 匹配空间) 列表"""
+		self.entries = {entry[0]: entry for entry in entries}
+		
+		tables = {}
+		for position, _, space in entries:
+			tables.setdefault(space.protocol, {}).setdefault(space.source, {}).setdefault(
+				space.destination, []).append((space.ports[0], space.ports[1], position))
+		
+		# 协议 -> (源前缀长度列表, {源键: (目标前缀长度列表, {目标键: 端口线段树})})
+		self.tables = {}
+		for protocol, sources in tables.items():
+			buckets = {}
+			for source, destinations in sources.items():
+				buckets[source] = (
+					sorted({destination[0] for destination in destinations}),
+					{destination: _PortIndex(items) for destination, items in destinations.items()}
+				)
+			self.tables[protocol] = (sorted({source[0] for source in sources}), buckets)
+	
+	def match(self, protocol, source, destination, port):
+		"""按顺序号逐条产出匹配数据包的条目；惰性计算，调用方找到终止规则后即停止"""
+		indexes = []
+		for table_protocol in ((protocol, 'all') if protocol != 'all' else ('all',)):
+			table = self.tables.get(table_protocol)
+			if table is None:
+				continue
+			source_lengths, buckets = table
+			for source_length in source_lengths:
+				bucket = buckets.get((source_length, source >> (32 - source_length)))
+				if bucket is None:
+					continue
+				destination_lengths, port_indexes = bucket
+				for destination_length in destination_lengths:
+					port_index = port_indexes.get((destination_length, destination >> (32 - destination_length)))
+					if port_index is not None:
+						indexes.append(port_index)
+		
+		position = -1
+		while True:
+			best = None
+			for port_index in indexes:
+				candidate = port_index.first_after(port, position)
+				if candidate is not None and (best is None or candidate < best):
+					best = candidate
+			if best is None:
+				return
+			yield self.entries[best]
+			position = best
+
+
+class RuleSimulator:
+	"""进程内数据包分类：按求值顺序（priority, id）编译启用的规则，不访问内核
+	
+	每个数据包在链中找到第一条终止规则，途经的LOG规则记入trace；动作为有规则的自定义链时
+	进入该链，RETURN或自定义链结束时返回上级链。没有规则命中时由链的默认策略决定（verdict为None）。
+	"""
+	
+	def __init__(self, rule_type='iptables'):
+		self.rule_type = rule_type
+		self.chains = {}
+		self.skipped = []
+	
+	def compile(self, rules=None):
+		"""编译规则；rules为空时从数据库读取该类型启用的规则"""
+		if rules is None:
+			rules = FirewallRule.query.filter_by(rule_type=self.rule_type, enabled=True).order_by(
+				FirewallRule.priority, FirewallRule.id).all()
+		
+		entries = {}
+		self.skipped = []
+		for position, rule in enumerate(rules):
+			space = rule_space(rule)
+			if space is None:
+				# 非IPv4地址或引用集合的规则无法在进程内判定
+				self.skipped.append(rule.id)
+				continue
+			entries.setdefault(rule.chain, []).append((position, rule, space))
+		
+		self.chains = {chain: _CompiledChain(chain_entries) for chain, chain_entries in entries.items()}
+		return self
+	
+	def simulate(self, packet, chain='INPUT'):
+		"""判定一个数据包：packet包含 protocol、source、destination、port（可选）"""
+		trace = []
+		try:
+			verdict, rule, path = self._evaluate(chain, self._parse_packet(packet), trace, [chain])
+		except ValueError as e:
+			return {'error': str(e)}
+		
+		return {
+			'matched': rule is not None,
+			'rule_id': rule.id if rule is not None else None,
+			'verdict': verdict,
+			'chain': path[-1] if rule is not None else chain,
+			'trace': trace
+		}
+	
+	def simulate_batch(self, packets, chain='INPUT'):
+		return [self.simulate(packet, chain) for packet in packets]
+	
+	def _evaluate(self, chain, packet, trace, path):
+		compiled = self.chains.get(chain)
+		if compiled is None:
+			return None, None, path
+		
+		for _, rule, _ in compiled.match(*packet):
+			action = (rule.action or '').upper()
+			if action in NON_TERMINAL_ACTIONS:
+				trace.append({'rule_id': rule.id, 'chain': chain, 'action': action})
+			elif action == 'RETURN':
+				trace.append({'rule_id': rule.id, 'chain': chain, 'action': action})
+				return None, None, path
+			elif action not in TERMINAL_ACTIONS and rule.action in self.chains:
+				if len(path) >= MAX_JUMP_DEPTH or rule.action in path:
+					raise ValueError(f"Jump loop detected at rule {rule.id}")
+				trace.append({'rule_id': rule.id, 'chain': chain, 'action': rule.action})
+				verdict, matched, target_path = self._evaluate(rule.action, packet, trace, path + [rule.action])
+				if matched is not None:
+					return verdict, matched, target_path
+			else:
+				return action if action in TERMINAL_ACTIONS else rule.action, rule, path
+		return None, None, path
+	
+	def _parse_packet(self, packet):
+		protocol = (packet.get('protocol') or 'all').lower()
+		source = _parse_address(packet.get('source'))
+		destination = _parse_address(packet.get('destination'))
+		
+		port = packet.get('port')
+		if port in (None, '', 'any') or protocol not in ('tcp', 'udp'):
+			port = None
+		else:
+			try:
+				port = int(port)
+			except (TypeError, ValueError):
+				raise ValueError(f"Invalid packet port: {port}")
+			if not 0 <= port <= 65535:
+				raise ValueError(f"Invalid packet port: {port}")
+		return protocol, source, destination, port
@@ -0,0 +1,265 @@
+# services/rule_template.py
+import hashlib
+import itertools
+import json
+import re
+import threading
+from collections import OrderedDict
+from models import db, FirewallRule, RuleCounterSample
+from models.rule import normalize_address, normalize_port, tombstone_rules
+from services.rule_batch import RULE_DEFAULTS, RULE_FIELDS, validate_rule_data
+from services.rule_compiler import CompiledGroup
+from services.rule_importer import RuleImporter
+from services.rule_reconciler import RuleReconciler
+from utils.validators import validate_ip_network, validate_port, validate_protocol, validate_chain, validate_action
+
+# 模板字段中引用参数的占位符：{{参数名}}
+TEMPLATE_PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# 一次展开最多生成的规则数
+TEMPLATE_MAX_RULES = 10000
+
+# 缓存的展开结果数量
+TEMPLATE_CACHE_SIZE = 64
+
+# 集合元素类型的参数放在笛卡尔积最内层，使同一组合展开的规则相邻，应用时可编译为集合
+TEMPLATE_ELEMENT_TYPES = ('addresses', 'ports')
+
+
+def _address_value(value):
+	if value != 'any' and not validate_ip_network(value):
+		raise ValueError(f'Invalid address: {value}')
+	return normalize_address(value)
+
+
+def _port_value(value):
+	value = normalize_port(value)
+	if value != 'any' and not validate_port(value):
+		raise ValueError(f'Invalid port: {value}')
+	return value
+
+
+def _protocol_value(value):
+	if not validate_protocol(value):
+		raise ValueError(f'Invalid protocol: {value}')
+	return value.lower()
+
+
+def _chain_value(value):
+	if not validate_chain(value):
+		raise ValueError(f'Invalid chain: {value}')
+	return value
+
+
+def _action_value(value):
+	if not validate_action(value) and not validate_chain(value):
+		raise ValueError(f'Invalid action: {value}')
+	return value
+
+
+# 参数类型 -> 单个取值的校验与规范化
+TEMPLATE_PARAMETER_TYPES = {
+	'addresses': _address_value,
+	'ports': _port_value,
+	'protocols': _protocol_value,
+	'chains': _chain_value,
+	'actions': _action_value,
+	'strings': str
+}
+
+
+def _split_values(value):
+	"""参数取值：列表，或以逗号/空白分隔的字符串"""
+	if value is None:
+		return []
+	if isinstance(value, (list, tuple)):
+		return [str(item).strip() for item in value if str(item).strip()]
+	return [item for item in re.split(r'[,\s]+', str(value)) if item]
+
+
+def parse_parameters(parameters):
+	"""校验参数定义（JSON文本或列表），返回定义列表"""
+	if isinstance(parameters, str):
+		parameters = json.loads(parameters) if parameters.strip() else []
+	if not isinstance(parameters, list):
+		raise ValueError('Template parameters must be a list')
+	
+	names = set()
+	for parameter in parameters:
+		if not isinstance(parameter, dict) or not parameter.get('name'):
+			raise ValueError('Template parameter must be an object with a name')
+		name = parameter['name']
+		if not re.match(r'^\w+$', name) or name in names:
+			raise ValueError(f'Invalid or duplicate parameter name: {name}')
+		if parameter.get('type') not in TEMPLATE_PARAMETER_TYPES:
+			raise ValueError(f"Invalid type for parameter {name}: {parameter.get('type')}")
+		names.add(name)
+	return parameters
+
+
+def parse_rule_json(rule_json):
+	"""模板规则（JSON文本，单个对象或列表），返回规则对象列表"""
+	rules = json.loads(rule_json) if isinstance(rule_json, str) else rule_json
+	if isinstance(rules, dict):
+		rules = [rules]
+	if not isinstance(rules, list) or not rules or not all(isinstance(rule, dict) for rule in rules):
+		raise ValueError('Template rule_json must be a rule object or a non-empty list of rule objects')
+	return rules
+
+
+class TemplateCache:
+	"""模板展开结果的进程内缓存：以模板内容和参数取值的摘要校验，只有变化时才重新展开和编译"""
+	
+	def __init__(self, size=TEMPLATE_CACHE_SIZE):
+		self.size = size
+		# 模板id -> (摘要, 展开结果)
+		self.entries = OrderedDict()
+		self._lock = threading.Lock()
+	
+	def get(self, template_id, digest, build):
+		with self._lock:
+			entry = self.entries.get(template_id)
+			if entry is not None and entry[0] == digest:
+				self.entries.move_to_end(template_id)
+				return entry[1]
+		
+		result = build()
+		with self._lock:
+			self.entries[template_id] = (digest, result)
+			self.entries.move_to_end(template_id)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+		return result
+
+
+# 进程内共享的模板展开缓存
+template_cache = TemplateCache()
+
+
+class TemplateExpander:
+	"""在服务端展开参数化规则模板
+	
+	每条模板规则按其引用的参数做笛卡尔积，集合元素类型（地址、端口）的参数在最内层变化，
+	展开后的规则优先级相同且按顺序写入，因此相邻排列，应用时由规则编译器合并为命名集合/ipset。
+	全部规则一次批量写入，每个后端一次内核事务应用。
+	"""
+	
+	def __init__(self, reconciler=None):
+		self.reconciler = reconciler or RuleReconciler()
+	
+	def expand(self, template, values=None):
+		"""展开模板，返回 {rules, compiled}；模板和参数取值未变时直接返回缓存的结果"""
+		values = values or {}
+		digest = hashlib.sha1(json.dumps([template.rule_json, template.parameters, values], sort_keys=True,
+		                                 default=str).encode()).hexdigest()
+		return template_cache.get(template.id, digest, lambda: self._build(template, values))
+	
+	def preview(self, template, values=None):
+		expansion = self.expand(template, values)
+		return {
+			'count': len(expansion['rules']),
+			'rules': expansion['rules'][:100],
+			'compiled': expansion['compiled']
+		}
+	
+	def apply(self, template, values=None, replace=False):
+		"""展开并批量应用；replace为True时先删除此前由该模板生成的规则"""
+		expansion = self.expand(template, values)
+		replaced = 0
+		if replace:
+			query = FirewallRule.query.filter(FirewallRule.template_id == template.id)
+			rule_ids = query.with_entities(FirewallRule.id)
+			RuleCounterSample.query.filter(RuleCounterSample.rule_id.in_(rule_ids)).delete(synchronize_session=False)
+			tombstone_rules(db.session, query)
+			replaced = query.delete(synchronize_session=False)
+		
+		importer = RuleImporter(self.reconciler)
+		importer.import_rows(dict(rule, template_id=template.id) for rule in expansion['rules'])
+		return {
+			'created': importer.imported,
+			'replaced': replaced,
+			'compiled': expansion['compiled']
+		}
+	
+	def _build(self, template, values):
+		parameters = parse_parameters(template.parameters or [])
+		resolved = self._resolve(parameters, values)
+		
+		rules = []
+		for index, rule in enumerate(parse_rule_json(template.rule_json)):
+			for data in self._expand_rule(rule, parameters, resolved):
+				error = validate_rule_data(data)
+				if error:
+					raise ValueError(f'Template rule {index + 1}: {error}')
+				rules.append({field: data.get(field, RULE_DEFAULTS.get(field)) for field in RULE_FIELDS})
+				if len(rules) > TEMPLATE_MAX_RULES:
+					raise ValueError(f'Template expands to more than {TEMPLATE_MAX_RULES} rules')
+		
+		return {'rules': rules, 'compiled': self._compile(rules)}
+	
+	@staticmethod
+	def _resolve(parameters, values):
+		"""参数名 -> 校验并规范化后的取值列表（未提供时使用默认值）"""
+		resolved = {}
+		for parameter in parameters:
+			name = parameter['name']
+			raw = values.get(name, parameter.get('default'))
+			items = _split_values(raw)
+			if not items:
+				raise ValueError(f'Missing value for parameter: {name}')
+			normalize = TEMPLATE_PARAMETER_TYPES[parameter['type']]
+			try:
+				# 重复的取值只展开一次
+				resolved[name] = list(dict.fromkeys(normalize(item) for item in items))
+			except ValueError as e:
+				raise ValueError(f'Parameter {name}: {e}')
+		return resolved
+	
+	@staticmethod
+	def _expand_rule(rule, parameters, resolved):
+		"""按单条模板规则引用的参数做笛卡尔积，逐条产出规则字段"""
+		referenced = set()
+		for value in rule.values():
+			if isinstance(value, str):
+				referenced.update(TEMPLATE_PLACEHOLDER.findall(value))
+		unknown = referenced - set(resolved)
+		if unknown:
+			raise ValueError(f"Unknown template parameter: {', '.join(sorted(unknown))}")
+		
+		types = {parameter['name']: parameter['type'] for parameter in parameters}
+		names = [name for name in types if name in referenced]
+		names.sort(key=lambda name: types[name] in TEMPLATE_ELEMENT_TYPES)
+		
+		for combination in itertools.product(*(resolved[name] for name in names)):
+			bound = dict(zip(names, combination))
+			yield {
+				field: TEMPLATE_PLACEHOLDER.sub(lambda match: bound[match.group(1)], value)
+				if isinstance(value, str) else value
+				for field, value in rule.items()
+			}
+	
+	def _compile(self, rules):
+		"""按应用时的编译方式估算展开结果在内核中的形态：内核规则数和集合"""
+		summary = {'kernel_rules': 0, 'sets': []}
+		chains = OrderedDict()
+		for data in rules:
+			if data['enabled']:
+				chains.setdefault((data['rule_type'], data['chain']), []).append(FirewallRule(**data))
+		
+		for (rule_type, chain), chain_rules in chains.items():
+			chain_rules.sort(key=lambda rule: rule.priority)
+			if rule_type == 'nftables':
+				units = self.reconciler.compiler.compile_chain(chain, chain_rules)
+			elif self.reconciler.firewall_manager.ipset.available():
+				units = self.reconciler.ipset_compiler.compile_chain(chain, chain_rules)
+			else:
+				units = chain_rules
+			
+			summary['kernel_rules'] += len(units)
+			summary['sets'].extend({
+				'rule_type': rule_type,
+				'chain': chain,
+				'name': unit.name,
+				'elements': len(unit.rules)
+			} for unit in units if isinstance(unit, CompiledGroup))
+		return summary
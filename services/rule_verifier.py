@@ -0,0 +1,164 @@
+# services/rule_verifier.py
+import bisect
+from collections import deque
+from models.rule import MANAGED_CHAIN_PREFIX, managed_chain_name
+from services.rule_compiler import CompiledGroup, unit_rules
+from services.chain_sharder import ShardJump, shard_chain
+from services.rule_reconciler import RuleReconciler
+from services.ruleset_cache import SNAPSHOT_MAX_AGE
+
+# 规则签名各字段的名称
+SIGNATURE_FIELDS = ('protocol', 'source', 'destination', 'port', 'action')
+
+
+def _signature_dict(signature):
+	return dict(zip(SIGNATURE_FIELDS, signature))
+
+
+def _in_order(positions):
+	"""最长递增子序列：返回保持相对顺序的元素下标集合，其余元素即为顺序错乱"""
+	tails = []
+	tail_indexes = []
+	previous = [None] * len(positions)
+	for index, position in enumerate(positions):
+		slot = bisect.bisect_left(tails, position)
+		if slot == len(tails):
+			tails.append(position)
+			tail_indexes.append(index)
+		else:
+			tails[slot] = position
+			tail_indexes[slot] = index
+		previous[index] = tail_indexes[slot - 1] if slot else None
+	
+	kept = set()
+	index = tail_indexes[-1] if tail_indexes else None
+	while index is not None:
+		kept.add(index)
+		index = previous[index]
+	return kept
+
+
+class RuleVerifier:
+	"""批量验证规则：每个后端读取一次内核快照，以签名哈希索引一次比对所有受管规则
+	
+	结果分为：missing（内核中不存在）、extra（受管链或编译集合中多出的内容）、
+	drifted（存在但顺序错乱、同一位置的规则被修改，或编译集合中缺少对应元素）。
+	"""
+	
+	def __init__(self, reconciler=None):
+		self.reconciler = reconciler or RuleReconciler()
+	
+	def verify(self, rule_type='all'):
+		rule_types = ['iptables', 'nftables'] if rule_type == 'all' else [rule_type]
+		report = {'verified': 0, 'missing': [], 'extra': [], 'drifted': [], 'missing_jumps': [], 'errors': {}}
+		
+		for current_type in rule_types:
+			try:
+				desired = self.reconciler.build_desired_state(current_type)
+				live = self.reconciler.fetch_live_state(current_type, max_age=SNAPSHOT_MAX_AGE)
+			except Exception as e:
+				report['errors'][current_type] = str(e)
+				continue
+			self._verify_backend(current_type, desired, live, report)
+		
+		report['effective'] = not (report['missing'] or report['extra'] or report['drifted'] or
+		                           report['missing_jumps'] or report['errors'])
+		return report
+	
+	def _verify_backend(self, rule_type, desired, live, report):
+		base_chains = set(desired)
+		base_chains.update(chain[len(MANAGED_CHAIN_PREFIX):] for chain in live['rules'])
+		
+		for base_chain in sorted(base_chains):
+			units = desired.get(base_chain, [])
+			managed_chain = managed_chain_name(base_chain)
+			if units and not shard_chain(base_chain) and base_chain not in live['jumps']:
+				report['missing_jumps'].append({'rule_type': rule_type, 'chain': base_chain})
+			# 分片分发规则不对应数据库规则，缺失时按缺少跳转报告
+			live_signatures = {entry['signature'] for entry in live['rules'].get(managed_chain, [])}
+			report['missing_jumps'].extend({'rule_type': rule_type, 'chain': base_chain, 'target': unit.target}
+			                               for unit in units
+			                               if isinstance(unit, ShardJump) and unit.signature() not in live_signatures)
+			self._verify_chain(rule_type, base_chain, units, live['rules'].get(managed_chain, []), live['sets'],
+			                   report)
+	
+	def _verify_chain(self, rule_type, chain, units, live_rules, live_sets, report):
+		# 签名 -> 内核中该签名规则的下标队列（重复规则按出现顺序依次配对）
+		index = {}
+		for live_index, entry in enumerate(live_rules):
+			index.setdefault(entry['signature'], deque()).append(live_index)
+		
+		matched = []
+		unmatched = []
+		for unit_index, unit in enumerate(units):
+			candidates = index.get(unit.signature())
+			if candidates:
+				matched.append((unit_index, candidates.popleft()))
+			else:
+				unmatched.append(unit_index)
+		
+		remaining = {live_index for candidates in index.values() for live_index in candidates}
+		
+		# 期望位置上是未配对的内核规则，视为该规则在内核中被修改
+		for unit_index in unmatched:
+			unit = units[unit_index]
+			if unit_index in remaining:
+				remaining.discard(unit_index)
+				actual = live_rules[unit_index]
+				for rule in unit_rules(unit):
+					report['drifted'].append(self._rule_entry(rule_type, rule, 'modified', actual=actual))
+			else:
+				report['missing'].extend(self._rule_entry(rule_type, rule) for rule in unit_rules(unit))
+		
+		in_order = _in_order([live_index for _, live_index in matched])
+		for position, (unit_index, live_index) in enumerate(matched):
+			unit = units[unit_index]
+			if position not in in_order:
+				for rule in unit_rules(unit):
+					report['drifted'].append(self._rule_entry(rule_type, rule, 'order', actual=live_rules[live_index]))
+			elif isinstance(unit, CompiledGroup):
+				self._verify_set(rule_type, unit, live_sets.get(unit.name, {}), report)
+			else:
+				report['verified'] += 1
+		
+		for live_index in sorted(remaining):
+			entry = live_rules[live_index]
+			report['extra'].append({
+				'rule_type': rule_type,
+				'chain': chain,
+				'position': entry['position'],
+				'handle': entry['handle'],
+				'rule': _signature_dict(entry['signature'])
+			})
+	
+	def _verify_set(self, rule_type, group, live_elements, report):
+		"""编译集合规则存在时，逐条检查其元素"""
+		desired_keys = set()
+		for rule, key, _ in group.rule_elements():
+			desired_keys.add(key)
+			if key in live_elements:
+				report['verified'] += 1
+			else:
+				report['drifted'].append(self._rule_entry(rule_type, rule, 'set_element', kernel_set=group.name))
+		
+		for key, element in live_elements.items():
+			if key not in desired_keys:
+				report['extra'].append({'rule_type': rule_type, 'chain': group.chain, 'set': group.name,
+				                        'element': element})
+	
+	@staticmethod
+	def _rule_entry(rule_type, rule, reason=None, actual=None, kernel_set=None):
+		entry = {
+			'rule_id': rule.id,
+			'rule_type': rule_type,
+			'chain': rule.chain,
+			'rule': _signature_dict(rule.signature())
+		}
+		if reason:
+			entry['reason'] = reason
+		if actual is not None:
+			entry['actual'] = dict(_signature_dict(actual['signature']), position=actual['position'],
+			                       handle=actual['handle'])
+		if kernel_set:
+			entry['set'] = kernel_set
+		return entry
@@ -0,0 +1,71 @@
+# services/ruleset_cache.py
+import hashlib
+import threading
+import time
+
+# 只用于展示的读取（状态、验证）在本进程未修改内核时，快照在该时间（秒）内直接复用，不再读取内核
+SNAPSHOT_MAX_AGE = 5
+
+
+class RulesetSnapshot:
+	"""一次内核规则集快照：原始输出的摘要、解析结果，以及按需派生的索引
+	
+	快照在多个请求和线程间共享，调用方不得修改 data 或派生结构。
+	"""
+	
+	def __init__(self, digest, data):
+		self.digest = digest
+		self.data = data
+		self.derived = {}
+	
+	def derive(self, name, build):
+		"""按名称缓存由快照派生的结构，同一快照只构建一次"""
+		if name not in self.derived:
+			self.derived[name] = build(self.data)
+		return self.derived[name]
+
+
+class RulesetCache:
+	"""进程内共享的内核规则集快照缓存
+	
+	默认每次读取都重新读取内核原始输出并校验摘要，内容未变时复用已解析的快照，不再解析；
+	其他进程对内核的修改因此总能被据此写入内核的调用方（协调、插入、删除）看到。
+	只用于展示的读取可传入max_age：本进程每次修改内核规则集后 invalidate() 使代数加一，
+	代数未变且快照未超过max_age时不访问内核。
+	"""
+	
+	def __init__(self):
+		self.generation = 0
+		# 键 -> (快照, 读取时的代数, 读取时间)
+		self.entries = {}
+		self._lock = threading.Lock()
+	
+	def invalidate(self):
+		"""本进程修改了内核规则集"""
+		with self._lock:
+			self.generation += 1
+	
+	def get(self, key, dump, parse, max_age=0):
+		"""读取快照；dump()返回内核原始输出文本，parse(文本)返回解析结果，
+		max_age（秒）只应由不据此写入内核的展示类读取使用"""
+		with self._lock:
+			entry = self.entries.get(key)
+			generation = self.generation
+		if entry is not None and entry[1] == generation and time.monotonic() - entry[2] < max_age:
+			return entry[0]
+		
+		raw = dump()
+		digest = hashlib.sha1(raw.encode()).hexdigest()
+		if entry is not None and entry[0].digest == digest:
+			snapshot = entry[0]
+		else:
+			snapshot = RulesetSnapshot(digest, parse(raw))
+		
+		# 读取期间发生的修改使代数变化，下次读取时会重新校验
+		with self._lock:
+			self.entries[key] = (snapshot, generation, time.monotonic())
+		return snapshot
+
+
+# 进程内共享的快照缓存
+ruleset_cache = RulesetCache()
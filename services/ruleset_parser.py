@@ -0,0 +1,433 @@
+# services/ruleset_parser.py
+import json
+import os
+import re
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from models.rule import OBJECT_GROUP_PREFIXES
+
+# iptables-save 输出中解析的表
+IPTABLES_TABLES = ('filter', 'nat', 'mangle', 'raw')
+
+# 增量解码nft JSON输出时每次读取的字符数
+NFT_READ_SIZE = 65536
+
+# nft JSON语句 -> 规则动作
+NFT_VERDICTS = {
+	'accept': 'ACCEPT',
+	'drop': 'DROP',
+	'reject': 'REJECT',
+	'return': 'RETURN',
+	'continue': 'CONTINUE',
+	'queue': 'QUEUE',
+	'log': 'LOG',
+	'masquerade': 'MASQUERADE',
+	'snat': 'SNAT',
+	'dnat': 'DNAT',
+	'redirect': 'REDIRECT'
+}
+
+# payload中隐含四层协议的协议名
+NFT_L4_PROTOCOLS = ('tcp', 'udp', 'udplite', 'sctp', 'dccp', 'icmp', 'icmpv6')
+
+# nft规则集中按 (族, 表, 名称) 记录的命名对象
+NFT_NAMED_OBJECTS = ('set', 'map', 'flowtable', 'counter', 'quota', 'limit', 'ct helper', 'ct timeout',
+                     'ct expectation', 'secmark', 'synproxy')
+
+
+# iptables-save 输出的参数：带引号的字符串（支持 \" 转义）或不含空白的单词
+IPTABLES_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|\'([^\']*)\'|(\S+)')
+
+
+def _unquote(value):
+	return value.replace('\\"', '"').replace('\\\\', '\\')
+
+
+def empty_rule(chain):
+	return {
+		'chain': chain,
+		'protocol': None,
+		'source': None,
+		'destination': None,
+		'port': None,
+		'action': None,
+		'comment': None
+	}
+
+
+def parse_iptables_rule(line):
+	"""解析一行 iptables -S / iptables-save 规则（-A 链 参数...）
+	
+	除数据库规则字段外还记录 in_interface、out_interface、source_port、target_options，
+	以及带 ! 取反的选项 negated。
+	"""
+	# 只有带引号的注释需要按引号切分，其余行直接按空白切分
+	if '"' in line or "'" in line:
+		parts = [_unquote(double) if double else single or word
+		         for double, single, word in IPTABLES_TOKEN.findall(line)]
+	else:
+		parts = line.split()
+	rule_data = empty_rule(parts[1] if len(parts) > 1 else None)
+	
+	negate = False
+	i = 2
+	while i < len(parts):
+		option = parts[i]
+		value = parts[i + 1] if i + 1 < len(parts) else None
+		if option == '!':
+			negate = True
+			i += 1
+			continue
+		if negate:
+			rule_data.setdefault('negated', []).append(option)
+			negate = False
+		
+		if value is None:
+			i += 1
+		elif option in ('-p', '--protocol'):
+			rule_data['protocol'] = value
+			i += 2
+		elif option in ('-s', '--source'):
+			rule_data['source'] = value
+			i += 2
+		elif option in ('-d', '--destination'):
+			rule_data['destination'] = value
+			i += 2
+		elif option in ('-i', '--in-interface'):
+			rule_data['in_interface'] = value
+			i += 2
+		elif option in ('-o', '--out-interface'):
+			rule_data['out_interface'] = value
+			i += 2
+		elif option in ('--dport', '--destination-port', '--dports', '--destination-ports'):
+			rule_data['port'] = value
+			i += 2
+		elif option in ('--sport', '--source-port', '--sports', '--source-ports'):
+			rule_data['source_port'] = value
+			i += 2
+		elif option == '--match-set' and i + 2 < len(parts):
+			# 编译进ipset的规则：按方向参数记为引用集合的源地址/端口；地址对象组按方向记为源/目标地址
+			flags = parts[i + 2].split(',')
+			if value.startswith(OBJECT_GROUP_PREFIXES['address']):
+				rule_data['source' if flags[0] == 'src' else 'destination'] = f'@{value}'
+			else:
+				if flags[0] == 'src':
+					rule_data['source'] = f'@{value}'
+				if flags[-1] == 'dst':
+					rule_data['port'] = f'@{value}'
+			i += 3
+		elif option in ('-j', '--jump', '-g', '--goto'):
+			rule_data['action'] = value
+			# 目标之后的参数都是目标选项（--to-destination、--reject-with 等）
+			if i + 2 < len(parts):
+				rule_data['target_options'] = ' '.join(parts[i + 2:])
+			break
+		elif option == '--comment':
+			rule_data['comment'] = value.strip('"\'')
+			i += 2
+		else:
+			i += 1
+	
+	return rule_data
+
+
+class IptablesSaveParser:
+	"""逐行解析 iptables-save / ip6tables-save 输出
+	
+	parse() 逐条产出规则，附带 family、table 和在链中的位置；链的默认策略记录在 chains 中。
+	"""
+	
+	def __init__(self, family='ipv4', tables=IPTABLES_TABLES):
+		self.family = family
+		self.tables = tables
+		# (表, 链) -> 默认策略（自定义链为None）
+		self.chains = {}
+	
+	def parse(self, lines):
+		table = None
+		positions = {}
+		for line in lines:
+			line = line.strip()
+			if not line or line[0] == '#':
+				continue
+			
+			if line[0] == '*':
+				table = line[1:]
+				positions = {}
+			elif line == 'COMMIT':
+				table = None
+			elif table not in self.tables:
+				continue
+			elif line[0] == ':':
+				parts = line[1:].split()
+				self.chains[(table, parts[0])] = parts[1] if len(parts) > 1 and parts[1] != '-' else None
+			elif line.startswith('-A '):
+				rule_data = parse_iptables_rule(line)
+				chain = rule_data['chain']
+				positions[chain] = positions.get(chain, 0) + 1
+				rule_data.update({'family': self.family, 'table': table, 'position': positions[chain]})
+				yield rule_data
+
+
+class JsonStreamError(ValueError):
+	"""增量解码时遇到语法错误或文档截断，line为出错位置所在的行号"""
+	
+	def __init__(self, line):
+		super().__init__(f'Invalid or truncated JSON near line {line}')
+		self.line = line
+
+
+def iter_json_array(stream, key=None, read_size=NFT_READ_SIZE):
+	"""增量解码JSON数组，逐个产出 (起始行号, 元素) 而不构建整个文档
+	
+	key为None时输入本身是数组，否则解码顶层对象中该键对应的数组（如 nft -j 输出的 "nftables"）。
+	"""
+	decoder = json.JSONDecoder()
+	buffer = ''
+	position = -1
+	
+	# 定位数组的起始位置
+	while position < 0:
+		chunk = stream.read(read_size)
+		if not chunk:
+			return
+		buffer += chunk
+		start = 0 if key is None else buffer.find(f'"{key}"')
+		if start >= 0:
+			position = buffer.find('[', start)
+	position += 1
+	
+	# line为buffer[counted]所在的行号
+	line = 1
+	counted = 0
+	exhausted = False
+	while True:
+		while position < len(buffer) and buffer[position] in ' \t\r\n,':
+			position += 1
+		if position < len(buffer) and buffer[position] == ']':
+			return
+		
+		try:
+			if position >= len(buffer):
+				raise ValueError('buffer exhausted')
+			item, end = decoder.raw_decode(buffer, position)
+		except ValueError:
+			if exhausted:
+				raise JsonStreamError(line + buffer.count('\n', counted, position))
+			chunk = stream.read(read_size)
+			exhausted = not chunk
+			line += buffer.count('\n', counted, position)
+			buffer = buffer[position:] + chunk
+			position = counted = 0
+			continue
+		
+		line += buffer.count('\n', counted, position)
+		counted = position
+		yield line, item
+		position = end
+
+
+def iter_nft_json(stream, read_size=NFT_READ_SIZE):
+	"""增量解码 nft -j 输出的 {"nftables": [...]}，逐个产出数组元素而不构建整个文档"""
+	for _, item in iter_json_array(stream, 'nftables', read_size):
+		yield item
+
+
+def nft_value_to_str(value):
+	"""将nft JSON中的匹配值（前缀、范围、匿名集合）转换为字符串"""
+	if isinstance(value, dict):
+		if 'prefix' in value:
+			return f"{value['prefix']['addr']}/{value['prefix']['len']}"
+		if 'range' in value:
+			return f"{value['range'][0]}-{value['range'][1]}"
+		if 'set' in value:
+			return ','.join(nft_value_to_str(item) for item in value['set'])
+	if isinstance(value, list):
+		return f'{value[0]}-{value[1]}'
+	return str(value)
+
+
+def parse_nft_rule(rule_json):
+	"""解析 nft -j 输出中的单条规则
+	
+	除数据库规则字段外还记录 family、table、handle，以及 in_interface、out_interface、source_port、
+	带 != 的字段 negated 和计数器 packets/bytes。
+	"""
+	rule_data = empty_rule(rule_json.get('chain'))
+	rule_data.update({
+		'family': rule_json.get('family'),
+		'table': rule_json.get('table'),
+		'handle': rule_json.get('handle'),
+		'comment': rule_json.get('comment')
+	})
+	
+	for expr in rule_json.get('expr', []):
+		match = expr.get('match')
+		if match:
+			left = match.get('left', {})
+			right = match.get('right')
+			if isinstance(left, dict) and 'payload' in left:
+				payload = left['payload']
+				field = payload.get('field')
+				
+				# 解析协议（ip protocol tcp 或 tcp dport 隐含的协议）
+				if field in ('protocol', 'nexthdr'):
+					rule_data['protocol'] = right
+				elif payload.get('protocol') in NFT_L4_PROTOCOLS:
+					rule_data['protocol'] = payload['protocol']
+				
+				# 解析源IP、目标IP和端口
+				if field == 'saddr':
+					rule_data['source'] = nft_value_to_str(right)
+				elif field == 'daddr':
+					rule_data['destination'] = nft_value_to_str(right)
+				elif field == 'dport':
+					rule_data['port'] = nft_value_to_str(right)
+				elif field == 'sport':
+					rule_data['source_port'] = nft_value_to_str(right)
+				if match.get('op') == '!=':
+					rule_data.setdefault('negated', []).append(field)
+			elif isinstance(left, dict) and 'meta' in left:
+				meta_key = left['meta'].get('key')
+				if meta_key == 'l4proto':
+					rule_data['protocol'] = right
+				elif meta_key in ('iifname', 'iif'):
+					rule_data['in_interface'] = right
+				elif meta_key in ('oifname', 'oif'):
+					rule_data['out_interface'] = right
+				if match.get('op') == '!=':
+					rule_data.setdefault('negated', []).append(meta_key)
+			elif isinstance(left, dict) and 'concat' in left:
+				# 源地址.端口拼接集合查找
+				for item in left['concat']:
+					payload = item.get('payload', {})
+					if payload.get('field') == 'saddr':
+						rule_data['source'] = right
+					elif payload.get('field') == 'dport':
+						rule_data['protocol'] = rule_data['protocol'] or payload.get('protocol')
+						rule_data['port'] = right
+			continue
+		
+		# 源地址判决映射
+		if 'vmap' in expr:
+			rule_data['source'] = expr['vmap'].get('data')
+			rule_data['action'] = expr['vmap'].get('data')
+		elif 'counter' in expr and isinstance(expr['counter'], dict):
+			rule_data['packets'] = expr['counter'].get('packets', 0)
+			rule_data['bytes'] = expr['counter'].get('bytes', 0)
+		elif 'jump' in expr or 'goto' in expr:
+			rule_data['action'] = (expr.get('jump') or expr.get('goto')).get('target')
+		else:
+			for statement, action in NFT_VERDICTS.items():
+				if statement in expr:
+					rule_data['action'] = action
+					break
+		
+		# 解析注释
+		if expr.get('comment') is not None:
+			rule_data['comment'] = expr['comment']
+	
+	return rule_data
+
+
+class NftRulesetParser:
+	"""解析 nft -j list ruleset 的对象流
+	
+	parse() 逐条产出规则；表、链和命名对象（集合、映射、流表、有状态对象等）按类型记录在
+	tables、chains 和 objects 中，元素增量等其它对象按类型追加到 others。
+	"""
+	
+	def __init__(self):
+		self.metainfo = None
+		self.tables = {}
+		self.chains = {}
+		self.objects = {}
+		self.others = {}
+	
+	def parse(self, items):
+		for item in items:
+			if 'rule' in item:
+				yield parse_nft_rule(item['rule'])
+				continue
+			
+			for kind, body in item.items():
+				if kind == 'metainfo':
+					self.metainfo = body
+				elif kind == 'table':
+					self.tables[(body.get('family'), body.get('name'))] = body
+				elif kind == 'chain':
+					self.chains[(body.get('family'), body.get('table'), body.get('name'))] = body
+				elif kind in NFT_NAMED_OBJECTS:
+					self.objects.setdefault(kind, {})[
+						(body.get('family'), body.get('table'), body.get('name'))] = body
+				else:
+					self.others.setdefault(kind, []).append(body)
+
+
+class RulesetReader:
+	"""流式读取内核规则集：iptables-save（IPv4/IPv6，filter/nat/mangle/raw）和 nft -j list ruleset
+	
+	各后端的输出边读边解析，read() 在线程池中并发运行各后端。
+	"""
+	
+	def __init__(self, iptables_save_path=None, ip6tables_save_path=None, nftables_path=None):
+		self.iptables_save_path = iptables_save_path or current_app.config.get('IPTABLES_SAVE_PATH',
+		                                                                       '/sbin/iptables-save')
+		self.ip6tables_save_path = ip6tables_save_path or current_app.config.get('IP6TABLES_SAVE_PATH',
+		                                                                         '/sbin/ip6tables-save')
+		self.nftables_path = nftables_path or current_app.config.get('NFTABLES_PATH', '/sbin/nft')
+	
+	def read(self, backends=('iptables', 'ip6tables', 'nftables')):
+		"""并发读取各后端，返回 (后端 -> 规则列表, 后端 -> 错误信息)"""
+		readers = {
+			'iptables': lambda: self.read_iptables('ipv4'),
+			'ip6tables': lambda: self.read_iptables('ipv6'),
+			'nftables': self.read_nftables
+		}
+		
+		rulesets = {}
+		errors = {}
+		with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+			futures = {backend: executor.submit(readers[backend]) for backend in backends}
+			for backend, future in futures.items():
+				try:
+					rulesets[backend] = future.result()
+				except Exception as e:
+					rulesets[backend] = []
+					errors[backend] = str(e)
+		return rulesets, errors
+	
+	def read_iptables(self, family='ipv4', tables=IPTABLES_TABLES):
+		path = self.iptables_save_path if family == 'ipv4' else self.ip6tables_save_path
+		if family == 'ipv6' and not os.access(path, os.X_OK):
+			return []
+		
+		parser = IptablesSaveParser(family, tables)
+		with command_output([path]) as stdout:
+			return list(parser.parse(stdout))
+	
+	def read_nftables(self):
+		parser = NftRulesetParser()
+		with command_output([self.nftables_path, '-j', 'list', 'ruleset']) as stdout:
+			return list(parser.parse(iter_nft_json(stdout)))
+
+
+@contextmanager
+def command_output(cmd):
+	"""运行命令并以文本流提供其标准输出；退出码非0时抛出异常
+	
+	标准错误写入临时文件而不是管道：读取标准输出期间命令写满标准错误管道会使双方互相等待。
+	"""
+	with tempfile.TemporaryFile(mode='w+') as stderr:
+		process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr, text=True)
+		try:
+			yield process.stdout
+		finally:
+			process.stdout.close()
+			returncode = process.wait()
+		if returncode != 0:
+			stderr.seek(0)
+			raise Exception(f"{os.path.basename(cmd[0])} failed: {stderr.read()}")
@@ -3,8 +3,16 @@ import subprocess
 import re
 import time
 import threading
-from datetime import datetime
-from models import db, FirewallStatus, ConnectionStat, FirewallRule
+from datetime import datetime, timedelta
+from models import db, FirewallStatus, ConnectionStat, FirewallRule, RuleCounterSample
+from models.rule import tombstone_rules
+from services.firewall_manager import FirewallManager
+from services.rule_reconciler import RuleReconciler
+from services.rule_compiler import element_key, element_ref, rule_element_key
+from services.ipset_backend import ipset_element_key, ipset_element_ref
+from services.ruleset_cache import ruleset_cache, SNAPSHOT_MAX_AGE
+from services.drift_watcher import DriftWatcher
+from services.job_queue import job_queue, RULESET_LOCK
 from flask import current_app
 
 
@@ -14,7 +22,11 @@ class FirewallMonitor:
 		self.iptables_path = current_app.config.get('IPTABLES_PATH', '/sbin/iptables')
 		self.nftables_path = current_app.config.get('NFTABLES_PATH', '/sbin/nft')
 		self.monitor_interval = current_app.config.get('MONITOR_INTERVAL', 30)
+		self.rule_stats_retention = current_app.config.get('RULE_STATS_RETENTION_DAYS', 7)
 		self.running = False
+		self.drift_watchers = []
+		# 规则id -> (内核定位, (包数, 字节数), 采样时间)，作为计算增量的基线
+		self.rule_counters = {}
 	
 	def check_status(self):
 		"""检查防火墙服务状态"""
@@ -70,12 +82,9 @@ class FirewallMonitor:
 	def _check_nftables_status(self):
 		"""检查nftables状态"""
 		try:
-			# 尝试列出nftables规则
-			result = subprocess.run([self.nftables_path, 'list', 'ruleset'], check=False, capture_output=True,
-			                        text=True)
-			
-			# 如果命令成功执行，则认为服务正常
-			return result.returncode == 0
+			# 能读取规则集快照即认为服务正常（快照与其他读取共享）
+			FirewallManager().snapshot('nftables', max_age=SNAPSHOT_MAX_AGE)
+			return True
 		except Exception as e:
 			current_app.logger.error(f"Error checking nftables status: {e}")
 			return False
@@ -146,6 +155,101 @@ class FirewallMonitor:
 			current_app.logger.error(f"Error getting connection stats: {e}")
 			return None
 	
+	def collect_rule_counters(self):
+		"""每个后端一次列出所有受管规则的计数器，记录与上次采样之间的增量
+		
+		编译进集合的规则使用其元素的计数器；集合未开启元素计数器时不记录，
+		避免把整个集合规则的命中次数算到每条成员规则上。
+		"""
+		now = datetime.utcnow()
+		rules_by_type = {}
+		for rule in FirewallRule.query.filter_by(enabled=True).all():
+			if rule.kernel_key[1] is not None:
+				rules_by_type.setdefault(rule.rule_type, []).append(rule)
+		
+		firewall_manager = FirewallManager()
+		rule_counters = {}
+		samples = []
+		for rule_type, rules in rules_by_type.items():
+			try:
+				counters = firewall_manager.read_counters(rule_type)
+			except Exception as e:
+				current_app.logger.error(f"Error collecting {rule_type} rule counters: {e}")
+				continue
+			
+			for rule in rules:
+				if rule.kernel_set:
+					element = ipset_element_key(ipset_element_ref(rule)) if rule_type == 'iptables' \
+						else rule_element_key(rule)
+					kernel_key = (rule.kernel_set, element)
+					current = counters['elements'].get(rule.kernel_set, {}).get(element)
+				else:
+					kernel_key = rule.kernel_key
+					current = counters['rules'].get(kernel_key)
+				if current is None:
+					continue
+				rule_counters[rule.id] = (kernel_key, current, now)
+				
+				previous = self.rule_counters.get(rule.id)
+				# 首次采样或规则在内核中的位置变化时只建立基线
+				if previous is None or previous[0] != kernel_key:
+					continue
+				packets, size = current
+				previous_packets, previous_bytes = previous[1]
+				# 计数器被清零时从零开始计算
+				if packets >= previous_packets and size >= previous_bytes:
+					packets -= previous_packets
+					size -= previous_bytes
+				if packets or size:
+					samples.append({
+						'rule_id': rule.id,
+						'timestamp': now,
+						'interval': (now - previous[2]).total_seconds(),
+						'packets': packets,
+						'bytes': size
+					})
+		self.rule_counters = rule_counters
+		
+		if samples:
+			db.session.bulk_insert_mappings(RuleCounterSample, samples)
+		RuleCounterSample.query.filter(
+			RuleCounterSample.timestamp < now - timedelta(days=self.rule_stats_retention)).delete(
+			synchronize_session=False)
+		db.session.commit()
+		
+		return len(samples)
+	
+	def purge_expired_rules(self):
+		"""批量删除已过期的临时规则，并为每个涉及的后端协调一次
+		
+		超时集合中的元素已由内核按超时删除，协调只移除不再引用任何元素的集合规则，
+		以及无法放入超时集合、作为单独规则写入的临时规则。
+		"""
+		query = FirewallRule.query.filter(FirewallRule.expires_at <= datetime.utcnow())
+		rule_types = [rule_type for rule_type, in query.with_entities(FirewallRule.rule_type).distinct()]
+		if not rule_types:
+			return 0
+		
+		try:
+			# 与路由和后台任务中的规则集修改互斥
+			with job_queue.exclusive(RULESET_LOCK):
+				rule_ids = query.with_entities(FirewallRule.id)
+				RuleCounterSample.query.filter(RuleCounterSample.rule_id.in_(rule_ids)).delete(synchronize_session=False)
+				tombstone_rules(db.session, query)
+				count = query.delete(synchronize_session=False)
+				
+				reconciler = RuleReconciler()
+				for rule_type in rule_types:
+					reconciler.apply_plan(reconciler.plan(rule_type))
+				db.session.commit()
+		except Exception as e:
+			db.session.rollback()
+			current_app.logger.error(f"Error purging expired rules: {e}")
+			return 0
+		
+		current_app.logger.info(f"Purged {count} expired rules")
+		return count
+	
 	def verify_rule_effectiveness(self, rule_id):
 		"""验证规则是否生效"""
 		rule = FirewallRule.query.get_or_404(rule_id)
@@ -185,55 +289,15 @@ class FirewallMonitor:
 			}
 	
 	def _verify_nftables_rule(self, rule):
-		"""验证nftables规则是否生效"""
-		# 对于nftables，我们需要列出所有规则并检查是否有匹配的
+		"""验证nftables规则是否生效：在共享的规则集快照中按签名查找（编译进集合的规则查找集合元素）"""
 		try:
-			# 获取规则列表
-			result = subprocess.run([self.nftables_path, '-j', 'list', 'ruleset'], check=True, capture_output=True,
-			                        text=True)
-			
-			# 解析JSON输出
-			import json
-			rules_json = json.loads(result.stdout)
-			
-			# 检查是否有匹配的规则
-			# 这是一个简化的匹配逻辑，实际情况可能需要更复杂的比较
-			found = False
-			if 'nftables' in rules_json:
-				for item in rules_json['nftables']:
-					if 'rule' in item and item['rule'].get('chain') == rule.chain:
-						# 简单匹配：检查协议、源IP和目标IP
-						expr = item['rule'].get('expr', [])
-						matches = 0
-						needed_matches = 0
-						
-						if rule.protocol and rule.protocol != 'all':
-							needed_matches += 1
-							for e in expr:
-								if e.get('match', {}).get('left', {}).get('payload', {}).get(
-										'protocol') == rule.protocol:
-									matches += 1
-									break
-						
-						if rule.source and rule.source != 'any':
-							needed_matches += 1
-							for e in expr:
-								if e.get('match', {}).get('left', {}).get('payload', {}).get('field') == 'saddr' and \
-										e.get('match', {}).get('right') == rule.source:
-									matches += 1
-									break
-						
-						if rule.destination and rule.destination != 'any':
-							needed_matches += 1
-							for e in expr:
-								if e.get('match', {}).get('left', {}).get('payload', {}).get('field') == 'daddr' and \
-										e.get('match', {}).get('right') == rule.destination:
-									matches += 1
-									break
-						
-						if matches == needed_matches:
-							found = True
-							break
+			firewall_manager = FirewallManager()
+			if rule.kernel_set:
+				live_state = RuleReconciler(firewall_manager).fetch_live_state('nftables', max_age=SNAPSHOT_MAX_AGE)
+				live_sets = live_state['sets']
+				found = element_key(element_ref(rule)['element']['elem'][0]) in live_sets.get(rule.kernel_set, {})
+			else:
+				found = bool(firewall_manager.nftables_rule_index().get((rule.kernel_chain, rule.signature())))
 			
 			# 返回验证结果
 			return {
@@ -252,6 +316,8 @@ class FirewallMonitor:
 	
 	def control_firewall(self, service, action):
 		"""控制防火墙服务"""
+		# 启停服务会加载或清空规则集
+		ruleset_cache.invalidate()
 		if service == 'iptables':
 			return self._control_iptables(action)
 		else:
@@ -346,6 +412,7 @@ class FirewallMonitor:
 	def start_monitoring(self):
 		"""启动定期监控"""
 		self.running = True
+		self.start_drift_watchers()
 		
 		while self.running:
 			try:
@@ -355,15 +422,33 @@ class FirewallMonitor:
 				# 获取连接统计
 				self.get_connection_stats()
 				
+				# 采集规则计数器
+				self.collect_rule_counters()
+				
+				# 清理已过期的临时规则
+				self.purge_expired_rules()
+				
 				# 等待下一次检查
 				time.sleep(self.monitor_interval)
 			except Exception as e:
 				current_app.logger.error(f"Error in monitoring loop: {e}")
 				time.sleep(self.monitor_interval)
 	
+	def start_drift_watchers(self):
+		"""启动事件驱动的漂移检测（nft monitor / xtables-monitor），不参与定期轮询"""
+		if not current_app.config.get('DRIFT_WATCH_ENABLED', True):
+			return
+		app = current_app._get_current_object()
+		for rule_type in ('nftables', 'iptables'):
+			watcher = DriftWatcher(app, self.socketio, rule_type)
+			watcher.start()
+			self.drift_watchers.append(watcher)
+	
 	def stop_monitoring(self):
 		"""停止监控"""
 		self.running = False
+		for watcher in self.drift_watchers:
+			watcher.stop()
 	
 	def broadcast_status_update(self, status_data):
 		"""通过WebSocket广播状态更新"""
@@ -6,6 +6,8 @@ import subprocess
 import tempfile
 from datetime import datetime
 from models import db, SystemSetting, SystemBackup, FirewallRule
+from models.rule import tombstone_rules
+from services.rule_reconciler import RuleReconciler
 from flask import current_app
 
 
@@ -81,21 +83,8 @@ class SystemManager:
 			db.session.begin_nested()
 			
 			try:
-				# 恢复规则前先清除现有规则
-				# 1. 从防火墙中移除规则
-				firewall_manager = FirewallManager()
-				existing_rules = FirewallRule.query.all()
-				
-				for rule in existing_rules:
-					try:
-						if rule.rule_type == 'iptables':
-							firewall_manager.remove_iptables_rule(rule)
-						else:
-							firewall_manager.remove_nftables_rule(rule)
-					except Exception as e:
-						current_app.logger.warning(f"Error removing rule {rule.id}: {e}")
-				
-				# 2. 从数据库中删除规则
+				# 恢复规则前先清除数据库中的现有规则，内核状态稍后统一协调
+				tombstone_rules(db.session, FirewallRule.query)
 				FirewallRule.query.delete()
 				
 				# 恢复规则
@@ -140,16 +129,8 @@ class SystemManager:
 				# 提交事务
 				db.session.commit()
 				
-				# 应用恢复的规则
-				for rule in restored_rules:
-					try:
-						if rule.enabled:
-							if rule.rule_type == 'iptables':
-								firewall_manager.apply_iptables_rule(rule)
-							else:
-								firewall_manager.apply_nftables_rule(rule)
-					except Exception as e:
-						current_app.logger.warning(f"Error applying restored rule {rule.id}: {e}")
+				# 将内核受管链协调为恢复后的规则，只应用差异
+				RuleReconciler().reconcile()
 				
 				return {
 					'success': True,
@@ -1,4 +1,27 @@
 // static/js/components.js
+// 轮询后台任务直到结束，成功时返回任务，失败时以任务或请求错误拒绝
+function waitForJob(jobId) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            axios.get(`/api/jobs/${jobId}`, {
+                headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') }
+            })
+            .then(response => {
+                const job = response.data.data;
+                if (job.status === 'succeeded') {
+                    resolve(job);
+                } else if (job.status === 'failed') {
+                    reject({ response: { data: { message: job.error || job.message } } });
+                } else {
+                    setTimeout(poll, 1000);
+                }
+            })
+            .catch(reject);
+        };
+        poll();
+    });
+}
+
 // 规则管理组件
 const RuleManagement = {
     data() {
@@ -44,7 +67,8 @@ const RuleManagement = {
             ],
             importDialogVisible: false,
             importFile: null,
-            syncLoading: false
+            syncLoading: false,
+            verifyLoading: false
         };
     },
     created() {
@@ -174,6 +198,27 @@ const RuleManagement = {
                 this.$message.error('验证失败: ' + error.response.data.message);
             });
         },
+        verifyAllRules() {
+            this.verifyLoading = true;
+
+            axios.post('/api/status/verify', {}, {
+                headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') }
+            })
+            .then(response => {
+                const result = response.data.data;
+                if (result.effective) {
+                    this.$message.success(`全部规则验证成功: ${result.verified} 条生效`);
+                } else {
+                    this.$message.warning(`规则验证发现差异: ${result.verified} 条生效, ${result.missing.length} 条缺失, ` +
+                        `${result.drifted.length} 条漂移, ${result.extra.length} 条多余`);
+                }
+                this.verifyLoading = false;
+            })
+            .catch(error => {
+                this.$message.error('验证失败: ' + error.response.data.message);
+                this.verifyLoading = false;
+            });
+        },
         handleImportSuccess() {
             this.importDialogVisible = false;
             this.fetchRules();
@@ -217,8 +262,9 @@ const RuleManagement = {
                     'Content-Type': 'multipart/form-data'
                 }
             })
-            .then(response => {
-                this.$message.success('规则导入成功: ' + response.data.message);
+            .then(response => waitForJob(response.data.data.id))
+            .then(job => {
+                this.$message.success('规则导入成功: ' + job.message);
                 this.importDialogVisible = false;
                 this.fetchRules();
             })
@@ -232,8 +278,9 @@ const RuleManagement = {
             axios.post('/api/rules/sync', {}, {
                 headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') }
             })
-            .then(response => {
-                this.$message.success('规则同步成功: ' + response.data.message);
+            .then(response => waitForJob(response.data.data.id))
+            .then(job => {
+                this.$message.success('规则同步成功: ' + job.message);
                 this.fetchRules();
                 this.syncLoading = false;
             })
@@ -255,6 +302,7 @@ const RuleManagement = {
                     <el-button @click="importDialogVisible = true">导入规则</el-button>
                     <el-button @click="exportRules">导出规则</el-button>
                     <el-button :loading="syncLoading" @click="syncRules">同步服务器规则</el-button>
+                    <el-button :loading="verifyLoading" @click="verifyAllRules">验证全部规则</el-button>
                 </div>
                 
                 <el-table :data="rules" v-loading="loading" border style="width: 100%">
@@ -412,12 +460,16 @@ const StatusMonitor = {
                 service: 'iptables',
                 action: 'restart'
             },
-            controlLoading: false
+            controlLoading: false,
+            shardType: 'nftables',
+            shardReport: null,
+            shardLoading: false
         };
     },
     created() {
         this.fetchStatus();
         this.fetchConnectionStats();
+        this.fetchShards();
         this.initSocket();
     },
     mounted() {
@@ -467,6 +519,29 @@ const StatusMonitor = {
                 this.$message.error('获取连接统计失败: ' + error.response.data.message);
             });
         },
+        fetchShards() {
+            this.shardLoading = true;
+
+            axios.get(`/api/rules/shards?type=${this.shardType}`, {
+                headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') }
+            })
+            .then(response => {
+                this.shardReport = response.data.data;
+                this.shardLoading = false;
+            })
+            .catch(error => {
+                this.$message.error('获取规则链分片失败: ' + error.response.data.message);
+                this.shardLoading = false;
+            });
+        },
+        shardLabel(node) {
+            // 分发条件 -> 子链（规则数 / 内核规则数）
+            let label = node.managed_chain;
+            if (node.match) {
+                label = `${node.match.protocol}` + (node.match.port !== 'any' ? ` dport ${node.match.port}` : '') + ` → ${label}`;
+            }
+            return `${label}（规则 ${node.rules}，内核规则 ${node.kernel_rules}）`;
+        },
         initSocket() {
             // 初始化Socket.IO连接
             this.socket = io();
@@ -493,6 +568,18 @@ const StatusMonitor = {
 
                 this.updateCharts();
             });
+
+            // 监听内核规则漂移
+            this.socket.on('rule_drift', (data) => {
+                const target = data.chain || data.set;
+                const labels = { missing: '缺失', extra: '多余', resolved: '已恢复' };
+                const message = `${data.rule_type} ${target}: 规则${labels[data.drift] || data.drift}`;
+                if (data.drift === 'resolved') {
+                    this.$message.success(message);
+                } else {
+                    this.$message.warning(message);
+                }
+            });
         },
         initCharts() {
             // 初始化连接总数图表
@@ -601,6 +688,7 @@ const StatusMonitor = {
         refreshData() {
             this.fetchStatus();
             this.fetchConnectionStats();
+            this.fetchShards();
         },
         formatTime(timestamp) {
             if (!timestamp) return '未知';
@@ -721,6 +809,39 @@ const StatusMonitor = {
                 </div>
             </el-card>
             
+            <el-card class="chart-container" v-loading="shardLoading">
+                <div slot="header">
+                    <span>规则链分片</span>
+                    <el-select v-model="shardType" size="small" style="float: right; width: 120px;" @change="fetchShards">
+                        <el-option label="nftables" value="nftables"></el-option>
+                        <el-option label="iptables" value="iptables"></el-option>
+                    </el-select>
+                </div>
+                <div v-if="shardReport && shardReport.chains.length > 0">
+                    <div style="font-size: 12px; color: #909399; margin-bottom: 10px;">
+                        分片的链: {{ shardReport.sharding_chains.join(', ') || '未启用' }}，
+                        深度按{{ shardReport.traffic_samples > 0 ? '最近 ' + shardReport.traffic_samples + ' 条日志的流量' : '各分发路径平均' }}估算
+                    </div>
+                    <div v-for="chain in shardReport.chains" :key="chain.chain" style="margin-bottom: 20px;">
+                        <div style="margin-bottom: 10px;">
+                            <span style="font-weight: bold;">{{ chain.chain }}</span>
+                            <el-tag size="mini" :type="chain.sharded ? 'success' : 'info'">{{ chain.sharded ? '已分片' : '未分片' }}</el-tag>
+                            <span style="margin-left: 10px;">规则数: {{ chain.rules }}</span>
+                            <span style="margin-left: 10px;">
+                                每包经过规则数: 平均 {{ chain.depth.average }}（未分片 {{ chain.flat_depth.average }}），
+                                最多 {{ chain.depth.max }}（未分片 {{ chain.flat_depth.max }}）
+                            </span>
+                        </div>
+                        <el-tree :data="[chain.tree]" node-key="chain" default-expand-all :expand-on-click-node="false">
+                            <span slot-scope="{ data }">{{ shardLabel(data) }}</span>
+                        </el-tree>
+                    </div>
+                </div>
+                <div v-else>
+                    <el-empty description="暂无受管规则"></el-empty>
+                </div>
+            </el-card>
+            
             <!-- 防火墙控制对话框 -->
             <el-dialog title="防火墙服务控制" :visible.sync="controlDialogVisible" width="400px">
                 <el-form :model="controlForm" label-width="100px">
@@ -959,8 +1080,9 @@ const LogAnalysis = {
             axios.post('/api/logs/collect', {}, {
                 headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') }
             })
-            .then(response => {
-                this.$message.success(response.data.message);
+            .then(response => waitForJob(response.data.data.id))
+            .then(job => {
+                this.$message.success(job.message);
                 this.collectLoading = false;
                 this.fetchLogs();
             })
@@ -1598,7 +1720,8 @@ const SystemSettings = {
                 axios.post(`/api/settings/backups/${backup.id}`, {}, {
                     headers: { 'Authorization': 'Bearer ' + localStorage.getItem('token') }
                 })
-                .then(response => {
+                .then(response => waitForJob(response.data.data.id))
+                .then(job => {
                     this.$message.success('系统恢复成功');
                     this.restoreLoading = false;
                     // 刷新页面以应用恢复的设置